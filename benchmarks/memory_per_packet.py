@@ -0,0 +1,110 @@
+# Measures the memory that is allocated per decoded packet.
+#
+# Usage (from the repo directory):
+#   python benchmarks/memory_per_packet.py                    # Run and print results.
+#   python benchmarks/memory_per_packet.py -o before.json     # Also save the results.
+#   python benchmarks/memory_per_packet.py -b before.json     # Compare with saved results.
+#
+# With --baseline, the exit code is 1 if any result grew by more than
+# --threshold, same as run_benchmarks.py.
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+from typing import Dict
+
+# For using the local version of serial_packet.
+sys.path.insert(0, "./src")
+
+from serial_packets.packet_decoder import PacketDecoder
+from serial_packets.packet_encoder import PacketEncoder
+
+NUM_PACKETS = 10000
+
+
+def measure(wire_bytes: bytes) -> Dict[str, float]:
+    """Returns the average retained and peak bytes per decoded packet."""
+    decoder = PacketDecoder()
+    # Warm up, e.g. for lazy allocations.
+    decoder.receive_bytes(wire_bytes)
+    stream = wire_bytes * NUM_PACKETS
+    tracemalloc.start()
+    start_size, _ = tracemalloc.get_traced_memory()
+    packets = decoder.receive_bytes(stream)
+    end_size, peak_size = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert (len(packets) == NUM_PACKETS)
+    # Exclude the list that holds the packets.
+    list_size = sys.getsizeof(packets)
+    return {
+        "retained_bytes": (end_size - start_size - list_size) / NUM_PACKETS,
+        "peak_bytes": (peak_size - start_size) / NUM_PACKETS,
+    }
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], threshold: float) -> bool:
+    """Prints the changes vs the baseline. Returns True if any metric grew."""
+    regressed = False
+    print(f"\n{'Packet':<12} {'Metric':<16} {'Baseline':>10} {'Current':>10} {'Change':>9}")
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            base_value = baseline.get(name, {}).get(metric)
+            if base_value is None:
+                continue
+            change = (value / base_value - 1) if base_value else 0.0
+            is_regression = value - base_value > threshold * max(base_value, 1.0)
+            regressed = regressed or is_regression
+            flag = "  REGRESSION" if is_regression else ""
+            print(f"{name:<12} {metric:<16} {base_value:>10.1f} {value:>10.1f} "
+                  f"{change:>+9.1%}{flag}")
+    return regressed
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Memory per decoded packet.")
+    parser.add_argument("-o", "--output", help="Save the results to this json file.")
+    parser.add_argument("-b", "--baseline", help="Compare with results saved with --output.")
+    parser.add_argument("-t",
+                        "--threshold",
+                        type=float,
+                        default=0.1,
+                        help="Relative growth that is reported as a regression. Default 0.1.")
+    args = parser.parse_args()
+
+    encoder = PacketEncoder()
+    results: Dict[str, Dict] = {}
+    for size in [0, 16, 256]:
+        data = bytearray(i % 256 for i in range(size))
+        results[f"command/{size}"] = measure(
+            bytes(encoder.encode_command_packet(1234, 20, data)))
+        results[f"message/{size}"] = measure(bytes(encoder.encode_message_packet(20, data)))
+
+    for name, metrics in results.items():
+        print(f"{name:<12} {metrics['retained_bytes']:8.1f} bytes/packet retained, "
+              f"{metrics['peak_bytes']:8.1f} bytes/packet peak")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "python": sys.version,
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "results": results,
+                },
+                f,
+                indent=2)
+        print(f"\nSaved results to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+# Decode and dispatch throughput on real traffic, by replaying a capture file
+# that was recorded with serial_packets.capture.CaptureRecorder.
+#
+# Usage (from the repo directory):
+#   python benchmarks/replay_capture.py session.spcap            # As fast as possible.
+#   python benchmarks/replay_capture.py session.spcap --realtime # At the original timing.
+
+import argparse
+import asyncio
+import sys
+import time
+
+# For using the local version of serial_packet.
+sys.path.insert(0, "./src")
+
+from serial_packets.capture import CAPTURE_RX, CaptureReader, ReplayTransport, decode_capture
+from serial_packets.client import SerialPacketsClient
+from serial_packets.packets import PacketData, PacketStatus
+
+
+def bench_decoder(path: str) -> None:
+    """Decodes the capture without a client or an event loop."""
+    with CaptureReader(path) as reader:
+        num_bytes = sum(len(chunk) for d, _, chunk in reader.records() if d == CAPTURE_RX)
+    start = time.perf_counter()
+    num_packets = sum(1 for _ in decode_capture(path))
+    elapsed = time.perf_counter() - start
+    print(f"{'decoder':<10} {num_packets:>10,} packets  {num_bytes / elapsed / 1e6:>8.2f} MB/s  "
+          f"{num_packets / elapsed:>12,.0f} packets/s")
+
+
+async def bench_client(path: str, realtime: bool, speed: float) -> None:
+    """Replays the capture through a client, with no op handlers."""
+
+    async def on_command(endpoint: int, data: PacketData):
+        return (PacketStatus.OK.value, PacketData())
+
+    async def on_message(endpoint: int, data: PacketData):
+        pass
+
+    transport = ReplayTransport(path, realtime=realtime, speed=speed)
+    client = SerialPacketsClient(transport,
+                                 command_async_callback=on_command,
+                                 message_async_callback=on_message)
+    assert await client.connect()
+    num_bytes, elapsed = await transport.wait_finished()
+    stats = client.stats()
+    num_packets = sum(stats.rx_packets.values())
+    print(f"{'client':<10} {num_packets:>10,} packets  {num_bytes / elapsed / 1e6:>8.2f} MB/s  "
+          f"{num_packets / elapsed:>12,.0f} packets/s  ({elapsed:.2f}s)")
+    print(f"{'':<10} crc errors={stats.crc_errors}  framing errors={stats.framing_errors}  "
+          f"queue high water={stats.queue_high_water}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Replays a serial packets capture file.")
+    parser.add_argument("path", help="A capture file.")
+    parser.add_argument("--realtime", action="store_true", help="Replay at the original timing.")
+    parser.add_argument("--speed",
+                        type=float,
+                        default=1.0,
+                        help="Speed up factor of a realtime replay. Default 1.0.")
+    args = parser.parse_args()
+    if not args.realtime:
+        bench_decoder(args.path)
+    asyncio.run(bench_client(args.path, args.realtime, args.speed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,310 @@
+# Throughput and latency benchmarks of the encoder, decoder, PacketData and
+# client command round trips.
+#
+# Usage (from the repo directory):
+#   python benchmarks/run_benchmarks.py                       # Run and print results.
+#   python benchmarks/run_benchmarks.py -o baseline.json      # Also save the results.
+#   python benchmarks/run_benchmarks.py -b baseline.json      # Compare with saved results.
+#   python benchmarks/run_benchmarks.py --quick -k decode     # A quick run of a subset.
+#
+# With --baseline, the exit code is 1 if any result regressed by more than
+# --threshold, so the script can be used as a CI gate on the same machine.
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+from typing import Callable, Dict, List
+
+# For using the local version of serial_packet.
+sys.path.insert(0, "./src")
+
+from serial_packets.client import SerialPacketsClient
+from serial_packets.packet_decoder import PacketDecoder
+from serial_packets.packet_encoder import PacketEncoder
+from serial_packets.packets import PacketData, PacketStatus
+from serial_packets.transports import FdTransport, LoopbackTransport
+
+PAYLOAD_SIZES = [0, 16, 64, 256, 1024]
+# Fraction of the data bytes that are flag or escape bytes and need stuffing.
+ESCAPE_DENSITIES = [0.0, 0.1, 0.5, 1.0]
+SPECIAL_BYTES = [0x7C, 0x7D, 0x7E]
+
+# Metrics where a lower value is better. All the others are higher is better.
+LOWER_IS_BETTER = ("_us",)
+
+
+class Config:
+    """Benchmark run parameters."""
+
+    def __init__(self, quick: bool):
+        # Min duration of a single timed run, in secs.
+        self.min_run_time = 0.05 if quick else 0.2
+        # Number of timed runs. The best one is reported.
+        self.repeats = 2 if quick else 5
+        # Number of commands per round trip benchmark.
+        self.rtt_commands = 300 if quick else 2000
+
+
+def make_data(size: int, escape_density: float) -> bytearray:
+    """Returns deterministic data with the given fraction of special bytes."""
+    rnd = random.Random(size * 1000 + int(escape_density * 100))
+    num_special = round(size * escape_density)
+    data = [rnd.choice(SPECIAL_BYTES) for _ in range(num_special)]
+    data.extend(rnd.choice([b for b in range(256) if b not in SPECIAL_BYTES])
+                for _ in range(size - num_special))
+    rnd.shuffle(data)
+    return bytearray(data)
+
+
+def time_per_op(config: Config, op: Callable[[], None], ops_per_call: int = 1) -> float:
+    """Returns the best time in secs of a single op. op() performs ops_per_call ops."""
+    # Calibrate the number of calls per run.
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            op()
+        elapsed = time.perf_counter() - start
+        if elapsed >= config.min_run_time:
+            break
+        calls *= 2 if elapsed <= 0 else max(2, int(config.min_run_time / elapsed) + 1)
+    best = elapsed
+    for _ in range(config.repeats - 1):
+        start = time.perf_counter()
+        for _ in range(calls):
+            op()
+        best = min(best, time.perf_counter() - start)
+    return best / (calls * ops_per_call)
+
+
+def throughput(secs_per_op: float, bytes_per_op: int) -> Dict[str, float]:
+    return {
+        "packets_per_sec": 1 / secs_per_op,
+        "mb_per_sec": bytes_per_op / secs_per_op / 1e6,
+    }
+
+
+def bench_encoder(config: Config, results: Dict[str, Dict], selected: Callable[[str], bool]):
+    encoder = PacketEncoder()
+    for size in PAYLOAD_SIZES:
+        for density in ESCAPE_DENSITIES:
+            name = f"encode_message/{size}/{density:.0%}"
+            if not selected(name):
+                continue
+            data = make_data(size, density)
+            secs = time_per_op(config, lambda: encoder.encode_message_packet(20, data))
+            results[name] = throughput(secs, size)
+
+
+def bench_decoder(config: Config, results: Dict[str, Dict], selected: Callable[[str], bool]):
+    encoder = PacketEncoder()
+    decoder = PacketDecoder()
+    for size in PAYLOAD_SIZES:
+        for density in ESCAPE_DENSITIES:
+            data = make_data(size, density)
+            wire = bytes(encoder.encode_message_packet(20, data))
+            # A chunk of a few packets, as typically returned by a port read.
+            num_packets = max(1, 4096 // len(wire))
+            stream = wire * num_packets
+
+            name = f"decode_bytes/{size}/{density:.0%}"
+            if selected(name):
+                secs = time_per_op(config, lambda: decoder.receive_bytes(stream), num_packets)
+                results[name] = throughput(secs, size)
+
+            name = f"decode_byte/{size}/{density:.0%}"
+            if selected(name):
+
+                def receive_byte_loop():
+                    receive_byte = decoder.receive_byte
+                    for b in wire:
+                        receive_byte(b)
+
+                secs = time_per_op(config, receive_byte_loop)
+                results[name] = throughput(secs, size)
+
+
+def bench_packet_data(config: Config, results: Dict[str, Dict], selected: Callable[[str], bool]):
+
+    # 75 mixed ints, 175 bytes.
+    def write_ints() -> PacketData:
+        data = PacketData()
+        for i in range(25):
+            data.add_uint8(i).add_uint16(i).add_uint32(i)
+        return data
+
+    def read_ints(data: PacketData) -> None:
+        data.reset_read_location()
+        for _ in range(25):
+            data.read_uint8()
+            data.read_uint16()
+            data.read_uint32()
+
+    def write_struct() -> PacketData:
+        data = PacketData()
+        for i in range(25):
+            data.add_struct("BHI", i, i, i)
+        return data
+
+    def read_struct(data: PacketData) -> None:
+        data.reset_read_location()
+        for _ in range(25):
+            data.read_struct("BHI")
+
+    ints_data = write_ints()
+    for name, op in [("packet_data/write_ints", write_ints),
+                     ("packet_data/read_ints", lambda: read_ints(ints_data)),
+                     ("packet_data/write_struct", write_struct),
+                     ("packet_data/read_struct", lambda: read_struct(ints_data))]:
+        if selected(name):
+            results[name] = throughput(time_per_op(config, op), ints_data.size())
+
+    for size in PAYLOAD_SIZES[1:]:
+        bfr = make_data(size, 0.0)
+        name = f"packet_data/bytes/{size}"
+        if selected(name):
+            secs = time_per_op(config, lambda: PacketData().add_bytes(bfr).read_bytes(size))
+            results[name] = throughput(secs, size)
+
+        name = f"packet_data/array_u16/{size}"
+        if selected(name):
+            count = size // 2
+            vals = list(range(count))
+            secs = time_per_op(
+                config, lambda: PacketData().add_array("H", vals).read_array("H", count))
+            results[name] = throughput(secs, size)
+
+
+async def measure_rtt(config: Config, transport1, transport2) -> Dict[str, float]:
+    """Returns command round trip stats over a link between the two transports."""
+
+    async def echo(endpoint: int, data: PacketData):
+        return (PacketStatus.OK.value, data)
+
+    client = SerialPacketsClient(transport1)
+    server = SerialPacketsClient(transport2, command_async_callback=echo)
+    assert await client.connect()
+    assert await server.connect()
+    # Let the connections complete.
+    await asyncio.sleep(0.01)
+    data = PacketData().add_bytes(make_data(16, 0.1))
+    rtts: List[float] = []
+    start = time.perf_counter()
+    for _ in range(config.rtt_commands):
+        t0 = time.perf_counter()
+        status, _ = await client.send_command_blocking(20, data)
+        rtts.append(time.perf_counter() - t0)
+        assert status == PacketStatus.OK.value, status
+    elapsed = time.perf_counter() - start
+    for c in (client, server):
+        c._SerialPacketsClient__transport.close()
+    await asyncio.sleep(0.01)
+    # Ignore the warm up commands.
+    rtts = sorted(rtts[len(rtts) // 10:])
+    return {
+        "rtt_per_sec": config.rtt_commands / elapsed,
+        "p50_us": rtts[len(rtts) // 2] * 1e6,
+        "p90_us": rtts[int(len(rtts) * 0.9)] * 1e6,
+        "p99_us": rtts[int(len(rtts) * 0.99)] * 1e6,
+        "mean_us": statistics.mean(rtts) * 1e6,
+    }
+
+
+def bench_rtt(config: Config, results: Dict[str, Dict], selected: Callable[[str], bool]):
+    name = "rtt/loopback"
+    if selected(name):
+        results[name] = asyncio.run(measure_rtt(config, *LoopbackTransport.pair()))
+
+    name = "rtt/pty"
+    if selected(name) and hasattr(os, "openpty"):
+        import tty
+        master_fd, slave_fd = os.openpty()
+        try:
+            tty.setraw(master_fd)
+            tty.setraw(slave_fd)
+            results[name] = asyncio.run(
+                measure_rtt(config, FdTransport(master_fd), FdTransport(slave_fd)))
+        finally:
+            os.close(master_fd)
+            os.close(slave_fd)
+
+
+def format_metrics(metrics: Dict[str, float]) -> str:
+    return "  ".join(f"{k}={v:,.1f}" for k, v in metrics.items())
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], threshold: float) -> bool:
+    """Prints the changes vs the baseline. Returns True if any metric regressed."""
+    regressed = False
+    print(f"\n{'Benchmark':<32} {'Metric':<16} {'Baseline':>14} {'Current':>14} {'Change':>9}")
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            base_value = baseline.get(name, {}).get(metric)
+            if not base_value:
+                continue
+            change = value / base_value - 1
+            lower_is_better = metric.endswith(LOWER_IS_BETTER)
+            is_regression = (change > threshold) if lower_is_better else (change < -threshold)
+            regressed = regressed or is_regression
+            flag = "  REGRESSION" if is_regression else ""
+            print(f"{name:<32} {metric:<16} {base_value:>14,.1f} {value:>14,.1f} "
+                  f"{change:>+9.1%}{flag}")
+    return regressed
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Serial packets benchmarks.")
+    parser.add_argument("-o", "--output", help="Save the results to this json file.")
+    parser.add_argument("-b", "--baseline", help="Compare with results saved with --output.")
+    parser.add_argument("-t",
+                        "--threshold",
+                        type=float,
+                        default=0.1,
+                        help="Relative change that is reported as a regression. Default 0.1.")
+    parser.add_argument("-k",
+                        "--filter",
+                        default="",
+                        help="Run only benchmarks whose name contains this string.")
+    parser.add_argument("--quick", action="store_true", help="Shorter and less accurate runs.")
+    args = parser.parse_args()
+
+    config = Config(args.quick)
+    selected = lambda name: args.filter in name
+    results: Dict[str, Dict] = {}
+    for bench in [bench_encoder, bench_decoder, bench_packet_data, bench_rtt]:
+        bench(config, results, selected)
+
+    for name, metrics in results.items():
+        print(f"{name:<32} {format_metrics(metrics)}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "python": sys.version,
+                    "platform": platform.platform(),
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "quick": args.quick,
+                    "results": results,
+                },
+                f,
+                indent=2)
+        print(f"\nSaved results to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
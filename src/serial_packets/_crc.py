@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+# CRC-CCITT (polynomial 0x1021, initial value 0xffff, no reflection and
+# no final xor) that is used to verify the packets.
+
+CRC_INIT = 0xFFFF
+
+
+def _make_table():
+    """Returns a 256 entries table for a byte at a time computation."""
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if (crc & 0x8000) else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return tuple(table)
+
+
+_CRC_TABLE = _make_table()
+
+
+def _update_table(buf, crc: int = CRC_INIT) -> int:
+    """Table driven, pure Python implementation of update()."""
+    table = _CRC_TABLE
+    for b in buf:
+        crc = ((crc << 8) & 0xFF00) ^ table[(crc >> 8) ^ b]
+    return crc
+
+
+try:
+    # binascii.crc_hqx() computes the same CRC in C.
+    from binascii import crc_hqx as _update_fast
+except ImportError:
+    _update_fast = None
+
+
+def update(buf, crc: int = CRC_INIT) -> int:
+    """Updates a crc with the bytes of buf and returns the new crc. buf can be
+    any bytes like object, including a memoryview, and is not copied."""
+    if _update_fast:
+        return _update_fast(buf, crc)
+    return _update_table(buf, crc)
+
+
+def crc16(buf) -> int:
+    """Returns the CRC of the bytes in buf."""
+    return update(buf, CRC_INIT)
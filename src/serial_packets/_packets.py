@@ -20,6 +20,10 @@ MAX_PACKET_OVERHEAD = 8
 MIN_PACKET_LEN = MIN_PACKET_OVERHEAD
 MAX_PACKET_LEN = MAX_PACKET_OVERHEAD + MAX_DATA_LEN
 
+# Max packet size in bytes on the wire, after byte stuffing and
+# flagging. This is the worst case where all bytes are escaped.
+MAX_ENCODED_PACKET_LEN = 2 * MAX_PACKET_LEN + 2
+
 # Range of command timeout values.
 MIN_CMD_TIMEOUT = 0.1
 MAX_CMD_TIMEOUT = 10.0
@@ -30,6 +34,9 @@ MIN_WORKERS_COUNT = 1
 MAX_WORKERS_COUNT = 30
 DEFAULT_WORKERS_COUNT = 3
 
+# Reserved endpoint of the messages that carry bulk transfers.
+BULK_ENDPOINT = 200
+
 # Do not change the numeric tags since the will change
 # the wire representation.
 class PacketType(Enum):
@@ -0,0 +1,481 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import logging
+import math
+import random
+import struct
+
+from typing import AsyncIterable, AsyncIterator, Callable, Deque, Dict, Optional, Tuple
+from .packets import PacketStatus, MAX_DATA_LEN
+
+logger = logging.getLogger(__name__)
+
+# Bulk transfers stream data that is larger than MAX_DATA_LEN as a sequence of
+# chunks. The chunks and their acks are sent as messages to the reserved
+# BULK_ENDPOINT, with one of these frames as the message data. All values are
+# big endian.
+#
+# DATA:  kind (B), transfer id (I), seq (I), user endpoint (B), flags (B),
+#        timeout (H), payload.
+# ACK:   kind (B), transfer id (I), cumulative seq (I), acked seq (I), window (H).
+# ABORT: kind (B), transfer id (I), status (B).
+#
+# The cumulative seq of an ACK is the first seq that was not received yet, and the
+# acked seq is of the DATA frame that triggered the ack, or _NO_SEQ. The window
+# is the number of chunks, starting at the cumulative seq, that the receiver can
+# accept. Chunks are retransmitted selectively, when their ack doesn't arrive in
+# time or when a chunk that was sent after them is acked. The timeout of a DATA
+# frame is the sender's timeout, in _TIMEOUT_UNIT secs, and the receiver aborts
+# the transfer when no DATA frame arrives for that long.
+_DATA = 1
+_ACK = 2
+_ABORT = 3
+
+_DATA_HEADER = struct.Struct(">BIIBBH")
+_ACK_FRAME = struct.Struct(">BIIIH")
+_ABORT_FRAME = struct.Struct(">BIB")
+
+# Flags of DATA frames.
+_FLAG_LAST = 0x01
+
+_NO_SEQ = 0xFFFFFFFF
+
+# Resolution in secs of the timeout in DATA frames.
+_TIMEOUT_UNIT = 0.01
+
+# Max payload bytes per chunk.
+MAX_BULK_CHUNK_LEN = MAX_DATA_LEN - _DATA_HEADER.size
+
+# Default max number of chunks that the sender sends before they are acked.
+DEFAULT_BULK_WINDOW = 16
+# Default time in secs with no progress after which a transfer is aborted.
+DEFAULT_BULK_TIMEOUT = 5.0
+
+# Max number of received chunks that are buffered per transfer, waiting for
+# the receiver to consume them.
+_RECEIVE_WINDOW = 32
+# Max number of incoming transfers per endpoint that wait for receive_bulk().
+_MAX_PENDING_TRANSFERS = 4
+# Number of completed incoming transfers that are remembered, for acking
+# retransmitted chunks whose ack was lost.
+_MAX_DONE_TRANSFERS = 16
+
+# Retransmission timeout in secs, before the round trip time is measured, and
+# its range.
+_INITIAL_RTO = 1.0
+_MIN_RTO = 0.2
+_MAX_RTO = 4.0
+
+
+async def _split(source: AsyncIterable[bytes], size: int) -> AsyncIterator[bytes]:
+    """Yields the bytes of source in chunks of the given size. The last chunk may
+    be shorter."""
+    pending = bytearray()
+    async for block in source:
+        with memoryview(block) as view:
+            i = 0
+            if pending:
+                i = min(size - len(pending), len(view))
+                pending += view[:i]
+                if len(pending) < size:
+                    continue
+                yield bytes(pending)
+                pending.clear()
+            while len(view) - i >= size:
+                yield bytes(view[i:i + size])
+                i += size
+            pending += view[i:]
+    if pending:
+        yield bytes(pending)
+
+
+async def _once(data: bytes | bytearray | memoryview) -> AsyncIterator[bytes | bytearray | memoryview]:
+    yield data
+
+
+async def _chunks(data: bytes | bytearray | memoryview | AsyncIterable[bytes],
+                  size: int) -> AsyncIterator[Tuple[bytes, bool]]:
+    """Yields (chunk, is_last) tuples of the data. Empty data has a single empty chunk."""
+    source = _once(data) if isinstance(data, (bytes, bytearray, memoryview)) else data
+    previous = None
+    async for chunk in _split(source, size):
+        if previous is not None:
+            yield (previous, False)
+        previous = chunk
+    yield (previous if previous is not None else b"", True)
+
+
+class _SentChunk:
+    __slots__ = ("frame", "send_time", "transmissions")
+
+    def __init__(self, frame: bytes, send_time: float):
+        self.frame = frame
+        self.send_time = send_time
+        self.transmissions = 1
+
+
+class _BulkSender:
+    """The sending side of an outgoing bulk transfer."""
+
+    def __init__(self, send_frame: Callable[[bytes], None], transfer_id: int, endpoint: int,
+                 window: int, timeout: float):
+        self.__send_frame = send_frame
+        self.__transfer_id = transfer_id
+        self.__endpoint = endpoint
+        self.__window = window
+        self.__timeout = timeout
+        self.__wire_timeout = min(max(math.ceil(timeout / _TIMEOUT_UNIT), 1), 0xFFFF)
+        # Chunks that were sent and not acked yet, keyed by seq, in seq order.
+        self.__unacked: Dict[int, _SentChunk] = {}
+        # All the chunks before this seq were acked.
+        self.__cum = 0
+        # Receiver's window, as of the last ack.
+        self.__receive_window = window
+        self.__status: Optional[int] = None
+        self.__progress = asyncio.Event()
+        self.__last_progress_time = 0.0
+        self.__srtt: Optional[float] = None
+        self.__rttvar = 0.0
+        # Retransmission timeout, before and after the exponential backoff.
+        self.__base_rto = _INITIAL_RTO
+        self.__rto = _INITIAL_RTO
+
+    async def run(self, data: bytes | bytearray | memoryview | AsyncIterable[bytes]) -> int:
+        """Sends the data and waits for it to be acked. Returns the transfer status."""
+        loop = asyncio.get_running_loop()
+        self.__last_progress_time = loop.time()
+        chunks = _chunks(data, MAX_BULK_CHUNK_LEN)
+        next_seq = 0
+        eof = False
+        while True:
+            while (not eof and self.__status is None and
+                   next_seq < self.__cum + min(self.__window, self.__receive_window)):
+                payload, eof = await chunks.__anext__()
+                flags = _FLAG_LAST if eof else 0
+                frame = _DATA_HEADER.pack(_DATA, self.__transfer_id, next_seq, self.__endpoint,
+                                          flags, self.__wire_timeout) + payload
+                self.__unacked[next_seq] = _SentChunk(frame, loop.time())
+                self.__send_frame(frame)
+                next_seq += 1
+            if self.__status is not None:
+                return self.__status
+            if eof and not self.__unacked:
+                return PacketStatus.OK.value
+            self.__progress.clear()
+            try:
+                await asyncio.wait_for(self.__progress.wait(), self.__rto)
+                continue
+            except asyncio.TimeoutError:
+                pass
+            now = loop.time()
+            if now - self.__last_progress_time >= self.__timeout:
+                logger.error("Bulk transfer [%08x] timeout", self.__transfer_id)
+                self.__send_frame(
+                    _ABORT_FRAME.pack(_ABORT, self.__transfer_id, PacketStatus.TIMEOUT.value))
+                return PacketStatus.TIMEOUT.value
+            rto = self.__rto
+            self.__rto = min(2 * rto, _MAX_RTO)
+            for chunk in self.__unacked.values():
+                if now - chunk.send_time >= rto:
+                    self.__resend(chunk, now)
+            # Probe a closed receiver window with the next chunk.
+            if not self.__unacked and self.__receive_window == 0:
+                self.__receive_window = 1
+
+    def __resend(self, chunk: _SentChunk, now: float) -> None:
+        chunk.send_time = now
+        chunk.transmissions += 1
+        self.__send_frame(chunk.frame)
+
+    def on_ack(self, cum: int, seq: int, receive_window: int, now: float) -> None:
+        unacked = self.__unacked
+        progress = receive_window > self.__receive_window
+        self.__receive_window = receive_window
+        if cum > self.__cum:
+            for s in range(self.__cum, cum):
+                chunk = unacked.pop(s, None)
+                if chunk and chunk.transmissions == 1:
+                    self.__on_rtt(now - chunk.send_time)
+            self.__cum = cum
+            progress = True
+        chunk = unacked.pop(seq, None) if seq != _NO_SEQ else None
+        if chunk:
+            progress = True
+            # Per Karn's algorithm, the round trip of retransmitted chunks is ambiguous.
+            if chunk.transmissions == 1:
+                self.__on_rtt(now - chunk.send_time)
+            # The link preserves order, so earlier chunks that were sent before the
+            # acked one were lost.
+            for s, earlier_chunk in unacked.items():
+                if s >= seq:
+                    break
+                if earlier_chunk.send_time < chunk.send_time:
+                    self.__resend(earlier_chunk, now)
+        if progress:
+            self.__rto = self.__base_rto
+            self.__last_progress_time = now
+            self.__progress.set()
+
+    def on_abort(self, status: int) -> None:
+        logger.error("Bulk transfer [%08x] aborted by the receiver, status %d", self.__transfer_id,
+                     status)
+        self.__status = status
+        self.__progress.set()
+
+    def __on_rtt(self, rtt: float) -> None:
+        if self.__srtt is None:
+            self.__srtt = rtt
+            self.__rttvar = rtt / 2
+        else:
+            self.__rttvar = 0.75 * self.__rttvar + 0.25 * abs(self.__srtt - rtt)
+            self.__srtt = 0.875 * self.__srtt + 0.125 * rtt
+        self.__base_rto = min(max(self.__srtt + 4 * self.__rttvar, _MIN_RTO), _MAX_RTO)
+        self.__rto = self.__base_rto
+
+
+class BulkTransfer:
+    """An incoming bulk transfer, as returned by SerialPacketsClient.receive_bulk().
+
+    Iterate it with 'async for' to get the data chunks, in order, as they arrive.
+    At most a window of chunks is buffered, and the sender waits while the
+    receiver doesn't consume them. Once the iteration ends, status() tells if
+    the transfer completed, since it also ends if the transfer was aborted.
+    """
+
+    def __init__(self, channel: _BulkChannel, transfer_id: int, endpoint: int, timeout: float):
+        self.__channel = channel
+        self.__transfer_id = transfer_id
+        self.__endpoint = endpoint
+        # The transfer is aborted when no DATA frame arrives for the sender's timeout.
+        self.__timeout = timeout
+        loop = asyncio.get_running_loop()
+        self.__last_data_time = loop.time()
+        self.__expire_timer: Optional[asyncio.TimerHandle] = loop.call_later(
+            timeout, self.__on_expire_timer)
+        # Received chunks that were not consumed yet, keyed by seq.
+        self.__chunks: Dict[int, bytes] = {}
+        # Seq of the next chunk to consume.
+        self.__next_seq = 0
+        # All the chunks before this seq were received.
+        self.__cum = 0
+        self.__last_seq: Optional[int] = None
+        self.__status: Optional[int] = None
+        self.__received = asyncio.Event()
+        self.__window_closed = False
+
+    def __str__(self) -> str:
+        return f"bulk transfer {self.__transfer_id:08x} to endpoint {self.__endpoint}"
+
+    def endpoint(self) -> int:
+        """Returns the endpoint that the transfer was sent to."""
+        return self.__endpoint
+
+    def status(self) -> Optional[int]:
+        """Returns PacketStatus.OK.value if all the chunks were consumed, an error
+        status if the transfer was aborted, or None if it's still in progress."""
+        return self.__status
+
+    def is_received(self) -> bool:
+        """Tests if all the chunks were received."""
+        return self.__last_seq is not None and self.__cum > self.__last_seq
+
+    def __aiter__(self) -> BulkTransfer:
+        return self
+
+    async def __anext__(self) -> bytes:
+        while True:
+            chunk = self.__chunks.pop(self.__next_seq, None)
+            if chunk is not None:
+                self.__next_seq += 1
+                if self.__window_closed:
+                    # Let the sender know that the window reopened.
+                    self.__window_closed = False
+                    self.__send_ack(_NO_SEQ)
+                if chunk:
+                    return chunk
+                continue
+            if self.__status is None and self.is_received():
+                self.__status = PacketStatus.OK.value
+            if self.__status is not None:
+                raise StopAsyncIteration
+            # Ends by the expiry timer if the sender goes quiet.
+            self.__received.clear()
+            await self.__received.wait()
+
+    async def read_all(self) -> Tuple[int, bytes]:
+        """Consumes the entire transfer. Returns its status and data."""
+        data = bytearray()
+        async for chunk in self:
+            data += chunk
+        return (self.__status, bytes(data))
+
+    def abort(self, status: int = PacketStatus.GENERAL_ERROR.value) -> None:
+        """Aborts the transfer and notifies the sender."""
+        if self.__status is not None:
+            return
+        self._on_abort(status)
+        self.__channel._send_abort(self.__transfer_id, status)
+
+    def _on_abort(self, status: int) -> None:
+        """Package private. Called when the transfer was aborted."""
+        self.__status = status
+        self.__chunks.clear()
+        self.__received.set()
+        self.__cancel_expire_timer()
+        self.__channel._on_receive_done(self.__transfer_id, self.__cum, status)
+
+    def _on_data(self, seq: int, flags: int, payload: bytes, now: float) -> None:
+        """Package private. Called with an incoming DATA frame."""
+        self.__last_data_time = now
+        if seq >= self.__next_seq + _RECEIVE_WINDOW:
+            # No room, the sender will retransmit it.
+            self.__send_ack(_NO_SEQ)
+            return
+        if seq >= self.__cum and seq not in self.__chunks:
+            self.__chunks[seq] = payload
+            if flags & _FLAG_LAST:
+                self.__last_seq = seq
+            while self.__cum in self.__chunks:
+                self.__cum += 1
+            self.__received.set()
+        self.__send_ack(seq)
+        if self.is_received():
+            self.__cancel_expire_timer()
+            self.__channel._on_receive_done(self.__transfer_id, self.__cum, PacketStatus.OK.value)
+
+    def __on_expire_timer(self) -> None:
+        loop = asyncio.get_running_loop()
+        idle = loop.time() - self.__last_data_time
+        if idle < self.__timeout:
+            self.__expire_timer = loop.call_later(self.__timeout - idle, self.__on_expire_timer)
+            return
+        self.__expire_timer = None
+        logger.error("%s timeout", self)
+        self.abort(PacketStatus.TIMEOUT.value)
+
+    def __cancel_expire_timer(self) -> None:
+        if self.__expire_timer:
+            self.__expire_timer.cancel()
+            self.__expire_timer = None
+
+    def __send_ack(self, seq: int) -> None:
+        window = max(0, self.__next_seq + _RECEIVE_WINDOW - self.__cum)
+        if window == 0:
+            self.__window_closed = True
+        self.__channel._send_ack(self.__transfer_id, self.__cum, seq, window)
+
+
+class _BulkChannel:
+    """The bulk transfers of a client, in both directions."""
+
+    def __init__(self, send_frame: Callable[[bytes], None]):
+        """send_frame sends a frame as a message to BULK_ENDPOINT."""
+        self.__send_frame = send_frame
+        self.__next_transfer_id = random.getrandbits(32)
+        self.__senders: Dict[int, _BulkSender] = {}
+        self.__receivers: Dict[int, BulkTransfer] = {}
+        # Maps recently completed incoming transfers to their (cum, status).
+        self.__done_receivers: Dict[int, Tuple[int, int]] = collections.OrderedDict()
+        # Incoming transfers that were not returned by receive() yet, per endpoint.
+        self.__pending: Dict[int, Deque[BulkTransfer]] = {}
+        # Futures of receive() calls that wait for a transfer, per endpoint.
+        self.__waiters: Dict[int, Deque[asyncio.Future]] = {}
+
+    async def send(self, endpoint: int, data: bytes | bytearray | memoryview |
+                   AsyncIterable[bytes], window: int, timeout: float) -> int:
+        transfer_id = self.__next_transfer_id
+        self.__next_transfer_id = (transfer_id + 1) & 0xffffffff
+        sender = _BulkSender(self.__send_frame, transfer_id, endpoint, window, timeout)
+        self.__senders[transfer_id] = sender
+        try:
+            return await sender.run(data)
+        finally:
+            del self.__senders[transfer_id]
+
+    async def receive(self, endpoint: int) -> BulkTransfer:
+        pending = self.__pending.get(endpoint)
+        if pending:
+            return pending.popleft()
+        future = asyncio.get_running_loop().create_future()
+        self.__waiters.setdefault(endpoint, collections.deque()).append(future)
+        return await future
+
+    def on_frame(self, frame: bytes | bytearray, now: float) -> None:
+        """Handles an incoming frame."""
+        kind = frame[0] if frame else None
+        if kind == _DATA and len(frame) >= _DATA_HEADER.size:
+            _, transfer_id, seq, endpoint, flags, timeout = _DATA_HEADER.unpack_from(frame)
+            self.__on_data(transfer_id, seq, endpoint, flags, timeout * _TIMEOUT_UNIT,
+                           bytes(frame[_DATA_HEADER.size:]), now)
+        elif kind == _ACK and len(frame) == _ACK_FRAME.size:
+            _, transfer_id, cum, seq, window = _ACK_FRAME.unpack(frame)
+            sender = self.__senders.get(transfer_id)
+            if sender:
+                sender.on_ack(cum, seq, window, now)
+        elif kind == _ABORT and len(frame) == _ABORT_FRAME.size:
+            _, transfer_id, status = _ABORT_FRAME.unpack(frame)
+            sender = self.__senders.get(transfer_id)
+            if sender:
+                sender.on_abort(status)
+            receiver = self.__receivers.get(transfer_id)
+            if receiver:
+                logger.error("%s aborted by the sender, status %d", receiver, status)
+                receiver._on_abort(status)
+        else:
+            logger.error("Invalid bulk frame (%d bytes), dropping", len(frame))
+
+    def __on_data(self, transfer_id: int, seq: int, endpoint: int, flags: int, timeout: float,
+                  payload: bytes, now: float) -> None:
+        receiver = self.__receivers.get(transfer_id)
+        if receiver:
+            receiver._on_data(seq, flags, payload, now)
+            return
+        done = self.__done_receivers.get(transfer_id)
+        if done:
+            # A retransmission of a chunk whose ack was lost.
+            cum, status = done
+            if status == PacketStatus.OK.value:
+                self._send_ack(transfer_id, cum, seq, _RECEIVE_WINDOW)
+            else:
+                self._send_abort(transfer_id, status)
+            return
+        # A new transfer.
+        waiters = self.__waiters.get(endpoint)
+        while waiters and waiters[0].done():
+            waiters.popleft()
+        pending = self.__pending.setdefault(endpoint, collections.deque())
+        if not waiters and len(pending) >= _MAX_PENDING_TRANSFERS:
+            logger.error("Too many pending bulk transfers to endpoint %d, aborting", endpoint)
+            self._send_abort(transfer_id, PacketStatus.UNHANDLED.value)
+            return
+        receiver = BulkTransfer(self, transfer_id, endpoint, timeout)
+        self.__receivers[transfer_id] = receiver
+        if waiters:
+            waiters.popleft().set_result(receiver)
+        else:
+            pending.append(receiver)
+        receiver._on_data(seq, flags, payload, now)
+
+    def _on_receive_done(self, transfer_id: int, cum: int, status: int) -> None:
+        """Package private. Called when an incoming transfer was received or aborted."""
+        receiver = self.__receivers.pop(transfer_id, None)
+        if receiver is None:
+            return
+        # Aborted transfers that were not returned by receive() yet are dropped.
+        if status != PacketStatus.OK.value:
+            pending = self.__pending.get(receiver.endpoint())
+            if pending and receiver in pending:
+                pending.remove(receiver)
+        self.__done_receivers[transfer_id] = (cum, status)
+        if len(self.__done_receivers) > _MAX_DONE_TRANSFERS:
+            self.__done_receivers.popitem(last=False)
+
+    def _send_ack(self, transfer_id: int, cum: int, seq: int, window: int) -> None:
+        """Package private."""
+        self.__send_frame(_ACK_FRAME.pack(_ACK, transfer_id, cum, seq, window))
+
+    def _send_abort(self, transfer_id: int, status: int) -> None:
+        """Package private."""
+        self.__send_frame(_ABORT_FRAME.pack(_ABORT, transfer_id, status))
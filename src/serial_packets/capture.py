@@ -0,0 +1,276 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import logging
+import mmap
+import struct
+import time
+
+from typing import Iterator, Optional, Tuple
+from .packet_decoder import PacketDecoder
+from .transports import PacketsTransport, ProtocolFactory
+
+logger = logging.getLogger(__name__)
+
+# Capture files start with a header, followed by a record per captured chunk. All
+# values are big endian.
+#
+# Header: magic (5s), version (B), start time in secs since epoch (d).
+# Record: direction (B), usecs since the start time (Q), chunk length (I), chunk bytes.
+_MAGIC = b"SPCAP"
+_VERSION = 1
+_HEADER = struct.Struct(">5sBd")
+_RECORD_HEADER = struct.Struct(">BQI")
+
+# Directions of captured chunks.
+CAPTURE_RX = 1
+CAPTURE_TX = 2
+
+# Buffered records are written to the file once they reach this size in bytes,
+# or after this time in secs.
+_FLUSH_SIZE = 64 * 1024
+_FLUSH_INTERVAL = 1.0
+
+
+class CaptureRecorder:
+    """Records the raw bytes that a client receives and sends, with their timestamps,
+    into a capture file. Pass it to SerialPacketsClient(recorder=...).
+
+    Records are buffered in memory and written in batches by a background thread,
+    so the event loop doesn't block on file I/O. Call close() when done.
+    """
+
+    def __init__(self, path: str):
+        """Creates the capture file. Raises FileExistsError if the file exists, so
+        earlier captures are never overwritten."""
+        self.__file = open(path, "xb")
+        self.__start_time_ns = time.monotonic_ns()
+        self.__file.write(_HEADER.pack(_MAGIC, _VERSION, time.time()))
+        self.__pending = bytearray()
+        self.__flush_timer: Optional[asyncio.TimerHandle] = None
+        # A single thread, so batches are written in order.
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                                thread_name_prefix="capture")
+        self.__closed = False
+
+    def __enter__(self) -> CaptureRecorder:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def record_rx(self, data: bytes | bytearray) -> None:
+        """Records a chunk of received bytes."""
+        self.__record(CAPTURE_RX, data)
+
+    def record_tx(self, data: bytes | bytearray) -> None:
+        """Records a chunk of sent bytes."""
+        self.__record(CAPTURE_TX, data)
+
+    def __record(self, direction: int, data: bytes | bytearray) -> None:
+        if self.__closed:
+            return
+        usecs = (time.monotonic_ns() - self.__start_time_ns) // 1000
+        self.__pending += _RECORD_HEADER.pack(direction, usecs, len(data))
+        self.__pending += data
+        if len(self.__pending) >= _FLUSH_SIZE:
+            self.flush()
+        elif not self.__flush_timer:
+            self.__flush_timer = asyncio.get_running_loop().call_later(
+                _FLUSH_INTERVAL, self.flush)
+
+    def flush(self) -> None:
+        """Passes the buffered records to the writer thread."""
+        if self.__flush_timer:
+            self.__flush_timer.cancel()
+            self.__flush_timer = None
+        if self.__pending and not self.__closed:
+            self.__executor.submit(self.__file.write, bytes(self.__pending))
+            self.__pending.clear()
+
+    def close(self) -> None:
+        """Writes the buffered records and closes the file. Blocks until done."""
+        if self.__closed:
+            return
+        self.flush()
+        self.__closed = True
+        self.__executor.shutdown(wait=True)
+        self.__file.close()
+
+
+class CaptureReader:
+    """Reads the records of a capture file. The file is memory mapped, so large
+    captures are read without loading them into memory."""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.__mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.__mmap) < _HEADER.size:
+            raise ValueError(f"Not a capture file: {path}")
+        magic, version, self.__start_time = _HEADER.unpack_from(self.__mmap)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError(f"Not a capture file or unsupported version: {path}")
+
+    def __enter__(self) -> CaptureReader:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def start_time(self) -> float:
+        """Returns the capture start time, in secs since epoch."""
+        return self.__start_time
+
+    def size(self) -> int:
+        """Returns the size of the capture file in bytes."""
+        return len(self.__mmap)
+
+    def records(self) -> Iterator[Tuple[int, float, bytes]]:
+        """Yields the (direction, secs since start, chunk bytes) of the records, in
+        order. A truncated last record, e.g. of a crashed recording, is ignored."""
+        m = self.__mmap
+        n = len(m)
+        i = _HEADER.size
+        record_header = _RECORD_HEADER
+        while i + record_header.size <= n:
+            direction, usecs, size = record_header.unpack_from(m, i)
+            i += record_header.size
+            if i + size > n:
+                logger.error("Truncated capture record at offset %d, ignoring", i)
+                return
+            yield (direction, usecs / 1e6, m[i:i + size])
+            i += size
+
+    def close(self) -> None:
+        self.__mmap.close()
+
+
+def decode_capture(path: str, direction: int = CAPTURE_RX) -> Iterator[Tuple[float, object]]:
+    """Decodes the chunks of the given direction of a capture file, as fast as
+    possible. Yields (secs since start, decoded packet) tuples, where the time is
+    of the chunk that completed the packet."""
+    decoder = PacketDecoder()
+    with CaptureReader(path) as reader:
+        for chunk_direction, t, chunk in reader.records():
+            if chunk_direction == direction:
+                for packet in decoder.receive_bytes(chunk):
+                    yield (t, packet)
+
+
+class _ReplayAsyncioTransport(asyncio.Transport):
+    """The asyncio transport of a replayed capture. Written data is discarded."""
+
+    def __init__(self, protocol: asyncio.Protocol):
+        super().__init__()
+        self.__protocol = protocol
+        self.__reading = asyncio.Event()
+        self.__reading.set()
+        self.__closing = False
+
+    async def wait_reading(self) -> None:
+        await self.__reading.wait()
+
+    def write(self, data) -> None:
+        pass
+
+    def pause_reading(self) -> None:
+        self.__reading.clear()
+
+    def resume_reading(self) -> None:
+        self.__reading.set()
+
+    def is_reading(self) -> bool:
+        return self.__reading.is_set()
+
+    def get_write_buffer_size(self) -> int:
+        return 0
+
+    def is_closing(self) -> bool:
+        return self.__closing
+
+    def close(self) -> None:
+        if self.__closing:
+            return
+        self.__closing = True
+        # Unblock the replay task.
+        self.__reading.set()
+        asyncio.get_running_loop().call_soon(self.__protocol.connection_lost, None)
+
+
+class ReplayTransport(PacketsTransport):
+    """Replays the received bytes of a capture file to a client, as if they were
+    received from a port. Data that the client sends is discarded. The connection
+    is closed at the end of the capture. Since the recorded commands are not sent
+    again, the client drops the recorded responses quietly.
+
+    With realtime=False the capture is replayed as fast as possible, which is also
+    a realistic benchmark of the client's decoding and dispatching."""
+
+    def __init__(self, path: str, realtime: bool = True, speed: float = 1.0):
+        """
+        Args:
+        * path: The capture file, as created by CaptureRecorder.
+        * realtime: An optional bool that specifies if the chunks should be replayed
+          at their original timing. Default is True.
+        * speed: An optional float with a speed up factor of the realtime replay.
+          Default is 1.0.
+        """
+        assert (speed > 0)
+        self.__path = path
+        self.__realtime = realtime
+        self.__speed = speed
+        self.__finished: Optional[asyncio.Future] = None
+        # Per https://stackoverflow.com/questions/71304329
+        self.__task: Optional[asyncio.Task] = None
+
+    def __str__(self) -> str:
+        return f"replay:{self.__path}"
+
+    def is_replay(self) -> bool:
+        return True
+
+    async def connect(self, protocol_factory: ProtocolFactory):
+        # Fail early on an invalid file.
+        CaptureReader(self.__path).close()
+        loop = asyncio.get_running_loop()
+        protocol = protocol_factory()
+        transport = _ReplayAsyncioTransport(protocol)
+        self.__finished = loop.create_future()
+        loop.call_soon(protocol.connection_made, transport)
+        self.__task = asyncio.create_task(self.__replay(transport, protocol))
+        return (transport, protocol)
+
+    async def wait_finished(self) -> Tuple[int, float]:
+        """Waits for the replay to complete. Returns the number of replayed bytes
+        and the elapsed time in secs."""
+        return await self.__finished
+
+    async def __replay(self, transport: _ReplayAsyncioTransport, protocol: asyncio.Protocol):
+        loop = asyncio.get_running_loop()
+        # Let connection_made() be called first.
+        await asyncio.sleep(0)
+        start_time = loop.time()
+        num_bytes = 0
+        try:
+            with CaptureReader(self.__path) as reader:
+                for direction, t, chunk in reader.records():
+                    if direction != CAPTURE_RX:
+                        continue
+                    if self.__realtime:
+                        delay = start_time + t / self.__speed - loop.time()
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    else:
+                        # Let the client's tasks run.
+                        await asyncio.sleep(0)
+                    if not transport.is_reading():
+                        await transport.wait_reading()
+                    if transport.is_closing():
+                        break
+                    protocol.data_received(chunk)
+                    num_bytes += len(chunk)
+        finally:
+            elapsed = loop.time() - start_time
+            transport.close()
+            self.__finished.set_result((num_bytes, elapsed))
@@ -1,43 +1,465 @@
 from __future__ import annotations
 
 import asyncio
-import serial_asyncio
+import collections
+import functools
+import inspect
 import logging
+import math
 import time
 import traceback
 
 from enum import Enum
-from typing import Optional, Tuple, Dict, Callable
+from typing import Optional, Tuple, Dict, Callable, List, Deque, AsyncIterable, TYPE_CHECKING
 from asyncio.transports import BaseTransport
 from .packet_encoder import PacketEncoder
 from .packet_decoder import PacketDecoder, DecodedCommandPacket, DecodedResponsePacket, DecodedMessagePacket
-from ._packets import PacketType, MAX_DATA_LEN, MIN_CMD_TIMEOUT, MAX_CMD_TIMEOUT, DEFAULT_CMD_TIMEOUT, MIN_WORKERS_COUNT, MAX_WORKERS_COUNT, DEFAULT_WORKERS_COUNT
-from .packets import PacketStatus, PacketsEvent, PacketsEventType, PacketsEvent, PacketData, MAX_USER_ENDPOINT
+from ._packets import PacketType, MAX_DATA_LEN, MAX_ENCODED_PACKET_LEN, MAX_PACKET_OVERHEAD, MIN_CMD_TIMEOUT, MAX_CMD_TIMEOUT, DEFAULT_CMD_TIMEOUT, MIN_WORKERS_COUNT, MAX_WORKERS_COUNT, DEFAULT_WORKERS_COUNT, BULK_ENDPOINT
+from .packets import PacketStatus, PacketsEvent, PacketsEventType, PacketsEvent, PacketData, MAX_USER_ENDPOINT, QueueOverflowPolicy, RetryPolicy
+from .transports import PacketsTransport, SerialPortTransport
+from .stats import PacketsStats, _StatsCollector
+from .capture import CaptureRecorder
+from .bulk import BulkTransfer, _BulkChannel, DEFAULT_BULK_WINDOW, DEFAULT_BULK_TIMEOUT
+
+if TYPE_CHECKING:
+    from .hub import SerialPacketsHub
 
 logger = logging.getLogger(__name__)
 
-# pyserial_asyncio is documented at
-# https://github.com/pyserial/pyserial-asyncio
+# Min interval in secs between consecutive PACKETS_DROPPED events.
+_DROPPED_PACKETS_REPORT_INTERVAL = 1.0
+
+# Commands window of the adaptive mode. The window is sized to the delivery rate
+# times the min round trip time, times the gain.
+_ADAPTIVE_INITIAL_WINDOW = 4
+_ADAPTIVE_MAX_WINDOW = 256
+_ADAPTIVE_GAIN = 1.25
+# Period in secs after which the min round trip time is re-measured.
+_ADAPTIVE_MIN_RTT_PERIOD = 10.0
+
+
+class _CommandRetry:
+    """The resend state of a command with a retry policy, shared by its attempts."""
+    __slots__ = ("policy", "endpoint", "data", "timeout", "future", "retries", "cmd_id", "cmd_ids",
+                 "handle")
+
+    def __init__(self, policy: RetryPolicy, endpoint: int, data: bytes, timeout: float,
+                 future: asyncio.Future):
+        self.policy = policy
+        self.endpoint = endpoint
+        self.data = data
+        self.timeout = timeout
+        self.future = future
+        # Number of resends so far.
+        self.retries = 0
+        # Command id of the attempt in flight, if any.
+        self.cmd_id: Optional[int] = None
+        # Command ids of the earlier attempts. Their late responses still
+        # resolve the command.
+        self.cmd_ids: List[int] = []
+        # Timer of the next resend, while waiting for it.
+        self.handle: Optional[asyncio.TimerHandle] = None
 
 
 class _TxCommandContext:
+    __slots__ = ("__cmd_id", "__endpoint", "__future", "__timeout_handle", "__start_time",
+                 "__retry")
 
-    def __init__(self, cmd_id: int, expiration_time: float, future: asyncio.Future):
-        """Constructs a command context."""
+    def __init__(self,
+                 cmd_id: int,
+                 endpoint: int,
+                 future: asyncio.Future,
+                 timeout_handle: asyncio.TimerHandle,
+                 start_time: float,
+                 retry: Optional[_CommandRetry] = None):
+        """Constructs a command context. Start time is in event loop time."""
         self.__cmd_id = cmd_id
+        self.__endpoint = endpoint
         self.__future = future
-        self.__expiration_time = expiration_time
+        self.__timeout_handle = timeout_handle
+        self.__start_time = start_time
+        self.__retry = retry
 
     def __str__(self):
-        return f"cmd_context {self.__cmd_id}, {self.__expiration_time - time.time()} sec left"
+        return f"cmd_context {self.__cmd_id}, expires at {self.__timeout_handle.when():.3f}"
+
+    def cmd_id(self) -> int:
+        return self.__cmd_id
+
+    def endpoint(self) -> int:
+        return self.__endpoint
+
+    def retry(self) -> Optional[_CommandRetry]:
+        return self.__retry
+
+    def start_time(self) -> float:
+        return self.__start_time
+
+    def cancel_timeout(self) -> None:
+        self.__timeout_handle.cancel()
 
     def set_command_result(self, status: int, data: PacketData):
-        """Transfer the command result to its future."""
-        self.__future.set_result((status, data))
+        """Transfer the command result to its future and cancel its timeout."""
+        self.__timeout_handle.cancel()
+        # The future may be cancelled by the user.
+        if not self.__future.done():
+            self.__future.set_result((status, data))
+
+
+class _BatchBuffer:
+    """A context manager for encoding a batch of packets into a single buffer."""
+
+    def __init__(self, items: List[Tuple[int, PacketData]]):
+        """Constructs a batch buffer for the given (endpoint, data) items."""
+        # Worst case size, where all bytes are escaped.
+        size = sum(2 * (data.size() + MAX_PACKET_OVERHEAD) + 2 for _, data in items)
+        self.packets = bytearray(size)
+        self.__view = None
+        self.__size = 0
+
+    def __enter__(self) -> _BatchBuffer:
+        self.__view = memoryview(self.packets)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.__view.release()
+        # On errors the packets are discarded, and views of the free space may
+        # still be referenced by the traceback.
+        if exc_type is None:
+            del self.packets[self.__size:]
+
+    def free_space(self) -> memoryview:
+        """Returns a view of the unused part of the buffer."""
+        return self.__view[self.__size:]
+
+    def add(self, n: int) -> None:
+        """Marks the next n bytes of the free space as used."""
+        self.__size += n
+
+
+class _WaitingCommand:
+    """An outgoing command that waits for a slot in the commands window."""
+    __slots__ = ("endpoint", "data", "timeout", "future", "retry")
+
+    def __init__(self,
+                 endpoint: int,
+                 data: bytes,
+                 timeout: float,
+                 future: asyncio.Future,
+                 retry: Optional[_CommandRetry] = None):
+        self.endpoint = endpoint
+        self.data = data
+        self.timeout = timeout
+        self.future = future
+        self.retry = retry
+
+
+class _CommandWindow:
+    """Limits the number of outgoing commands that wait for a response, per client
+    and per endpoint. Commands beyond the limits wait in per endpoint lanes and 
+    are sent, in a round robin order between the endpoints, as responses arrive.
+
+    In the adaptive mode, the client limit is adjusted to the delivery rate of
+    the commands times their min round trip time, which is the number of commands 
+    the link can carry without queueing, with some headroom. It is halved when 
+    commands time out.
+    """
+
+    def __init__(self, max_in_flight: int, max_endpoint_in_flight: int, adaptive: bool):
+        """Zero max values mean no limit."""
+        self.__max_endpoint_in_flight = max_endpoint_in_flight
+        self.__adaptive = adaptive
+        self.__max_window = (max_in_flight or _ADAPTIVE_MAX_WINDOW) if adaptive else max_in_flight
+        self.__window = min(_ADAPTIVE_INITIAL_WINDOW, self.__max_window) if adaptive else max_in_flight
+        self.__in_flight = 0
+        self.__endpoint_in_flight = [0] * (MAX_USER_ENDPOINT + 1)
+        # Maps endpoints to their waiting commands.
+        self.__lanes: Dict[int, Deque[_WaitingCommand]] = {}
+        # Endpoints with waiting commands that are below the endpoint limit, in
+        # sending order.
+        self.__ready_endpoints: Deque[int] = collections.deque()
+        self.__size = 0
+        # Adaptive mode state, in event loop time.
+        self.__min_rtt = math.inf
+        self.__min_rtt_time = 0.0
+        self.__srtt = 0.0
+        self.__interval_start: Optional[float] = None
+        self.__interval_completions = 0
+        self.__last_decrease_time = -math.inf
+
+    def window(self) -> int:
+        """Returns the current client limit, or 0 if there is no limit."""
+        return self.__window
+
+    def in_flight(self) -> int:
+        return self.__in_flight
+
+    def __len__(self) -> int:
+        """Returns the number of waiting commands."""
+        return self.__size
+
+    def __has_room(self, endpoint: int) -> bool:
+        return ((not self.__window or self.__in_flight < self.__window) and
+                (not self.__max_endpoint_in_flight or
+                 self.__endpoint_in_flight[endpoint] < self.__max_endpoint_in_flight))
+
+    def try_acquire(self, endpoint: int) -> bool:
+        """Takes a slot for a new command, if the command doesn't need to wait."""
+        if endpoint in self.__lanes or not self.__has_room(endpoint):
+            return False
+        self.__in_flight += 1
+        self.__endpoint_in_flight[endpoint] += 1
+        return True
+
+    def put(self, command: _WaitingCommand) -> None:
+        """Appends a command that should wait for a slot."""
+        endpoint = command.endpoint
+        lane = self.__lanes.get(endpoint)
+        if lane is None:
+            lane = collections.deque()
+            self.__lanes[endpoint] = lane
+            if (not self.__max_endpoint_in_flight or
+                    self.__endpoint_in_flight[endpoint] < self.__max_endpoint_in_flight):
+                self.__ready_endpoints.append(endpoint)
+        lane.append(command)
+        self.__size += 1
+
+    def pop_ready(self) -> Optional[_WaitingCommand]:
+        """Removes and returns the next waiting command that has a slot, and takes
+        the slot. Returns None if there is none."""
+        while self.__ready_endpoints and (not self.__window or
+                                          self.__in_flight < self.__window):
+            endpoint = self.__ready_endpoints.popleft()
+            lane = self.__lanes[endpoint]
+            command = lane.popleft()
+            self.__size -= 1
+            if not lane:
+                del self.__lanes[endpoint]
+            # The future may be cancelled by the user.
+            if command.future.done():
+                if lane:
+                    self.__ready_endpoints.appendleft(endpoint)
+                continue
+            self.__in_flight += 1
+            self.__endpoint_in_flight[endpoint] += 1
+            if lane and (not self.__max_endpoint_in_flight or
+                         self.__endpoint_in_flight[endpoint] < self.__max_endpoint_in_flight):
+                self.__ready_endpoints.append(endpoint)
+            return command
+        return None
+
+    def clear(self) -> List[_WaitingCommand]:
+        """Removes and returns all the waiting commands."""
+        result = [command for lane in self.__lanes.values() for command in lane]
+        self.__lanes.clear()
+        self.__ready_endpoints.clear()
+        self.__size = 0
+        return result
+
+    def release(self, endpoint: int, rtt: Optional[float], now: float) -> None:
+        """Releases the slot of a command that got a response after rtt secs, or
+        timed out if rtt is None."""
+        self.abandon(endpoint)
+        if self.__adaptive:
+            if rtt is None:
+                self.__on_timeout(now)
+            else:
+                self.__on_rtt(rtt, now)
+
+    def abandon(self, endpoint: int) -> None:
+        """Releases the slot of a command that is no longer waited for, with no
+        effect on the adaptive window."""
+        self.__in_flight -= 1
+        self.__endpoint_in_flight[endpoint] -= 1
+        if (self.__max_endpoint_in_flight and
+                self.__endpoint_in_flight[endpoint] == self.__max_endpoint_in_flight - 1 and
+                endpoint in self.__lanes):
+            self.__ready_endpoints.append(endpoint)
+
+    def __on_rtt(self, rtt: float, now: float) -> None:
+        # The min rtt is re-measured periodically, in case the link changed.
+        if rtt <= self.__min_rtt or now - self.__min_rtt_time > _ADAPTIVE_MIN_RTT_PERIOD:
+            self.__min_rtt = rtt
+            self.__min_rtt_time = now
+        self.__srtt = rtt if not self.__srtt else 0.875 * self.__srtt + 0.125 * rtt
+        if self.__interval_start is None:
+            self.__interval_start = now
+            self.__interval_completions = 0
+            return
+        self.__interval_completions += 1
+        elapsed = now - self.__interval_start
+        # Adjust once per round trip.
+        if elapsed < self.__srtt or elapsed <= 0:
+            return
+        rate = self.__interval_completions / elapsed
+        target = math.ceil(rate * self.__min_rtt * _ADAPTIVE_GAIN) + 1
+        self.__window = max(1, min(target, self.__max_window))
+        self.__interval_start = now
+        self.__interval_completions = 0
+
+    def __on_timeout(self, now: float) -> None:
+        # Decrease at most once per round trip, since commands that were sent
+        # together tend to time out together.
+        if now - self.__last_decrease_time < max(self.__srtt, MIN_CMD_TIMEOUT):
+            return
+        self.__last_decrease_time = now
+        self.__window = max(1, self.__window // 2)
+        self.__interval_start = None
+
+
+class _WorkQueue:
+    """The queue of work items that are served by the worker tasks. Similar to
+    asyncio.Queue but allows to remove and replace queued items.
+
+    Items are assigned to lanes. With ordered lanes, incoming packets are 
+    assigned to lanes by their endpoint and the items of a lane are served
+    one at a time, in order, while different lanes are served concurrently.
+    Otherwise, all items are in a single lane and are served concurrently.
+    """
+
+    def __init__(self, ordered_lanes: bool):
+        self.__ordered_lanes = ordered_lanes
+        # Optional callback that is called when an item becomes ready to be
+        # served. Used by the hub instead of waiting in get().
+        self.__on_ready: Optional[Callable[[], None]] = None
+        # Maps lane keys to lane items.
+        self.__lanes: Dict[object, Deque] = {}
+        # Maps lane keys to the number of packets in the lane.
+        self.__lanes_packets: Dict[object, int] = {}
+        # Keys of non empty lanes that are not being served, in serving order.
+        self.__ready_lanes: Deque = collections.deque()
+        # Keys of ordered lanes with an item that is being served.
+        self.__busy_lanes = set()
+        self.__waiters: Deque[asyncio.Future] = collections.deque()
+        self.__size = 0
+
+    def __len__(self) -> int:
+        return self.__size
+
+    def set_on_ready(self, on_ready: Optional[Callable[[], None]]) -> None:
+        """Sets a callback to call when an item becomes ready to be served."""
+        self.__on_ready = on_ready
 
-    def is_expired(self):
-        """Tests if the command timeout."""
-        return time.time() > self.__expiration_time
+    def has_ready(self) -> bool:
+        """Tests if there is an item that can be served now."""
+        return bool(self.__ready_lanes)
+
+    def lane_key(self, item) -> object:
+        """Returns the key of the lane of a work item."""
+        if not self.__ordered_lanes or not _is_queued_packet(item):
+            return None
+        # Log packets have no endpoint.
+        return getattr(item, "endpoint", None)
+
+    def lane_packets(self, lane_key: object) -> int:
+        """Returns the number of packets in a lane."""
+        return self.__lanes_packets.get(lane_key, 0)
+
+    def put_nowait(self, item) -> None:
+        """Appends an item to its lane."""
+        key = self.lane_key(item)
+        lane = self.__lanes.get(key)
+        if lane is None:
+            lane = collections.deque()
+            self.__lanes[key] = lane
+            self.__lanes_packets[key] = 0
+        lane.append(item)
+        self.__size += 1
+        if _is_queued_packet(item):
+            self.__lanes_packets[key] += 1
+        if len(lane) == 1 and key not in self.__busy_lanes:
+            self.__ready_lanes.append(key)
+            self.__wakeup_next()
+
+    def __wakeup_next(self) -> None:
+        if self.__on_ready:
+            self.__on_ready()
+        while self.__waiters:
+            waiter = self.__waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    async def get(self):
+        """Removes and returns the next item to serve, waiting if there is none.
+        The caller should call task_done() once the item was served."""
+        while not self.__ready_lanes:
+            waiter = asyncio.get_running_loop().create_future()
+            self.__waiters.append(waiter)
+            try:
+                await waiter
+            except:
+                waiter.cancel()
+                # Pass the wakeup, if any, to another getter.
+                if self.__ready_lanes and waiter.cancelled():
+                    self.__wakeup_next()
+                raise
+        return self.get_nowait()
+
+    def get_nowait(self):
+        """Same as get() but requires has_ready() to be True."""
+        key = self.__ready_lanes.popleft()
+        lane = self.__lanes[key]
+        item = lane.popleft()
+        self.__size -= 1
+        if _is_queued_packet(item):
+            self.__lanes_packets[key] -= 1
+        if self.__ordered_lanes:
+            self.__busy_lanes.add(key)
+        elif lane:
+            self.__ready_lanes.append(key)
+            self.__wakeup_next()
+        return item
+
+    def task_done(self, item) -> None:
+        """Indicates that an item that was returned by get() was served."""
+        if not self.__ordered_lanes:
+            return
+        key = self.lane_key(item)
+        self.__busy_lanes.discard(key)
+        if self.__lanes[key]:
+            self.__ready_lanes.append(key)
+            self.__wakeup_next()
+
+    def remove_first(self, lane_key: object, predicate: Callable[[object], bool]) -> bool:
+        """Removes the first packet of the lane that matches the predicate. Returns True 
+        if found."""
+        lane = self.__lanes.get(lane_key, ())
+        for i, item in enumerate(lane):
+            if predicate(item):
+                assert (_is_queued_packet(item))
+                del lane[i]
+                self.__size -= 1
+                self.__lanes_packets[lane_key] -= 1
+                if not lane and lane_key in self.__ready_lanes:
+                    self.__ready_lanes.remove(lane_key)
+                return True
+        return False
+
+    def replace_first(self, lane_key: object, predicate: Callable[[object], bool],
+                      new_item) -> bool:
+        """Replaces in place the first item of the lane that matches the predicate. 
+        Returns True if found."""
+        lane = self.__lanes.get(lane_key, ())
+        for i, item in enumerate(lane):
+            if predicate(item):
+                lane[i] = new_item
+                return True
+        return False
+
+
+def _is_queued_packet(item) -> bool:
+    """Tests if a work item is an incoming packet rather than an event."""
+    return not isinstance(item, PacketsEvent)
+
+
+def _is_async_callable(fn: Callable) -> bool:
+    """Tests if fn is an async function, a partial of one, or an object with an
+    async __call__."""
+    while isinstance(fn, functools.partial):
+        fn = fn.func
+    return inspect.iscoroutinefunction(fn) or inspect.iscoroutinefunction(
+        getattr(fn, "__call__", None))
 
 
 class _SerialProtocol(asyncio.Protocol):
@@ -47,14 +469,12 @@ class _SerialProtocol(asyncio.Protocol):
         self.__client: SerialPacketsClient = None
         self.__port: str = None
         self.__packet_decoder: PacketDecoder = None
-        self.__work_queue: asyncio.Queue = None
         self.__is_connected = False
 
-    def set(self, client: SerialPacketsClient, port: str, packet_decoder: PacketDecoder, work_queue: asyncio.Queue):
+    def set(self, client: SerialPacketsClient, port: str, packet_decoder: PacketDecoder):
         self.__client = client
         self.__port = port
         self.__packet_decoder = packet_decoder
-        self.__work_queue = work_queue
 
     def is_connected(self):
         return self.__is_connected
@@ -65,11 +485,20 @@ class _SerialProtocol(asyncio.Protocol):
             PacketsEvent(PacketsEventType.CONNECTED, f"Connected to {self.__port}"))
 
     def data_received(self, data: bytes):
-        for b in data:
-          decoded_packet =  self.__packet_decoder.receive_byte(b)
-          if decoded_packet:
-            logger.debug("Queuing incoming packet of type [%s.]", type(decoded_packet).__name__)
-            self.__work_queue.put_nowait(decoded_packet)
+        self.__client._on_received_bytes(data)
+        for decoded_packet in self.__packet_decoder.receive_bytes(data):
+            # Responses are resolved immediately, so their latency doesn't
+            # depend on the worker tasks.
+            if isinstance(decoded_packet, DecodedResponsePacket):
+                self.__client._handle_incoming_response_packet(decoded_packet)
+                continue
+            # Same for bulk transfer frames, which are flow controlled by their own acks.
+            if isinstance(decoded_packet,
+                          DecodedMessagePacket) and decoded_packet.endpoint == BULK_ENDPOINT:
+                self.__client._handle_incoming_bulk_packet(decoded_packet)
+                continue
+            if not self.__client._serve_packet_inline(decoded_packet):
+                self.__client._queue_incoming_packet(decoded_packet)
 
     def connection_lost(self, exc):
         self.__is_connected = False
@@ -77,30 +506,42 @@ class _SerialProtocol(asyncio.Protocol):
             PacketsEvent(PacketsEventType.DISCONNECTED, f"Disconnected from {self.__port}"))
 
     def pause_writing(self):
-        logger.warn("Serial [%s] paused.", self.__port)
+        logger.warning("Serial [%s] paused.", self.__port)
         # print('Writing paused', flush=True)
 
     def resume_writing(self):
-        logger.warn("Serial [%s] resumed.", self.__port)
+        logger.warning("Serial [%s] resumed.", self.__port)
 
 
 class SerialPacketsClient:
 
     def __init__(self,
-                 port: str,
+                 port: str | PacketsTransport,
                  command_async_callback: Optional(Callable[[int, PacketData],
                                                            Tuple(int, PacketData)]) = None,
                  message_async_callback: Optional(Callable[[int, PacketData], None]) = None,
                  event_async_callback: Optional(Callable[[PacketsEvent], None]) = None,
                  baudrate: int = 115200,
-                 workers: int = DEFAULT_WORKERS_COUNT):
+                 workers: int = DEFAULT_WORKERS_COUNT,
+                 coalesce_writes: bool = False,
+                 max_queue_size: int = 0,
+                 queue_overflow_policy: QueueOverflowPolicy = QueueOverflowPolicy.DROP_NEWEST,
+                 endpoint_lanes: bool = False,
+                 hub: Optional[SerialPacketsHub] = None,
+                 recorder: Optional[CaptureRecorder] = None,
+                 max_commands_in_flight: int = 0,
+                 max_endpoint_commands_in_flight: int = 0,
+                 adaptive_commands_window: bool = False,
+                 retry_policy: Optional[RetryPolicy] = None):
         """
         Constructs a serial messaging client. 
         
         The constructor doesn't actually open the port. To do that, call connect().
 
         Args:
-        * port: A string with dependent serial port to use. E.g. 'COM1'.
+        * port: A string with dependent serial port to use. E.g. 'COM1'. Can also be
+          a PacketsTransport from serial_packets.transports, e.g. for connecting
+          over TCP, in which case baudrate is ignored.
             
         * command_async_callback: An optional async callback function to be called on incoming
           command requests. Ignored if None. This is an async function that accepts 
@@ -117,39 +558,117 @@ class SerialPacketsClient:
           Ignored if None. This is an async function that accepts 
           a PacketEvent argument and returns no value.
                 
-        * baudrate: And optional int port baud rate to set. Default is 115200.
+        * baudrate: And optional int serial port baud rate to set. Default is 115200.
         
         * workers: An optional int that specifies how many worker tasks the client should
         use for servicing user callbacks. Having a value higher than 1 allows 
         more parallelism, but may be unnecessary. Range is MIN_WORKERS_COUNT to 
         MAX_WORKERS_COUNT, and default is DEFAULT_WORKERS_COUNT. 
         
+        * coalesce_writes: An optional bool that specifies if packets that are sent
+        within the same event loop iteration should be merged into a single
+        port write. This reduces the per write overhead with high rate of small 
+        packets, at the cost of delaying the sending until the next loop iteration.
+        Default is False.
+        
+        * max_queue_size: An optional int with the max number of incoming packets
+        that wait for the worker tasks. If endpoint_lanes is True, this is the limit
+        of each endpoint lane. Default is 0 which means unlimited.
+        
+        * queue_overflow_policy: An optional QueueOverflowPolicy that specifies
+        what to do with incoming packets when the queue is full. Dropped packets
+        are reported with PACKETS_DROPPED events. Default is DROP_NEWEST.
+        
+        * endpoint_lanes: An optional bool that specifies if incoming commands and 
+        messages of the same endpoint should be served one at a time, in the order
+        they were received. Packets of different endpoints are still served 
+        concurrently by the workers. Default is False.
+        
+        * hub: An optional SerialPacketsHub whose shared worker tasks serve the client
+        instead of its own workers, in which case workers is ignored. Clients of a
+        hub are typically created with SerialPacketsHub.add_client().
+        
+        * recorder: An optional CaptureRecorder from serial_packets.capture that
+        records the raw bytes that are received and sent, e.g. for replaying them
+        later with a ReplayTransport. Default is None.
+        
+        * max_commands_in_flight: An optional int with the max number of sent commands
+        that wait for a response. Commands beyond the limit wait and are sent as 
+        responses arrive, and their timeout starts when they are sent. With
+        adaptive_commands_window, this is the max of the adaptive window. Default is 
+        0 which means no limit.
+        
+        * max_endpoint_commands_in_flight: An optional int with the same limit per
+        endpoint. Default is 0 which means no limit.
+        
+        * adaptive_commands_window: An optional bool that specifies if the limit of 
+        commands in flight should be adjusted to the measured round trip time and 
+        delivery rate of the commands, to keep the link busy without queueing 
+        commands until they time out. Default is False.
+        
+        * retry_policy: An optional RetryPolicy for resending outgoing commands that
+        timed out or failed, unless another policy is passed when sending them.
+        Use only if the commands are idempotent. Default is None for no resends.
+        
         Returns:
         * A new serial messaging client.
         """
         assert (workers >= MIN_WORKERS_COUNT and workers <= MAX_WORKERS_COUNT)
-        self.__port = port
-        self.__baudrate = baudrate
+        assert (max_queue_size >= 0)
+        assert (max_commands_in_flight >= 0 and max_endpoint_commands_in_flight >= 0)
+        self.__packets_transport: PacketsTransport = (port if isinstance(
+            port, PacketsTransport) else SerialPortTransport(port, baudrate))
+        # Replayed responses are of commands that were not sent by this client.
+        self.__is_replay = self.__packets_transport.is_replay()
         self.__command_async_callback = command_async_callback
         self.__message_async_callback = message_async_callback
         self.__event_async_callback = event_async_callback
+        # Per endpoint handlers, indexed by endpoint. Each registered handler
+        # is stored as a (function, is_async) tuple.
+        self.__command_handlers: List[Optional[Tuple[Callable, bool]]] = [None] * (
+            MAX_USER_ENDPOINT + 1)
+        self.__message_handlers: List[Optional[Tuple[Callable, bool]]] = [None] * (
+            MAX_USER_ENDPOINT + 1)
         self.__transport = None
         self.__protocol = None
         self.__packet_encoder = PacketEncoder()
         self.__packet_decoder = PacketDecoder()
+        self.__stats = _StatsCollector()
+        self.__recorder = recorder
+        self.__coalesce_writes = coalesce_writes
+        # Encoded packets that wait for the next coalesced write.
+        self.__pending_writes = bytearray()
+        # A reusable buffer for encoding single packets.
+        self.__tx_bfr = bytearray(MAX_ENCODED_PACKET_LEN)
         self.__command_id_counter = 0
         # self.__interval_tracker = IntervalTracker(PRE_FLAG_TIMEOUT)
         self.__tx_cmd_contexts: Dict[int, _TxCommandContext] = {}
+        self.__command_window: Optional[_CommandWindow] = None
+        if max_commands_in_flight or max_endpoint_commands_in_flight or adaptive_commands_window:
+            self.__command_window = _CommandWindow(max_commands_in_flight,
+                                                   max_endpoint_commands_in_flight,
+                                                   adaptive_commands_window)
+        self.__retry_policy = retry_policy
+        # Maps the command ids of earlier attempts of commands that were resent.
+        self.__retried_cmd_ids: Dict[int, _CommandRetry] = {}
+        self.__bulk_channel = _BulkChannel(self.__send_bulk_frame)
         # Work items types:
         # * PacketsEvent: call user's event handler.
         # * DecodedCommandPacket: handle incoming command packet.
-        # * DecodedResponsePacket: handle incoming response packet.
         # * DecodedMessagePacket: handle incoming message packet.
-        self.__work_queue = asyncio.Queue()
+        self.__work_queue = _WorkQueue(endpoint_lanes)
+        self.__max_queue_size = max_queue_size
+        self.__queue_overflow_policy = queue_overflow_policy
+        # Keys of the lanes that paused reading, and are not drained yet.
+        self.__paused_lanes = set()
+        # Number of dropped packets that were not reported yet.
+        self.__unreported_dropped_packets = 0
         # Per https://stackoverflow.com/questions/71304329
         self.__background_tasks = []
 
-        self.__create_loop_runner_task(self.__cleanup_task_loop, "cleanup")
+        if hub:
+            hub._attach(self, self.__work_queue)
+            return
 
         # Create a few worker tasks to process incoming packets.
         logger.debug("Creating [%d] workers tasks", workers)
@@ -157,28 +676,169 @@ class SerialPacketsClient:
             self.__create_loop_runner_task(self.__worker_task_loop, f"rx_task_{i+1:02d}")
 
     def __str__(self) -> str:
-        return f"{self.__port}@{self.__baudrate}"
+        return str(self.__packets_transport)
 
     def is_connected(self) -> bool:
         """Test if the client is connected to the port."""
         return self.__protocol and self.__protocol.is_connected()
 
+    def commands_in_flight(self) -> int:
+        """Returns the number of sent commands that wait for a response."""
+        return len(self.__tx_cmd_contexts)
+
+    def commands_waiting(self) -> int:
+        """Returns the number of commands that wait for a slot in the commands window."""
+        return len(self.__command_window) if self.__command_window is not None else 0
+
+    def commands_window(self) -> int:
+        """Returns the current limit of commands in flight, or 0 if there is no limit."""
+        return self.__command_window.window() if self.__command_window is not None else 0
+
+    def stats(self) -> PacketsStats:
+        """Returns a snapshot of the client's counters, since the client was created."""
+        decoder = self.__packet_decoder
+        return self.__stats.snapshot(decoder.crc_errors(), decoder.framing_errors(),
+                                     decoder.dropped_bytes())
+
     def _post_event(self, event: PacketsEvent) -> None:
         logger.debug("Posted event: %s", event)
         self.__work_queue.put_nowait(event)
+        self.__update_queue_high_water()
+
+    def __update_queue_high_water(self) -> None:
+        n = len(self.__work_queue)
+        if n > self.__stats.queue_high_water:
+            self.__stats.queue_high_water = n
+
+    def _on_received_bytes(self, data: bytes) -> None:
+        """Package private. Called by the protocol with received data, before decoding it."""
+        self.__stats.rx_wire_bytes += len(data)
+        if self.__recorder:
+            self.__recorder.record_rx(data)
+
+    def _queue_incoming_packet(self, decoded_packet) -> None:
+        """Package private. Called by the protocol to queue incoming packets for the workers."""
+        logger.debug("Queuing incoming packet of type [%s.]", type(decoded_packet).__name__)
+        if isinstance(decoded_packet, DecodedCommandPacket):
+            self.__stats.count_rx(PacketType.COMMAND, decoded_packet.endpoint,
+                                  decoded_packet.data.size())
+        elif isinstance(decoded_packet, DecodedMessagePacket):
+            self.__stats.count_rx(PacketType.MESSAGE, decoded_packet.endpoint,
+                                  decoded_packet.data.size())
+        else:
+            self.__stats.count_rx(PacketType.LOG, None, decoded_packet.data.size())
+        lane_key = self.__work_queue.lane_key(decoded_packet)
+        if self.__max_queue_size and self.__work_queue.lane_packets(
+                lane_key) >= self.__max_queue_size:
+            policy = self.__queue_overflow_policy
+            if policy == QueueOverflowPolicy.PAUSE_READING:
+                if not self.__paused_lanes:
+                    logger.debug("Work queue full, pausing reading")
+                    self.__transport.pause_reading()
+                self.__paused_lanes.add(lane_key)
+            elif policy == QueueOverflowPolicy.DROP_OLDEST:
+                self.__work_queue.remove_first(lane_key, _is_queued_packet)
+                self.__on_packet_dropped()
+            else:
+                if policy == QueueOverflowPolicy.COALESCE:
+                    self.__coalesce_incoming_packet(lane_key, decoded_packet)
+                self.__on_packet_dropped()
+                return
+        self.__work_queue.put_nowait(decoded_packet)
+        self.__update_queue_high_water()
+
+    def __coalesce_incoming_packet(self, lane_key: object, decoded_packet) -> None:
+        """If the packet is a message, replaces with it the first queued message of the
+        same endpoint, if any."""
+        if isinstance(decoded_packet, DecodedMessagePacket):
+            endpoint = decoded_packet.endpoint
+            self.__work_queue.replace_first(
+                lane_key,
+                lambda item: isinstance(item, DecodedMessagePacket) and item.endpoint == endpoint,
+                decoded_packet)
+
+    def __on_packet_dropped(self) -> None:
+        """Counts a dropped incoming packet and schedules its reporting."""
+        self.__stats.dropped_packets += 1
+        if not self.__unreported_dropped_packets:
+            asyncio.get_running_loop().call_later(_DROPPED_PACKETS_REPORT_INTERVAL,
+                                                  self.__report_dropped_packets)
+        self.__unreported_dropped_packets += 1
+
+    def __report_dropped_packets(self) -> None:
+        """Posts an event with the number of packets that were dropped since last report."""
+        n = self.__unreported_dropped_packets
+        self.__unreported_dropped_packets = 0
+        logger.error("Work queue full, dropped %d incoming packets", n)
+        self._post_event(
+            PacketsEvent(PacketsEventType.PACKETS_DROPPED, f"Dropped {n} incoming packets"))
+
+    def __on_packet_dequeued(self, decoded_packet) -> None:
+        """Called by the workers when they take an incoming packet from the queue."""
+        lane_key = self.__work_queue.lane_key(decoded_packet)
+        if lane_key not in self.__paused_lanes or self.__work_queue.lane_packets(
+                lane_key) > self.__max_queue_size // 2:
+            return
+        # Resume only when all the lanes that paused reading were drained.
+        self.__paused_lanes.discard(lane_key)
+        if not self.__paused_lanes:
+            logger.debug("Work queue drained, resuming reading")
+            if self.is_connected():
+                self.__transport.resume_reading()
+
+    def register_command_handler(self, endpoint: int, handler: Optional[Callable]) -> None:
+        """Registers a handler for incoming commands of a given endpoint.
+
+        Commands of endpoints with no registered handler are passed to
+        command_async_callback.
+
+        Args:
+        * endpoint: The endpoint of the commands (int [0-MAX_USER_ENDPOINT]).
+        * handler: A function with the same signature as command_async_callback.
+          Can be an async function, also as a functools.partial, that is served by
+          the worker tasks, or a regular function that is called as the command
+          arrives, without creating a coroutine or queuing it, so it should return
+          quickly. None to unregister the endpoint's handler.
+        """
+        assert (endpoint >= 0 and endpoint <= MAX_USER_ENDPOINT)
+        self.__command_handlers[endpoint] = ((handler, _is_async_callable(handler))
+                                             if handler else None)
+
+    def register_message_handler(self, endpoint: int, handler: Optional[Callable]) -> None:
+        """Registers a handler for incoming messages of a given endpoint.
+
+        Messages of endpoints with no registered handler are passed to
+        message_async_callback.
+
+        Args:
+        * endpoint: The endpoint of the messages (int [0-MAX_USER_ENDPOINT]).
+        * handler: A function with the same signature as message_async_callback.
+          Can be an async function, also as a functools.partial, that is served by
+          the worker tasks, or a regular function that is called as the message
+          arrives, without creating a coroutine or queuing it, so it should return
+          quickly. None to unregister the endpoint's handler.
+        """
+        assert (endpoint >= 0 and endpoint <= MAX_USER_ENDPOINT)
+        self.__message_handlers[endpoint] = ((handler, _is_async_callable(handler))
+                                             if handler else None)
+
+    def __new_protocol(self) -> _SerialProtocol:
+        """Returns a new protocol for a new connection."""
+        protocol = _SerialProtocol()
+        protocol.set(self, str(self.__packets_transport), self.__packet_decoder)
+        return protocol
 
     async def connect(self) -> bool:
         """Connect to serial port. Returns True if connected to port."""
-        logger.debug("Connecting to port [%s]", self.__port)
+        logger.debug("Connecting to port [%s]", self.__packets_transport)
         try:
-            self.__transport, self.__protocol = await serial_asyncio.create_serial_connection(
-                asyncio.get_running_loop(), _SerialProtocol, self.__port, baudrate=self.__baudrate)
+            self.__transport, self.__protocol = await self.__packets_transport.connect(
+                self.__new_protocol)
         except Exception as e:
             logger.error("%s", e)
             if logging.DEBUG >= logger.getEffectiveLevel():
                 traceback.print_exception(e)
             return False
-        self.__protocol.set(self, self.__port, self.__packet_decoder, self.__work_queue)
         return True
 
   
@@ -199,18 +859,17 @@ class SerialPacketsClient:
                 logger.error("Task [%s] exception:", task_name)
                 traceback.print_exception(e)
 
-    async def __cleanup_task_loop(self, task_name):
-        """Worker task loop for cleaning outgoing commands that timeout."""
-        await asyncio.sleep(0.05)
-        # NOTE: Deleting dict elements inside a dict iteration is not allowed.
-        # Using a workaround instead.
-        keys = list(self.__tx_cmd_contexts.keys())
-        for cmd_id in keys:
-            tx_context = self.__tx_cmd_contexts.get(cmd_id)
-            if tx_context.is_expired():
-                logger.error("Command [%d] timeout", cmd_id)
-                tx_context.set_command_result(PacketStatus.TIMEOUT.value, PacketData())
-                self.__tx_cmd_contexts.pop(cmd_id)
+    def __on_command_timeout(self, cmd_id: int) -> None:
+        """Called by the event loop when an outgoing command times out."""
+        tx_context = self.__tx_cmd_contexts.pop(cmd_id, None)
+        if tx_context:
+            logger.error("Command [%d] timeout", cmd_id)
+            self.__stats.command_timeouts += 1
+            self.__resolve_command(tx_context, PacketStatus.TIMEOUT.value, PacketData())
+            if self.__command_window is not None:
+                self.__command_window.release(tx_context.endpoint(), None,
+                                              asyncio.get_running_loop().time())
+                self.__send_waiting_commands()
 
     async def __worker_task_loop(self, task_name):
         """Body of the worker tasks to serve incoming packets."""
@@ -219,47 +878,219 @@ class SerialPacketsClient:
         # logger.debug("RX worker task [%s] started", task_name)
         # while True:
         work_item = await self.__work_queue.get()
+        await self._serve_work_item(work_item)
+
+    async def _serve_work_item(self, work_item) -> None:
+        """Package private. Serves an item that was taken from the work queue. Called 
+        by the worker tasks of the client or of its hub."""
+        if _is_queued_packet(work_item):
+            self.__on_packet_dequeued(work_item)
         # Since we call user's callback we want to protect the thread from
         # exceptions.
-        if isinstance(work_item, DecodedCommandPacket):
-            await self.__handle_incoming_command_packet(work_item)
-        elif isinstance(work_item, DecodedResponsePacket):
-            await self.__handle_incoming_response_packet(work_item)
-        elif isinstance(work_item, DecodedMessagePacket):
-            await self.__handle_incoming_message_packet(work_item)
-        elif isinstance(work_item, PacketsEvent):
-            await self.__handle_packets_event(work_item)
-        else:
-            logger.error(f"Unknown work item type [%s], dropping", type(work_item))
+        try:
+            if isinstance(work_item, DecodedCommandPacket):
+                start_time = time.perf_counter()
+                await self.__handle_incoming_command_packet(work_item)
+                self.__stats.callback_time.record(time.perf_counter() - start_time)
+            elif isinstance(work_item, DecodedMessagePacket):
+                start_time = time.perf_counter()
+                await self.__handle_incoming_message_packet(work_item)
+                self.__stats.callback_time.record(time.perf_counter() - start_time)
+            elif isinstance(work_item, PacketsEvent):
+                await self.__handle_packets_event(work_item)
+            else:
+                logger.error(f"Unknown work item type [%s], dropping", type(work_item))
+        finally:
+            # Allow serving the next item of the lane.
+            self.__work_queue.task_done(work_item)
 
     async def __handle_incoming_command_packet(self, decoded_cmd_packet: DecodedCommandPacket):
         assert (isinstance(decoded_cmd_packet, DecodedCommandPacket))
-        if self.__command_async_callback:
-            status, data = await self.__command_async_callback(decoded_cmd_packet.endpoint,
-                                                               decoded_cmd_packet.data)
-            if data.size() > MAX_DATA_LEN:
-                logger.error("Command response data too long (%d), failing command", data.size9)
-                status, data = (PacketStatus.LENGTH_ERROR.value, PacketData())
+        endpoint = decoded_cmd_packet.endpoint
+        handler = self.__command_handlers[endpoint] if endpoint <= MAX_USER_ENDPOINT else None
+        if handler:
+            result = handler[0](endpoint, decoded_cmd_packet.data)
+            status, data = (await result) if inspect.isawaitable(result) else result
+        elif self.__command_async_callback:
+            status, data = await self.__command_async_callback(endpoint, decoded_cmd_packet.data)
         else:
             status, data = (PacketStatus.UNHANDLED.value, PacketData())
-        response_packet = self.__packet_encoder.encode_response_packet(
-            decoded_cmd_packet.cmd_id, status, data._internal_bytes_buffer())
-        self.__transport.write(response_packet)
+        self.__send_response(decoded_cmd_packet, status, data)
 
-    async def __handle_incoming_response_packet(self, decoded_rsp_packet: DecodedResponsePacket):
+    def _serve_packet_inline(self, decoded_packet) -> bool:
+        """Package private. Called by the protocol to serve incoming commands and
+        messages of endpoints with a sync handler, as they arrive. Returns False if
+        the packet should be queued for the workers instead."""
+        if isinstance(decoded_packet, DecodedCommandPacket):
+            packet_type, handlers = (PacketType.COMMAND, self.__command_handlers)
+        elif isinstance(decoded_packet, DecodedMessagePacket):
+            packet_type, handlers = (PacketType.MESSAGE, self.__message_handlers)
+        else:
+            return False
+        endpoint = decoded_packet.endpoint
+        handler = handlers[endpoint] if endpoint <= MAX_USER_ENDPOINT else None
+        if not handler or handler[1]:
+            return False
+        self.__stats.count_rx(packet_type, endpoint, decoded_packet.data.size())
+        start_time = time.perf_counter()
+        try:
+            result = handler[0](endpoint, decoded_packet.data)
+        except Exception as e:
+            logger.error("Handler of endpoint [%d] exception:", endpoint)
+            traceback.print_exception(e)
+            return True
+        self.__stats.callback_time.record(time.perf_counter() - start_time)
+        if inspect.isawaitable(result):
+            # A regular function that returns an awaitable. Its next packets are
+            # served by the workers.
+            handlers[endpoint] = (handler[0], True)
+            asyncio.ensure_future(self.__finish_inline_handler(decoded_packet, result))
+        elif packet_type == PacketType.COMMAND:
+            status, data = result
+            self.__send_response(decoded_packet, status, data)
+        return True
+
+    async def __finish_inline_handler(self, decoded_packet, awaitable) -> None:
+        """Awaits the result of an inline handler and responds if it's a command."""
+        try:
+            result = await awaitable
+        except Exception as e:
+            logger.error("Handler of endpoint [%d] exception:", decoded_packet.endpoint)
+            traceback.print_exception(e)
+            return
+        if isinstance(decoded_packet, DecodedCommandPacket):
+            status, data = result
+            self.__send_response(decoded_packet, status, data)
+
+    def __send_response(self, decoded_cmd_packet: DecodedCommandPacket, status: int,
+                        data: PacketData) -> None:
+        """Sends the response to an incoming command."""
+        if data.size() > MAX_DATA_LEN:
+            logger.error("Command response data too long (%d), failing command", data.size())
+            status, data = (PacketStatus.LENGTH_ERROR.value, PacketData())
+        self.__write_packet(self.__packet_encoder.encode_response_packet_into,
+                            decoded_cmd_packet.cmd_id, status, data._internal_bytes_buffer())
+        self.__stats.count_tx(PacketType.RESPONSE, None, data.size())
+
+    def _handle_incoming_response_packet(self, decoded_rsp_packet: DecodedResponsePacket) -> None:
+        """Package private. Called by the protocol on incoming response packets."""
         # print(f"Handling resp packet ({len(self.__tx_cmd_contexts)} tx contexts)", flush=True)
         assert (isinstance(decoded_rsp_packet, DecodedResponsePacket))
+        self.__stats.count_rx(PacketType.RESPONSE, None, decoded_rsp_packet.data.size())
         tx_context: _TxCommandContext = self.__tx_cmd_contexts.pop(decoded_rsp_packet.cmd_id, None)
         if not tx_context:
+            retry = self.__retried_cmd_ids.get(decoded_rsp_packet.cmd_id)
+            if retry:
+                # A late response to an earlier attempt of a command that was resent.
+                logger.debug("Late response to command [%d] resolves its resend",
+                             decoded_rsp_packet.cmd_id)
+                if not retry.future.done():
+                    retry.future.set_result((decoded_rsp_packet.status, decoded_rsp_packet.data))
+                self.__end_retry(retry)
+                return
+            if self.__is_replay:
+                logger.debug("Dropping replayed response [%d]", decoded_rsp_packet.cmd_id)
+                return
+            self.__stats.late_responses += 1
             logger.error("Response has no matching command [%d], may timeout. Dropping",
                          decoded_rsp_packet.cmd_id)
             # print(f"Response has no matching context {packet.cmd_id}, dropping", flush=True)
             return
-        tx_context.set_command_result(decoded_rsp_packet.status, decoded_rsp_packet.data)
+        now = asyncio.get_running_loop().time()
+        rtt = now - tx_context.start_time()
+        self.__stats.command_rtt.record(rtt)
+        self.__resolve_command(tx_context, decoded_rsp_packet.status, decoded_rsp_packet.data)
+        if self.__command_window is not None:
+            self.__command_window.release(tx_context.endpoint(), rtt, now)
+            self.__send_waiting_commands()
+
+    def __resolve_command(self, tx_context: _TxCommandContext, status: int,
+                          data: PacketData) -> None:
+        """Sets the result of a command, or resends it if its retry policy says so."""
+        retry = tx_context.retry()
+        if retry is not None:
+            # The attempt is no longer in flight.
+            retry.cmd_id = None
+            if not retry.future.done() and retry.policy.should_retry(status, retry.retries + 1):
+                self.__schedule_resend(tx_context.cmd_id(), retry)
+                return
+            self.__end_retry(retry)
+        tx_context.set_command_result(status, data)
+
+    def __schedule_resend(self, cmd_id: int, retry: _CommandRetry) -> None:
+        """Schedules the next attempt of a command, after the backoff of its retry policy."""
+        retry.retries += 1
+        self.__stats.command_retries += 1
+        retry.cmd_ids.append(cmd_id)
+        self.__retried_cmd_ids[cmd_id] = retry
+        delay = retry.policy.delay(retry.retries)
+        logger.debug("Resending command [%d] in %.3f secs", cmd_id, delay)
+        retry.handle = asyncio.get_running_loop().call_later(delay, self.__resend_command, retry)
+
+    def __resend_command(self, retry: _CommandRetry) -> None:
+        """Called by the event loop when the backoff of a command ends."""
+        retry.handle = None
+        # The future may be cancelled by the user.
+        if retry.future.done():
+            self.__end_retry(retry)
+            return
+        if not self.is_connected():
+            self.__end_retry(retry)
+            retry.future.set_result((PacketStatus.NOT_CONNECTED.value, PacketData()))
+            return
+        window = self.__command_window
+        if window is not None and not window.try_acquire(retry.endpoint):
+            window.put(
+                _WaitingCommand(retry.endpoint, retry.data, retry.timeout, retry.future, retry))
+            return
+        self.__send_command(retry.endpoint, retry.data, retry.timeout, retry.future, retry)
+
+    def __end_retry(self, retry: _CommandRetry) -> None:
+        """Forgets the attempts of a command that is resolved, including the one in
+        flight, whose response is no longer waited for."""
+        if retry.handle:
+            retry.handle.cancel()
+            retry.handle = None
+        for cmd_id in retry.cmd_ids:
+            self.__retried_cmd_ids.pop(cmd_id, None)
+        retry.cmd_ids.clear()
+        if retry.cmd_id is None:
+            return
+        tx_context = self.__tx_cmd_contexts.pop(retry.cmd_id, None)
+        retry.cmd_id = None
+        if tx_context is None:
+            return
+        tx_context.cancel_timeout()
+        if self.__command_window is not None:
+            self.__command_window.abandon(tx_context.endpoint())
+            self.__send_waiting_commands()
+
+    def __new_retry(self, endpoint: int, data: PacketData, timeout: float,
+                    retry_policy: Optional[RetryPolicy]) -> Optional[_CommandRetry]:
+        """Returns the resend state of a new command, or None if it's not resent."""
+        policy = retry_policy if retry_policy is not None else self.__retry_policy
+        if policy is None or not policy.retries:
+            return None
+        # The caller may reuse the data after this call.
+        return _CommandRetry(policy, endpoint, bytes(data._internal_bytes_buffer()), timeout,
+                             asyncio.get_running_loop().create_future())
+
+    def _handle_incoming_bulk_packet(self, decoded_msg_packet: DecodedMessagePacket) -> None:
+        """Package private. Called by the protocol on incoming bulk transfer frames."""
+        data = decoded_msg_packet.data
+        self.__stats.count_rx(PacketType.MESSAGE, BULK_ENDPOINT, data.size())
+        self.__bulk_channel.on_frame(data._internal_bytes_buffer(),
+                                     asyncio.get_running_loop().time())
 
     async def __handle_incoming_message_packet(self, decoded_msg_packet: DecodedMessagePacket):
         assert (isinstance(decoded_msg_packet, DecodedMessagePacket))
-        if self.__message_async_callback:
+        endpoint = decoded_msg_packet.endpoint
+        handler = self.__message_handlers[endpoint] if endpoint <= MAX_USER_ENDPOINT else None
+        if handler:
+            result = handler[0](endpoint, decoded_msg_packet.data)
+            if inspect.isawaitable(result):
+                await result
+        elif self.__message_async_callback:
             await self.__message_async_callback(decoded_msg_packet.endpoint,
                                                 decoded_msg_packet.data)
         else:
@@ -273,10 +1104,12 @@ class SerialPacketsClient:
             logger.debug("Callback with event %s", packets_event)
             await self.__event_async_callback(packets_event)
 
-    async def send_command_blocking(self,
-                                    endpoint: int,
-                                    data: PacketData,
-                                    timeout=DEFAULT_CMD_TIMEOUT) -> Tuple([int, PacketData]):
+    async def send_command_blocking(
+            self,
+            endpoint: int,
+            data: PacketData,
+            timeout=DEFAULT_CMD_TIMEOUT,
+            retry_policy: Optional[RetryPolicy] = None) -> Tuple([int, PacketData]):
         """ Sends a command and wait for result or timeout. This is a convenience
         method that calls send_command_future() and then waits on the future
         for command result.
@@ -288,6 +1121,8 @@ class SerialPacketsClient:
         If a command response is not received within this period, the command
         is aborted with status PacketStatus.TIMEOUT.value and an empty 
         data PacketData.
+        * retry_policy: An optional RetryPolicy for resending the command, as in
+        send_command_future().
         
         Returns:
         * status: The command returned status (int, [0-255]) or PacketStatus.TIMEOUT.value
@@ -295,14 +1130,96 @@ class SerialPacketsClient:
         * data: The command's response data (PacketData [0, DATA_MAX_LEN] or an empty PacketData
         in case of a timeout.
         """
-        future = self.send_command_future(endpoint, data, timeout=timeout)
+        future = self.send_command_future(endpoint,
+                                          data,
+                                          timeout=timeout,
+                                          retry_policy=retry_policy)
         status, data = await future
         return (status, data)
 
+    def __write(self, packet: bytes | bytearray) -> None:
+        """Writes encoded packet(s) to the port, or merge them with other writes
+        of this loop iteration if writes coalescing is enabled."""
+        self.__stats.tx_wire_bytes += len(packet)
+        if not self.__coalesce_writes:
+            self.__transport_write(packet)
+            return
+        if not self.__pending_writes:
+            asyncio.get_running_loop().call_soon(self.__flush_pending_writes)
+        self.__pending_writes.extend(packet)
+
+    def __write_packet(self, encode_into: Callable[..., int], *args) -> None:
+        """Encodes a packet with one of the encoder's _into methods, into a reusable
+        buffer, and writes it. With writes coalescing the packet is appended to the
+        pending writes, otherwise it's copied once since transports may keep a
+        reference to the written data."""
+        n = encode_into(self.__tx_bfr, *args)
+        self.__stats.tx_wire_bytes += n
+        if not self.__coalesce_writes:
+            self.__transport_write(self.__tx_bfr[:n])
+            return
+        if not self.__pending_writes:
+            asyncio.get_running_loop().call_soon(self.__flush_pending_writes)
+        with memoryview(self.__tx_bfr) as view:
+            self.__pending_writes += view[:n]
+
+    def __flush_pending_writes(self) -> None:
+        """Writes the coalesced packets to the port."""
+        pending_writes = self.__pending_writes
+        self.__pending_writes = bytearray()
+        if not self.is_connected():
+            logger.error("Client not connected, dropping %d coalesced bytes", len(pending_writes))
+            return
+        self.__transport_write(pending_writes)
+
+    def __transport_write(self, data: bytes | bytearray) -> None:
+        if self.__recorder:
+            self.__recorder.record_tx(data)
+        self.__transport.write(data)
+
+    def __new_command_context(self,
+                              endpoint: int,
+                              timeout: float,
+                              future: Optional[asyncio.Future] = None,
+                              retry: Optional[_CommandRetry] = None) -> Tuple[int, asyncio.Future]:
+        """Allocates a command id and registers a context for its response.
+        Returns the command id and the future of the command result, which is
+        a new future unless one is given."""
+        cmd_id = self.__new_command_id()
+        return (cmd_id, self.__register_command_context(cmd_id, endpoint, timeout, future, retry))
+
+    def __new_command_id(self) -> int:
+        """Allocates a 32 bit fresh command id. Wrap around are ok since
+        commands are short living."""
+        self.__command_id_counter = (self.__command_id_counter + 1) & 0xffffffff
+        cmd_id = self.__command_id_counter
+        assert (not cmd_id in self.__tx_cmd_contexts)
+        return cmd_id
+
+    def __register_command_context(self, cmd_id: int, endpoint: int, timeout: float,
+                                   future: Optional[asyncio.Future],
+                                   retry: Optional[_CommandRetry]) -> asyncio.Future:
+        """Registers a context for the response of a command with the given id.
+        Returns the future of the command result, which is a new future unless
+        one is given."""
+        # Create command tx context. The timeout is scheduled with the
+        # event loop's timers, using its monotonic clock.
+        loop = asyncio.get_running_loop()
+        if future is None:
+            future = loop.create_future()
+        now = loop.time()
+        timeout_handle = loop.call_at(now + timeout, self.__on_command_timeout, cmd_id)
+        tx_cmd_context = _TxCommandContext(cmd_id, endpoint, future, timeout_handle, now, retry)
+        if retry is not None:
+            retry.cmd_id = cmd_id
+        self.__tx_cmd_contexts[cmd_id] = tx_cmd_context
+        return future
+
     def send_command_future(self,
                             endpoint: int,
                             data: PacketData,
-                            timeout=DEFAULT_CMD_TIMEOUT) -> Tuple([int, PacketData]):
+                            timeout=DEFAULT_CMD_TIMEOUT,
+                            retry_policy: Optional[RetryPolicy] = None) -> Tuple([int, PacketData]):
         """ Sends a command and return immediately without blocking. 
         
         Caller should wait on the returned future to receive the command
@@ -317,7 +1234,11 @@ class SerialPacketsClient:
         * timeout: Command timeout in secs (float MIN_CMD_TIMEOUT to MAX_CMD_TIMEOUT, default DEFAULT_CMD_TIMEOUT). 
         If a command response is not received within this period, the command
         is aborted with status PacketStatus.TIMEOUT.value and an empty 
-        data PacketData.
+        data PacketData. If the commands window is full, the command waits for
+        a slot and its timeout starts when it is sent.
+        * retry_policy: An optional RetryPolicy for resending the command if it timed
+        out or failed, with a new timeout per attempt. A late response to an earlier 
+        attempt still resolves the command. Default is the client's retry_policy.
         
         Returns:
         * A future to wait on for command result. 
@@ -330,24 +1251,134 @@ class SerialPacketsClient:
             future = asyncio.Future()
             future.set_result((PacketStatus.NOT_CONNECTED.value, PacketData()))
             return future
-        # Allocate a 32 bit fresh command id. Wrap around are ok since
-        # commands are short living.
-        self.__command_id_counter = (self.__command_id_counter + 1) & 0xffffffff
-        cmd_id = self.__command_id_counter
-        assert (not cmd_id in self.__tx_cmd_contexts)
-        # Encode packet bytes
-        packet = self.__packet_encoder.encode_command_packet(cmd_id, endpoint, data._internal_bytes_buffer())
-        logger.debug("TX command packet [%d]: %s", endpoint, packet.hex(sep=' '))
-        # Create command tx context
-        expiration_time = time.time() + timeout
-        future = asyncio.Future()
-        tx_cmd_context = _TxCommandContext(cmd_id, expiration_time, future)
-        self.__tx_cmd_contexts[cmd_id] = tx_cmd_context
-        # Start sending
-        self.__transport.write(packet)
+        retry = self.__new_retry(endpoint, data, timeout, retry_policy)
+        if self.__command_window is not None and not self.__command_window.try_acquire(endpoint):
+            return self.__wait_for_command_slot(endpoint, data, timeout, retry)
         # Future will be signaled on response or timeout.
+        if retry is not None:
+            return self.__send_command(endpoint, retry.data, timeout, retry.future, retry)
+        return self.__send_command(endpoint, data._internal_bytes_buffer(), timeout)
+
+    def __send_command(self,
+                       endpoint: int,
+                       data: bytes | bytearray | memoryview,
+                       timeout: float,
+                       future: Optional[asyncio.Future] = None,
+                       retry: Optional[_CommandRetry] = None) -> asyncio.Future:
+        """Sends a command with the given data bytes. Returns the future of its result."""
+        cmd_id, future = self.__new_command_context(endpoint, timeout, future, retry)
+        # Encode packet bytes
+        logger.debug("TX command packet [%d], %d data bytes", endpoint, len(data))
+        self.__write_packet(self.__packet_encoder.encode_command_packet_into, cmd_id, endpoint,
+                            data)
+        self.__stats.count_tx(PacketType.COMMAND, endpoint, len(data))
         return future
 
+    def __wait_for_command_slot(self, endpoint: int, data: PacketData, timeout: float,
+                                retry: Optional[_CommandRetry]) -> asyncio.Future:
+        """Queues a command until it has a slot in the commands window. Returns the
+        future of its result."""
+        if retry is not None:
+            command = _WaitingCommand(endpoint, retry.data, timeout, retry.future, retry)
+        else:
+            # The caller may reuse the data after this call.
+            command = _WaitingCommand(endpoint, bytes(data._internal_bytes_buffer()), timeout,
+                                      asyncio.get_running_loop().create_future())
+        self.__command_window.put(command)
+        return command.future
+
+    def __send_waiting_commands(self) -> None:
+        """Sends the waiting commands that have a slot in the commands window."""
+        window = self.__command_window
+        if not len(window):
+            return
+        if not self.is_connected():
+            for command in window.clear():
+                if command.retry is not None:
+                    self.__end_retry(command.retry)
+                if not command.future.done():
+                    command.future.set_result((PacketStatus.NOT_CONNECTED.value, PacketData()))
+            return
+        command = window.pop_ready()
+        while command is not None:
+            self.__send_command(command.endpoint, command.data, command.timeout, command.future,
+                                command.retry)
+            command = window.pop_ready()
+
+    def send_commands_futures(self,
+                              commands: List[Tuple[int, PacketData]],
+                              timeout=DEFAULT_CMD_TIMEOUT,
+                              retry_policy: Optional[RetryPolicy] = None) -> List[asyncio.Future]:
+        """ Sends a batch of commands with a single port write and return immediately 
+        without blocking. Same as calling send_command_future() for each of the 
+        commands, but more efficient for a large number of small commands.
+
+        Args:
+        * commands: A list of (endpoint, data) tuples of the commands to send, 
+          with the same constraints as in send_command_future().
+        * timeout: Command timeout in secs, applied to each of the commands.
+        * retry_policy: An optional RetryPolicy for resending the commands, as in
+          send_command_future().
+        
+        Returns:
+        * A list of futures to wait on for the commands result, in the same
+          order as the commands. 
+        """
+        assert (timeout >= MIN_CMD_TIMEOUT and timeout <= MAX_CMD_TIMEOUT)
+        for endpoint, data in commands:
+            assert (endpoint >= 0 and endpoint <= MAX_USER_ENDPOINT)
+            assert (data.size() <= MAX_DATA_LEN)
+        if not self.is_connected():
+            logger.error("Client not connected when trying to send commands")
+            futures = []
+            for _ in commands:
+                future = asyncio.Future()
+                future.set_result((PacketStatus.NOT_CONNECTED.value, PacketData()))
+                futures.append(future)
+            return futures
+        window = self.__command_window
+        if window is not None:
+            # Commands with no slot wait, and are left out of the batch.
+            futures = [
+                None if window.try_acquire(endpoint) else self.__wait_for_command_slot(
+                    endpoint, data, timeout, self.__new_retry(endpoint, data, timeout,
+                                                              retry_policy))
+                for endpoint, data in commands
+            ]
+            commands = [command for command, future in zip(commands, futures) if future is None]
+        else:
+            futures = [None] * len(commands)
+        encoder = self.__packet_encoder
+        cmd_ids = []
+        try:
+            with _BatchBuffer(commands) as batch:
+                for endpoint, data in commands:
+                    cmd_id = self.__new_command_id()
+                    batch.add(
+                        encoder.encode_command_packet_into(batch.free_space(), cmd_id, endpoint,
+                                                           data._internal_bytes_buffer()))
+                    cmd_ids.append(cmd_id)
+        except BaseException:
+            # Nothing was registered for the batch yet, only its window slots.
+            if window is not None:
+                for endpoint, _ in commands:
+                    window.abandon(endpoint)
+                self.__send_waiting_commands()
+            raise
+        # The contexts are registered only after the whole batch was encoded.
+        sent_futures = []
+        for cmd_id, (endpoint, data) in zip(cmd_ids, commands):
+            retry = self.__new_retry(endpoint, data, timeout, retry_policy)
+            sent_futures.append(
+                self.__register_command_context(cmd_id, endpoint, timeout, retry and retry.future,
+                                                retry))
+            self.__stats.count_tx(PacketType.COMMAND, endpoint, data.size())
+        logger.debug("TX %d command packets, %d bytes", len(commands), len(batch.packets))
+        if commands:
+            self.__write(batch.packets)
+        sent_futures.reverse()
+        return [future or sent_futures.pop() for future in futures]
+
     def send_message(self, endpoint: int, data: PacketData) -> None:
         """ Sends a message. Returns immediately, before sending completed. 
 
@@ -361,10 +1392,91 @@ class SerialPacketsClient:
         assert (endpoint >= 0 and endpoint <= MAX_USER_ENDPOINT)
         assert (data.size() <= MAX_DATA_LEN)
         if not self.is_connected():
-            logger.warn("Client not connected, ignoring message send")
+            logger.warning("Client not connected, ignoring message send")
             return
         # Encode packet bytes
-        packet = self.__packet_encoder.encode_message_packet(endpoint, data._internal_bytes_buffer())
-        logger.debug("TX message packet [%d]: %s", endpoint, packet.hex(sep=' '))
-        # Start sending
-        self.__transport.write(packet)
+        logger.debug("TX message packet [%d], %d data bytes", endpoint, data.size())
+        self.__write_packet(self.__packet_encoder.encode_message_packet_into, endpoint,
+                            data._internal_bytes_buffer())
+        self.__stats.count_tx(PacketType.MESSAGE, endpoint, data.size())
+
+    def send_messages(self, messages: List[Tuple[int, PacketData]]) -> None:
+        """ Sends a batch of messages with a single port write. Returns immediately, 
+            before sending completed. Same as calling send_message() for each of the
+            messages, but more efficient for a large number of small messages.
+
+            Args:
+            * messages: A list of (endpoint, data) tuples of the messages to send, 
+              with the same constraints as in send_message().
+            
+            Returns:
+            * None.
+            """
+        for endpoint, data in messages:
+            assert (endpoint >= 0 and endpoint <= MAX_USER_ENDPOINT)
+            assert (data.size() <= MAX_DATA_LEN)
+        if not self.is_connected():
+            logger.warning("Client not connected, ignoring messages send")
+            return
+        encoder = self.__packet_encoder
+        with _BatchBuffer(messages) as batch:
+            for endpoint, data in messages:
+                batch.add(
+                    encoder.encode_message_packet_into(batch.free_space(), endpoint,
+                                                       data._internal_bytes_buffer()))
+                self.__stats.count_tx(PacketType.MESSAGE, endpoint, data.size())
+        logger.debug("TX %d message packets, %d bytes", len(messages), len(batch.packets))
+        self.__write(batch.packets)
+
+    def __send_bulk_frame(self, frame: bytes) -> None:
+        """Sends a bulk transfer frame as a message to BULK_ENDPOINT."""
+        if not self.is_connected():
+            logger.debug("Client not connected, dropping bulk frame")
+            return
+        self.__write_packet(self.__packet_encoder.encode_message_packet_into, BULK_ENDPOINT,
+                            frame)
+        self.__stats.count_tx(PacketType.MESSAGE, BULK_ENDPOINT, len(frame))
+
+    async def send_bulk(self,
+                        endpoint: int,
+                        data: bytes | bytearray | memoryview | AsyncIterable[bytes],
+                        window: int = DEFAULT_BULK_WINDOW,
+                        timeout: float = DEFAULT_BULK_TIMEOUT) -> int:
+        """ Sends data of any size, as a bulk transfer, and waits for the receiver to
+            acknowledge all of it. The receiver gets it with receive_bulk().
+
+            Args:
+            * endpoint: The target endpoint (int [0-MAX_USER_ENDPOINT]) on the receiver side.
+            * data: The data to send, as bytes or as an async iterable of bytes blocks, e.g.
+              for streaming a file without reading all of it to memory.
+            * window: An optional int with the max number of chunks that are sent before
+              they are acknowledged. Default is DEFAULT_BULK_WINDOW.
+            * timeout: An optional float with the max time in secs with no progress before
+              the transfer is aborted. Default is DEFAULT_BULK_TIMEOUT. The receiver
+              also aborts it when no chunk arrives for that long.
+
+            Returns:
+            * The transfer status (int). PacketStatus.OK.value if all the data was
+              acknowledged, PacketStatus.TIMEOUT.value on a timeout, or the status
+              of the receiver if it aborted the transfer.
+            """
+        assert (endpoint >= 0 and endpoint <= MAX_USER_ENDPOINT)
+        assert (window >= 1)
+        assert (timeout > 0)
+        if not self.is_connected():
+            logger.error("Client not connected, ignoring bulk send")
+            return PacketStatus.NOT_CONNECTED.value
+        return await self.__bulk_channel.send(endpoint, data, window, timeout)
+
+    async def receive_bulk(self, endpoint: int) -> BulkTransfer:
+        """ Waits for the next incoming bulk transfer to the endpoint.
+
+            Args:
+            * endpoint: The endpoint (int [0-MAX_USER_ENDPOINT]) of the transfer.
+
+            Returns:
+            * A BulkTransfer from serial_packets.bulk, whose data chunks are read with
+              'async for', as they arrive.
+            """
+        assert (endpoint >= 0 and endpoint <= MAX_USER_ENDPOINT)
+        return await self.__bulk_channel.receive(endpoint)
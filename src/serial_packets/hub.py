@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import traceback
+
+from typing import Dict, List
+from .client import SerialPacketsClient, _WorkQueue
+from .stats import PacketsStats
+from .transports import PacketsTransport
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HUB_WORKERS_COUNT = 10
+
+
+class _HubClient:
+    """The hub's state of one of its clients."""
+
+    __slots__ = ("client", "work_queue", "scheduled", "busy_workers")
+
+    def __init__(self, client: SerialPacketsClient, work_queue: _WorkQueue):
+        self.client = client
+        self.work_queue = work_queue
+        # True if the client is in the hub's ready queue.
+        self.scheduled = False
+        # Number of hub workers that currently serve items of this client.
+        self.busy_workers = 0
+
+
+class SerialPacketsHub:
+    """Manages many SerialPacketsClients in a single event loop.
+
+    The clients of a hub have no worker tasks of their own. Instead, their incoming
+    packets and events are served by a shared pool of worker tasks, so the number
+    of tasks doesn't grow with the number of ports. Command timeouts of all the
+    clients are scheduled with the event loop's timers, with no per client tasks.
+
+    Clients with items to serve are served in a round robin order, one item at a
+    time, so a busy port can't starve the other ports.
+    """
+
+    def __init__(self, workers: int = DEFAULT_HUB_WORKERS_COUNT, max_client_workers: int = 0):
+        """
+        Constructs a hub. Should be called from within a running event loop.
+
+        Args:
+        * workers: An optional int with the number of shared worker tasks. Default
+          is DEFAULT_HUB_WORKERS_COUNT.
+        * max_client_workers: An optional int with the max number of workers that
+          can serve items of the same client at the same time, e.g. to prevent a
+          port with slow handlers from occupying all the workers. Default is 0
+          which means no limit.
+        """
+        assert (workers >= 1)
+        assert (max_client_workers >= 0)
+        self.__max_client_workers = max_client_workers
+        self.__hub_clients: List[_HubClient] = []
+        # Clients that have items to serve, in serving order.
+        self.__ready_clients: asyncio.Queue[_HubClient] = asyncio.Queue()
+        # Per https://stackoverflow.com/questions/71304329
+        self.__background_tasks = []
+        logger.debug("Creating [%d] hub workers tasks", workers)
+        for i in range(workers):
+            task = asyncio.create_task(self.__worker_task(), name=f"hub_task_{i+1:02d}")
+            self.__background_tasks.append(task)
+
+    def add_client(self, port: str | PacketsTransport, **kwargs) -> SerialPacketsClient:
+        """Creates a client that is served by the hub.
+
+        Args:
+        * port: The port of the client, as in SerialPacketsClient().
+        * kwargs: Other SerialPacketsClient() args, except for workers and hub.
+
+        Returns:
+        * A new client. As with other clients, call its connect() to open its port.
+        """
+        assert ("workers" not in kwargs and "hub" not in kwargs)
+        return SerialPacketsClient(port, hub=self, **kwargs)
+
+    def _attach(self, client: SerialPacketsClient, work_queue: _WorkQueue) -> None:
+        """Package private. Called by a new client of the hub."""
+        hub_client = _HubClient(client, work_queue)
+        self.__hub_clients.append(hub_client)
+        work_queue.set_on_ready(lambda: self.__schedule(hub_client))
+
+    def clients(self) -> List[SerialPacketsClient]:
+        """Returns the clients of the hub, in the order they were added."""
+        return [hub_client.client for hub_client in self.__hub_clients]
+
+    async def connect_all(self) -> List[bool]:
+        """Connects all the clients concurrently. Returns their connect() results, in
+        the order of clients()."""
+        return await asyncio.gather(*[client.connect() for client in self.clients()])
+
+    def stats(self) -> Dict[str, PacketsStats]:
+        """Returns a snapshot of the stats of each of the clients, keyed by the client's
+        port name. Duplicate port names are suffixed with #2, #3, etc."""
+        result = {}
+        for client in self.clients():
+            name = str(client)
+            key = name
+            n = 1
+            while key in result:
+                n += 1
+                key = f"{name}#{n}"
+            result[key] = client.stats()
+        return result
+
+    def __schedule(self, hub_client: _HubClient) -> None:
+        """Appends a client to the ready queue, if it has items that can be served now."""
+        if hub_client.scheduled or not hub_client.work_queue.has_ready():
+            return
+        if self.__max_client_workers and hub_client.busy_workers >= self.__max_client_workers:
+            return
+        hub_client.scheduled = True
+        self.__ready_clients.put_nowait(hub_client)
+
+    async def __worker_task(self):
+        """Body of the shared worker tasks."""
+        task_name = asyncio.current_task().get_name()
+        logger.debug("Task started '%s'", task_name)
+        while True:
+            hub_client = await self.__ready_clients.get()
+            hub_client.scheduled = False
+            # The client's items may have been dropped since it was scheduled.
+            if not hub_client.work_queue.has_ready():
+                continue
+            hub_client.busy_workers += 1
+            try:
+                work_item = hub_client.work_queue.get_nowait()
+                # If the client has more items, let other workers serve them after
+                # the clients that are already in the queue.
+                self.__schedule(hub_client)
+                await hub_client.client._serve_work_item(work_item)
+            except Exception as e:
+                logger.error("Task [%s] exception:", task_name)
+                traceback.print_exception(e)
+            finally:
+                hub_client.busy_workers -= 1
+                self.__schedule(hub_client)
@@ -2,17 +2,29 @@ from __future__ import annotations
 
 import logging
 import asyncio
-from PyCRC.CRCCCITT import CRCCCITT
-from typing import Optional
+import math
+import time
+from typing import Optional, List
 
+from . import _crc
 from ._packets import PacketType, PACKET_START_FLAG, PACKET_END_FLAG, PACKET_ESC, MIN_PACKET_LEN, MAX_PACKET_LEN
 from .packets import PacketData, MAX_DATA_LEN
 # from .packets import  PACKET_MAX_LEN
 
 logger = logging.getLogger(__name__)
 
+# Min interval in secs between decoder error log records.
+_ERROR_LOG_INTERVAL = 1.0
+
+# Packet type values, to avoid enum lookups per packet.
+_COMMAND = PacketType.COMMAND.value
+_RESPONSE = PacketType.RESPONSE.value
+_MESSAGE = PacketType.MESSAGE.value
+_LOG = PacketType.LOG.value
+
 
 class DecodedCommandPacket:
+    __slots__ = ("cmd_id", "endpoint", "data")
 
     def __init__(self, cmd_id: int, endpoint: int, data: PacketData):
         self.cmd_id: int = cmd_id
@@ -24,6 +36,7 @@ class DecodedCommandPacket:
 
 
 class DecodedResponsePacket:
+    __slots__ = ("cmd_id", "status", "data")
 
     def __init__(self, cmd_id: int, status: int, data: PacketData):
         self.cmd_id: int = cmd_id
@@ -35,6 +48,7 @@ class DecodedResponsePacket:
 
 
 class DecodedMessagePacket:
+    __slots__ = ("endpoint", "data")
 
     def __init__(self, endpoint: int, data: PacketData):
         self.endpoint: int = endpoint
@@ -45,6 +59,7 @@ class DecodedMessagePacket:
       
       
 class DecodedLogPacket:
+    __slots__ = ("data",)
 
     def __init__(self,  data: PacketData):
         self.data: PacketData = data
@@ -53,20 +68,123 @@ class DecodedLogPacket:
         return f"Log packet: {self.data.size()}"
 
 
+def _trimmed_data(frame: bytearray, data_start: int) -> PacketData:
+    """Returns a PacketData that owns the frame, trimmed to the data bytes
+    between the header and the two CRC bytes."""
+    del frame[-2:]
+    del frame[:data_start]
+    return PacketData._from_bytearray(frame)
+
+
 class PacketDecoder:
 
     def __init__(self):
         # assert (decoded_packet_callback is not None)
-        self.__crc_calc = CRCCCITT("FFFF")
         self.__packet_bfr = bytearray()
         self.__in_packet = False
         self.__pending_escape = False
         # Used to filter warnings before first packet.
         self.__encountered_start_flag = False
+        # Error counters, since the decoder was created.
+        self.__crc_errors = 0
+        self.__framing_errors = 0
+        self.__dropped_bytes = 0
+        # Errors logging is rate limited. After an error is logged, errors are
+        # counted and logged as a periodic summary.
+        self.__last_error_log_time = -math.inf
+        self.__error_log_pending = False
+        # A one shot timer that flushes the summary if no more data is received.
+        self.__error_log_timer: Optional[asyncio.TimerHandle] = None
+        # The (crc, framing, dropped bytes) counters when last logged.
+        self.__logged_error_counts = (0, 0, 0)
 
     def __str__(self):
         return f"In_packet ={self.__in_packet}, pending_escape={self.__pending_escape}, len={len(self.__packet_bytes)}"
 
+    def crc_errors(self) -> int:
+        """Returns the number of packets that were dropped due to a CRC error."""
+        return self.__crc_errors
+
+    def framing_errors(self) -> int:
+        """Returns the number of packets that were dropped due to framing errors,
+        such as invalid escaping, partial packets and invalid length or type."""
+        return self.__framing_errors
+
+    def dropped_bytes(self) -> int:
+        """Returns the number of bytes that were dropped outside of packets. Bytes
+        before the first packet start flag are not counted."""
+        return self.__dropped_bytes
+
+    def _start_mid_stream(self) -> None:
+        """Package private. Marks the stream as starting right after an end flag of
+        an earlier packet, rather than at the start of the communication, so leading
+        bytes before a start flag are counted as dropped."""
+        self.__encountered_start_flag = True
+
+    def __on_dropped_bytes(self, n: int) -> None:
+        self.__dropped_bytes += n
+        self.__log_error("Dropping %d bytes", n)
+
+    def __on_framing_error(self, msg: str, *args) -> None:
+        self.__framing_errors += 1
+        self.__log_error(msg, *args)
+
+    def __on_crc_error(self, msg: str, *args) -> None:
+        self.__crc_errors += 1
+        self.__log_error(msg, *args)
+
+    def __log_error(self, msg: str, *args) -> None:
+        """Logs an error that was already counted. If another error was logged in
+        the last _ERROR_LOG_INTERVAL secs, the error is included in the next summary
+        instead."""
+        now = time.monotonic()
+        if not self.__error_log_pending and now - self.__last_error_log_time >= _ERROR_LOG_INTERVAL:
+            logger.error(msg, *args)
+            self.__last_error_log_time = now
+            self.__logged_error_counts = (self.__crc_errors, self.__framing_errors,
+                                          self.__dropped_bytes)
+            return
+        self.__error_log_pending = True
+        self.__flush_error_log(now)
+        if self.__error_log_pending:
+            self.__schedule_error_log_flush(now)
+
+    def __schedule_error_log_flush(self, now: float) -> None:
+        """Schedules a flush of the error summary, in case the line goes quiet. Does
+        nothing if not running in an event loop."""
+        if self.__error_log_timer is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        delay = max(0, self.__last_error_log_time + _ERROR_LOG_INTERVAL - now)
+        self.__error_log_timer = loop.call_later(delay, self.__on_error_log_timer)
+
+    def __on_error_log_timer(self) -> None:
+        self.__error_log_timer = None
+        if self.__error_log_pending:
+            now = time.monotonic()
+            self.__flush_error_log(now)
+            if self.__error_log_pending:
+                self.__schedule_error_log_flush(now)
+
+    def __flush_error_log(self, now: float) -> None:
+        """Logs a summary of the errors that were not logged yet, if
+        _ERROR_LOG_INTERVAL secs passed since the last error log."""
+        elapsed = now - self.__last_error_log_time
+        if elapsed < _ERROR_LOG_INTERVAL:
+            return
+        crc_errors, framing_errors, dropped_bytes = self.__logged_error_counts
+        logger.error(
+            "Decoder errors in last %.1fs: dropped %d bytes, %d framing errors, %d CRC errors",
+            elapsed, self.__dropped_bytes - dropped_bytes, self.__framing_errors - framing_errors,
+            self.__crc_errors - crc_errors)
+        self.__last_error_log_time = now
+        self.__logged_error_counts = (self.__crc_errors, self.__framing_errors,
+                                      self.__dropped_bytes)
+        self.__error_log_pending = False
+
     def __reset_packet(self, in_packet: bool):
         self.__in_packet = in_packet
         self.__pending_escape = False
@@ -90,8 +208,8 @@ class PacketDecoder:
                 # happen in normal operation, except when connecting to 
                 # and on going communication.
                 if self.__encountered_start_flag:
-                  logger.error(f"Dropping byte {b:02x}")
-                pass
+                    self.__dropped_bytes += 1
+                    self.__log_error("Dropping byte %02x", b)
             return None
 
         # Here collecting packet bytes.
@@ -99,34 +217,34 @@ class PacketDecoder:
 
         if b == PACKET_START_FLAG:
             # Abort current packet and start a new one.
-            logger.error(
-                f"Dropping partial packet of size {len(self.__packet_bfr)}.")
+            self.__on_framing_error("Dropping partial packet of size %d.", len(self.__packet_bfr))
             self.__reset_packet(True)
             return None
 
         if b == PACKET_END_FLAG:
             # Process current packet.
             if self.__pending_escape:
-                logger.error("Packet has a pending escape, dropping.")
+                self.__on_framing_error("Packet has a pending escape, dropping.")
                 decoded_packet = None
             else:
                 # Returns None or a packet.
                 decoded_packet = self.__process_packet()
             self.__reset_packet(False)
+            if self.__error_log_pending:
+                self.__flush_error_log(time.monotonic())
             return decoded_packet
 
         # Check for size overrun. At this point, we know that the packet will
         # have at least one more additional byte, either normal or escaped.
         if len(self.__packet_bfr) >= MAX_PACKET_LEN:
-            logger.error("Packet is too long (%d), dropping",
-                         len(self.__packet_bfr))
+            self.__on_framing_error("Packet is too long (%d), dropping", len(self.__packet_bfr))
             self.__reset_packet(False)
             return None
 
         # Handle escape byte.
         if b == PACKET_ESC:
             if self.__pending_escape:
-                logger.error("Two consecutive escape chars, dropping packet")
+                self.__on_framing_error("Two consecutive escape chars, dropping packet")
                 self.__reset_packet(False)
             else:
                 self.__pending_escape = True
@@ -137,9 +255,7 @@ class PacketDecoder:
             # Flip back for 5x to 7x.
             b1 = b ^ 0x20
             if b1 != PACKET_START_FLAG and b1 != PACKET_END_FLAG and b1 != PACKET_ESC:
-                logger.error(
-                    f"Invalid escaped byte ({b1:02x}, {b:02x}), dropping packet"
-                )
+                self.__on_framing_error("Invalid escaped byte (%02x, %02x), dropping packet", b1, b)
                 self.__reset_packet(False)
             else:
                 self.__packet_bfr.append(b1)
@@ -149,6 +265,119 @@ class PacketDecoder:
         # Handle a normal byte
         self.__packet_bfr.append(b)
 
+    def receive_bytes(
+        self, data: bytes | bytearray
+    ) -> List[DecodedCommandPacket | DecodedResponsePacket | DecodedMessagePacket
+              | DecodedLogPacket]:
+        """Decodes a chunk of received bytes. Returns a list with zero or more
+        decoded packets, in the order they were received.
+
+        This is equivalent to calling receive_byte() for each of the bytes
+        but scans the chunk for flag and escape bytes rather than processing
+        one byte at a time.
+        """
+        result = []
+        n = len(data)
+        i = 0
+        while i < n:
+            # If not in a packet, skip to the next start flag.
+            if not self.__in_packet:
+                j = data.find(PACKET_START_FLAG, i)
+                stop = n if j < 0 else j
+                if stop > i and self.__encountered_start_flag:
+                    self.__on_dropped_bytes(stop - i)
+                if j < 0:
+                    break
+                self.__reset_packet(True)
+                self.__encountered_start_flag = True
+                i = j + 1
+                continue
+
+            # Here collecting packet bytes. Find the next flag, if any.
+            end_flag = data.find(PACKET_END_FLAG, i)
+            stop = n if end_flag < 0 else end_flag
+            start_flag = data.find(PACKET_START_FLAG, i, stop)
+            if start_flag >= 0:
+                stop = start_flag
+
+            # Process the packet bytes up to the flag. Returns the index
+            # to continue from or None if the entire segment was consumed.
+            i = self.__receive_segment(data, i, stop)
+            if i is not None:
+                continue
+
+            # Here the segment was consumed and we are still in a packet.
+            i = stop
+            if i >= n:
+                break
+            if data[i] == PACKET_START_FLAG:
+                # Abort current packet and start a new one.
+                self.__on_framing_error("Dropping partial packet of size %d.",
+                                        len(self.__packet_bfr))
+                self.__reset_packet(True)
+            else:
+                # Process current packet.
+                if self.__pending_escape:
+                    self.__on_framing_error("Packet has a pending escape, dropping.")
+                    decoded_packet = None
+                else:
+                    decoded_packet = self.__process_packet()
+                self.__reset_packet(False)
+                if decoded_packet:
+                    result.append(decoded_packet)
+            i += 1
+        if self.__error_log_pending:
+            self.__flush_error_log(time.monotonic())
+        return result
+
+    def __receive_segment(self, data: bytes | bytearray, start: int, stop: int) -> int | None:
+        """Appends to the packet the bytes data[start:stop] which contain no flag
+        bytes. Returns None if all bytes were consumed, or the index of the
+        next byte to process if the packet was dropped due to an error."""
+        bfr = self.__packet_bfr
+        i = start
+        while i < stop:
+            # Size overrun check. Same as in receive_byte(), it applies to any
+            # non flag byte, including escape bytes.
+            room = MAX_PACKET_LEN - len(bfr)
+            if self.__pending_escape:
+                if room <= 0:
+                    self.__on_framing_error("Packet is too long (%d), dropping", len(bfr))
+                    self.__reset_packet(False)
+                    return i + 1
+                b = data[i]
+                if b == PACKET_ESC:
+                    self.__on_framing_error("Two consecutive escape chars, dropping packet")
+                    self.__reset_packet(False)
+                    return i + 1
+                b1 = b ^ 0x20
+                if b1 != PACKET_START_FLAG and b1 != PACKET_END_FLAG and b1 != PACKET_ESC:
+                    self.__on_framing_error("Invalid escaped byte (%02x, %02x), dropping packet",
+                                            b1, b)
+                    self.__reset_packet(False)
+                    return i + 1
+                bfr.append(b1)
+                self.__pending_escape = False
+                i += 1
+                continue
+            # Copy a run of normal bytes, up to the next escape byte.
+            esc = data.find(PACKET_ESC, i, stop)
+            run_end = stop if esc < 0 else esc
+            if run_end - i > room:
+                self.__on_framing_error("Packet is too long (%d), dropping", MAX_PACKET_LEN)
+                self.__reset_packet(False)
+                return i + room + 1
+            bfr += data[i:run_end]
+            if esc < 0:
+                return None
+            if len(bfr) >= MAX_PACKET_LEN:
+                self.__on_framing_error("Packet is too long (%d), dropping", len(bfr))
+                self.__reset_packet(False)
+                return esc + 1
+            self.__pending_escape = True
+            i = esc + 1
+        return None
+
     def __process_packet(self):
         """Returns a packet or None."""
         rx_bfr = self.__packet_bfr
@@ -159,45 +388,57 @@ class PacketDecoder:
         # logger.info(f"Packet candidate: len={n}")
         # logger.info(f"Packet: {rx_bfr.hex(sep=' ')}")
         if n < MIN_PACKET_LEN:
-            logger.error("Packet too short (%d), dropping", n)
+            self.__on_framing_error("Packet too short (%d), dropping", n)
             return None
 
         # Check CRC
-        packet_crc = int.from_bytes(rx_bfr[-2:], byteorder='big', signed=False)
-        computed_crc = self.__crc_calc.calculate(bytes(rx_bfr[:-2]))
-        if computed_crc != packet_crc:
-            logger.error("Packet CRC error, packet: %04x vs computed: %04x, dropping", packet_crc,
-                         computed_crc)
+        # The CRC of the entire packet, including its big endian CRC bytes, is
+        # zero iff the CRC matches. This saves copying the packet bytes.
+        if _crc.crc16(rx_bfr) != 0:
+            packet_crc = int.from_bytes(rx_bfr[-2:], byteorder='big', signed=False)
+            computed_crc = _crc.crc16(rx_bfr[:-2])
+            self.__on_crc_error("Packet CRC error, packet: %04x vs computed: %04x, dropping",
+                                packet_crc, computed_crc)
             return None
 
-        # Construct decoded packet
+        # Determine the data offset.
         type_value = rx_bfr[0]
-        if type_value == PacketType.COMMAND.value:
+        if type_value == _COMMAND or type_value == _RESPONSE:
+            data_start = 6
+        elif type_value == _MESSAGE:
+            data_start = 2
+        elif type_value == _LOG:
+            data_start = 1
+        else:
+            self.__on_framing_error("Invalid packet type %02x, dropping packet", type_value)
+            return None
+
+        data_size = n - data_start - 2
+        if data_size > MAX_DATA_LEN:
+            self.__on_framing_error("Packet data too long (type=%d, len=%d), dropping",
+                                    type_value, data_size)
+            return None
+
+        # Construct decoded packet. The packet buffer is handed over to the packet
+        # data, trimmed in place to the data bytes, and the decoder starts a new
+        # one. Deleting the header from the start of a bytearray only advances
+        # its start, so no data bytes are copied.
+        self.__packet_bfr = bytearray()
+        if type_value == _COMMAND:
             cmd_id = int.from_bytes(rx_bfr[1:5], byteorder='big', signed=False)
             endpoint = rx_bfr[5]
-            data = PacketData().add_bytes(rx_bfr[6:-2])
-            decoded_packet = DecodedCommandPacket(cmd_id, endpoint, data)
-        elif type_value == PacketType.RESPONSE.value:
+            decoded_packet = DecodedCommandPacket(cmd_id, endpoint,
+                                                  _trimmed_data(rx_bfr, data_start))
+        elif type_value == _RESPONSE:
             cmd_id = int.from_bytes(rx_bfr[1:5], byteorder='big', signed=False)
             status = rx_bfr[5]
-            data = PacketData().add_bytes(rx_bfr[6:-2])
-            decoded_packet = DecodedResponsePacket(cmd_id, status, data)
-        elif type_value == PacketType.MESSAGE.value:
+            decoded_packet = DecodedResponsePacket(cmd_id, status,
+                                                   _trimmed_data(rx_bfr, data_start))
+        elif type_value == _MESSAGE:
             endpoint = rx_bfr[1]
-            data = PacketData().add_bytes(rx_bfr[2:-2])
-            decoded_packet = DecodedMessagePacket(endpoint, data)
-        elif type_value == PacketType.LOG.value:
-            data = PacketData().add_bytes(rx_bfr[1:-2])
-            decoded_packet = DecodedLogPacket(data)
+            decoded_packet = DecodedMessagePacket(endpoint, _trimmed_data(rx_bfr, data_start))
         else:
-            logger.error("Invalid packet type %02x, dropping packet",
-                         type_value)
-            return None
-
-        if data.size() > MAX_DATA_LEN:
-            logger.error("Packet data too long (type=%d, len=%d), dropping",
-                         type_value, data.size())
-            return None
+            decoded_packet = DecodedLogPacket(_trimmed_data(rx_bfr, data_start))
 
         # A new packet is available.
         # logger.info("A packet is available.")
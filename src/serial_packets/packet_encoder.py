@@ -1,102 +1,154 @@
 from __future__ import annotations
 
 import logging
+import struct
 import time
 
-from PyCRC.CRCCCITT import CRCCCITT
-from ._packets import PacketType, PACKET_START_FLAG, PACKET_END_FLAG, PACKET_ESC, MAX_DATA_LEN, MAX_PACKET_LEN
+from . import _crc
+from ._packets import PacketType, PACKET_START_FLAG, PACKET_END_FLAG, PACKET_ESC, MAX_DATA_LEN, MAX_PACKET_LEN, MAX_ENCODED_PACKET_LEN
 
 logger = logging.getLogger(__name__)
 
+# Byte sequences for byte stuffing.
+_START_FLAG_BYTES = bytes([PACKET_START_FLAG])
+_ESC_BYTES = bytes([PACKET_ESC])
+_END_FLAG_BYTES = bytes([PACKET_END_FLAG])
+_ESCAPED_START_FLAG_BYTES = bytes([PACKET_ESC, PACKET_START_FLAG ^ 0x20])
+_ESCAPED_ESC_BYTES = bytes([PACKET_ESC, PACKET_ESC ^ 0x20])
+_ESCAPED_END_FLAG_BYTES = bytes([PACKET_ESC, PACKET_END_FLAG ^ 0x20])
+
+# Packet headers, before the data bytes.
+_COMMAND_HEADER = struct.Struct(">BIB")
+_RESPONSE_HEADER = struct.Struct(">BIB")
+_MESSAGE_HEADER = struct.Struct(">BB")
+_LOG_HEADER = struct.Struct(">B")
+_CRC = struct.Struct(">H")
+
 
 class PacketEncoder:
 
     def __init__(self):
         # self.__last_packet_time = 0
-        self.__crc_calc = CRCCCITT("FFFF")
+        # Reusable buffers for the packet before byte stuffing and for
+        # the encoded packet.
+        self.__packet_bfr = bytearray(MAX_PACKET_LEN)
+        self.__packet_view = memoryview(self.__packet_bfr)
+        self.__encoded_bfr = bytearray(MAX_ENCODED_PACKET_LEN)
+
+    def __finish_packet(self, n: int) -> memoryview:
+        """Appends the CRC to the first n bytes of the packet buffer. Returns
+        a view of the packet bytes."""
+        view = self.__packet_view
+        _CRC.pack_into(self.__packet_bfr, n, _crc.crc16(view[:n]))
+        return view[:n + 2]
 
     def __construct_command_packet(self, cmd_id: int, endpoint: int, data: bytearray):
-        """Constructs a command packet, before byte stuffing"""
-        packet = bytearray()
-        packet.append(PacketType.COMMAND.value)
-        packet.extend(cmd_id.to_bytes(4, 'big'))
-        packet.append(endpoint)
-        packet.extend(data)
-        crc = self.__crc_calc.calculate(bytes(packet))
-        packet.extend(crc.to_bytes(2, 'big'))
-        assert (len(packet) <= MAX_PACKET_LEN)
-        return packet
+        """Constructs a command packet in the packet buffer, before byte stuffing"""
+        assert (len(data) <= MAX_DATA_LEN)
+        n = _COMMAND_HEADER.size
+        _COMMAND_HEADER.pack_into(self.__packet_bfr, 0, PacketType.COMMAND.value, cmd_id, endpoint)
+        self.__packet_bfr[n:n + len(data)] = data
+        return self.__finish_packet(n + len(data))
 
     def __construct_response_packet(self, cmd_id: int, status: int, data: bytearray):
-        """Constructs a response packet, before byte stuffing"""
-        packet = bytearray()
-        packet.append(PacketType.RESPONSE.value)
-        packet.extend(cmd_id.to_bytes(4, 'big'))
-        packet.append(status)
-        packet.extend(data)
-        crc = self.__crc_calc.calculate(bytes(packet))
-        packet.extend(crc.to_bytes(2, 'big'))
-        assert (len(packet) <= MAX_PACKET_LEN)
-        return packet
+        """Constructs a response packet in the packet buffer, before byte stuffing"""
+        assert (len(data) <= MAX_DATA_LEN)
+        n = _RESPONSE_HEADER.size
+        _RESPONSE_HEADER.pack_into(self.__packet_bfr, 0, PacketType.RESPONSE.value, cmd_id, status)
+        self.__packet_bfr[n:n + len(data)] = data
+        return self.__finish_packet(n + len(data))
 
     def __construct_message_packet(self, endpoint: int, data: bytearray):
-        """Constructs a message packet, before byte stuffing"""
-        packet = bytearray()
-        packet.append(PacketType.MESSAGE.value)
-        packet.append(endpoint)
-        packet.extend(data)
-        crc = self.__crc_calc.calculate(bytes(packet))
-        packet.extend(crc.to_bytes(2, 'big'))
-        assert (len(packet) <= MAX_PACKET_LEN)
-        return packet
-      
-    def __construct_log_packet(self,  data: bytearray):
-        """Constructs a log packet, before byte stuffing"""
-        packet = bytearray()
-        packet.append(PacketType.LOG.value)
-        packet.extend(data)
-        crc = self.__crc_calc.calculate(bytes(packet))
-        packet.extend(crc.to_bytes(2, 'big'))
-        assert (len(packet) <= MAX_PACKET_LEN)
-        return packet
-
-    def __byte_stuffing(self, packet: bytearray):
-        """Byte stuff the packet using HDLC format. Also adds packet flag(s)"""
-        result = bytearray()
-        result.append(PACKET_START_FLAG)
-        for byte in packet:
-            if byte == PACKET_START_FLAG or byte == PACKET_END_FLAG or byte == PACKET_ESC:
-                result.append(PACKET_ESC)
-                result.append(byte ^ 0x20)
-            else:
-                result.append(byte)
-        result.append(PACKET_END_FLAG)
-        return result
+        """Constructs a message packet in the packet buffer, before byte stuffing"""
+        assert (len(data) <= MAX_DATA_LEN)
+        n = _MESSAGE_HEADER.size
+        _MESSAGE_HEADER.pack_into(self.__packet_bfr, 0, PacketType.MESSAGE.value, endpoint)
+        self.__packet_bfr[n:n + len(data)] = data
+        return self.__finish_packet(n + len(data))
 
-    def encode_command_packet(self, cmd_id: int, endpoint: int, data: bytearray):
-        """Returns the command packet in wire format"""
+    def __construct_log_packet(self, data: bytearray):
+        """Constructs a log packet in the packet buffer, before byte stuffing"""
         assert (len(data) <= MAX_DATA_LEN)
+        n = _LOG_HEADER.size
+        _LOG_HEADER.pack_into(self.__packet_bfr, 0, PacketType.LOG.value)
+        self.__packet_bfr[n:n + len(data)] = data
+        return self.__finish_packet(n + len(data))
+
+    def __byte_stuffing_into(self, out: bytearray | memoryview, packet: bytearray, n: int) -> int:
+        """Byte stuff the first n bytes of packet into out using HDLC format. Also adds
+        packet flag(s). Returns the number of bytes written to out."""
+        if (packet.find(PACKET_START_FLAG, 0, n) < 0 and packet.find(PACKET_ESC, 0, n) < 0
+                and packet.find(PACKET_END_FLAG, 0, n) < 0):
+            # Fast path, nothing to escape.
+            if n + 2 > len(out):
+                raise ValueError(f"Output buffer too small ({len(out)} < {n + 2})")
+            with memoryview(packet) as view:
+                out[1:n + 1] = view[:n]
+            end = n + 1
+        else:
+            # Escape bytes must be escaped first.
+            escaped = packet[:n].replace(_ESC_BYTES, _ESCAPED_ESC_BYTES)
+            escaped = escaped.replace(_START_FLAG_BYTES, _ESCAPED_START_FLAG_BYTES)
+            escaped = escaped.replace(_END_FLAG_BYTES, _ESCAPED_END_FLAG_BYTES)
+            end = len(escaped) + 1
+            if end + 1 > len(out):
+                raise ValueError(f"Output buffer too small ({len(out)} < {end + 1})")
+            out[1:end] = escaped
+        out[0] = PACKET_START_FLAG
+        out[end] = PACKET_END_FLAG
+        return end + 1
+
+    def __stuff_packet_into(self, out: bytearray | memoryview, packet: memoryview) -> int:
+        """Byte stuff a packet that was constructed in the packet buffer."""
+        return self.__byte_stuffing_into(out, self.__packet_bfr, len(packet))
+
+    def encode_command_packet_into(self, out: bytearray | memoryview, cmd_id: int, endpoint: int,
+                                   data: bytearray) -> int:
+        """Writes the command packet in wire format to the beginning of out. Returns
+        the number of bytes written. A buffer of size MAX_ENCODED_PACKET_LEN
+        is always sufficient."""
         packet = self.__construct_command_packet(cmd_id, endpoint, data)
-        stuffed_packet = self.__byte_stuffing(packet)
-        return stuffed_packet
+        return self.__stuff_packet_into(out, packet)
+
+    def encode_response_packet_into(self, out: bytearray | memoryview, cmd_id: int, status: int,
+                                    data: bytearray) -> int:
+        """Writes the response packet in wire format to the beginning of out. Returns
+        the number of bytes written. A buffer of size MAX_ENCODED_PACKET_LEN
+        is always sufficient."""
+        packet = self.__construct_response_packet(cmd_id, status, data)
+        return self.__stuff_packet_into(out, packet)
+
+    def encode_message_packet_into(self, out: bytearray | memoryview, endpoint: int,
+                                   data: bytearray) -> int:
+        """Writes the message packet in wire format to the beginning of out. Returns
+        the number of bytes written. A buffer of size MAX_ENCODED_PACKET_LEN
+        is always sufficient."""
+        packet = self.__construct_message_packet(endpoint, data)
+        return self.__stuff_packet_into(out, packet)
+
+    def encode_log_packet_into(self, out: bytearray | memoryview, data: bytearray) -> int:
+        """Writes the log packet in wire format to the beginning of out. Returns
+        the number of bytes written. A buffer of size MAX_ENCODED_PACKET_LEN
+        is always sufficient."""
+        packet = self.__construct_log_packet(data)
+        return self.__stuff_packet_into(out, packet)
+
+    def encode_command_packet(self, cmd_id: int, endpoint: int, data: bytearray):
+        """Returns the command packet in wire format"""
+        n = self.encode_command_packet_into(self.__encoded_bfr, cmd_id, endpoint, data)
+        return self.__encoded_bfr[:n]
 
     def encode_response_packet(self, cmd_id: int, status: int, data: bytearray):
         """Returns the packet in wire format."""
-        assert (len(data) <= MAX_DATA_LEN)
-        packet = self.__construct_response_packet(cmd_id, status, data)
-        stuffed_packet = self.__byte_stuffing(packet)
-        return stuffed_packet
+        n = self.encode_response_packet_into(self.__encoded_bfr, cmd_id, status, data)
+        return self.__encoded_bfr[:n]
 
     def encode_message_packet(self, endpoint: int, data: bytearray):
         """Returns the message packet in wire format"""
-        assert (len(data) <= MAX_DATA_LEN)
-        packet = self.__construct_message_packet(endpoint, data)
-        stuffed_packet = self.__byte_stuffing(packet)
-        return stuffed_packet
-      
-    def encode_log_packet(self,  data: bytearray):
+        n = self.encode_message_packet_into(self.__encoded_bfr, endpoint, data)
+        return self.__encoded_bfr[:n]
+
+    def encode_log_packet(self, data: bytearray):
         """Returns the log packet in wire format"""
-        assert (len(data) <= MAX_DATA_LEN)
-        packet = self.__construct_log_packet(data)
-        stuffed_packet = self.__byte_stuffing(packet)
-        return stuffed_packet
+        n = self.encode_log_packet_into(self.__encoded_bfr, data)
+        return self.__encoded_bfr[:n]
@@ -1,6 +1,13 @@
 from __future__ import annotations
 
+import array
+import random
+import struct
+import sys
+
 from enum import Enum
+from functools import lru_cache
+from typing import Iterable, Tuple
 
 # Max size of data that is sent in a command request, command response,
 # or in a message. This is the original size in bytes before byte stuffing.
@@ -15,10 +22,47 @@ MAX_RX_WORKER_COUNT = 20
 DEFAULT_RX_WORKER_COUNT = 5
 
 
+# Array typecodes supported by PacketData arrays. These typecodes have the
+# same meaning in the array and struct modules and in numpy.
+_ARRAY_TYPECODES = "bBhHiIqQfd"
+
+
+@lru_cache(maxsize=256)
+def _compiled_struct(fmt: str) -> struct.Struct:
+    """Returns a cached struct for the given format. Formats with no explicit
+    byte order are big endian. The cache is bounded since formats may be
+    constructed at run time."""
+    if fmt[:1] not in "@=<>!":
+        fmt = ">" + fmt
+    return struct.Struct(fmt)
+
+
+def _array_item_size(typecode: str) -> int:
+    """Returns the wire size of a PacketData array item."""
+    assert (len(typecode) == 1 and typecode in _ARRAY_TYPECODES), typecode
+    return _compiled_struct(typecode).size
+
+
 class PacketsEventType(Enum):
     """Event type."""
     CONNECTED = 1
     DISCONNECTED = 2
+    # Incoming packets were dropped due to a full work queue.
+    PACKETS_DROPPED = 3
+
+
+class QueueOverflowPolicy(Enum):
+    """What to do with an incoming packet when the work queue is full."""
+    # Drop the oldest queued packet to make room for the new one.
+    DROP_OLDEST = 1
+    # Drop the new packet.
+    DROP_NEWEST = 2
+    # Queue the packet and pause reading from the port until the
+    # queue drains to half of its max size.
+    PAUSE_READING = 3
+    # Replace a queued message of the same endpoint with the new one,
+    # otherwise drop the new packet.
+    COALESCE = 4
 
 
 class PacketsEvent:
@@ -56,8 +100,60 @@ class PacketStatus(Enum):
     USER_ERRORS_BASE = 100
 
 
+class RetryPolicy:
+    """When and how outgoing commands are resent after they failed.
+
+    Use it only with idempotent commands. A command that timed out may still have
+    been executed by the receiver, and resending it executes it again.
+    """
+
+    def __init__(self,
+                 retries: int = 3,
+                 backoff: float = 0.1,
+                 max_backoff: float = 2.0,
+                 multiplier: float = 2.0,
+                 jitter: float = 0.5,
+                 statuses: Iterable[int] = (PacketStatus.TIMEOUT.value,)):
+        """Constructs a retry policy.
+
+        Args:
+        * retries: The max number of times a command is resent.
+        * backoff: The delay in secs before the first resend.
+        * max_backoff: The max delay in secs before a resend.
+        * multiplier: The factor by which the delay grows with each resend.
+        * jitter: The fraction [0, 1] of the delay that is randomized, to spread
+          the resends of commands that failed together.
+        * statuses: The command statuses that trigger a resend.
+        """
+        assert (retries >= 0)
+        assert (backoff >= 0 and max_backoff >= backoff)
+        assert (multiplier >= 1)
+        assert (jitter >= 0 and jitter <= 1)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.statuses = frozenset(statuses)
+
+    def should_retry(self, status: int, retry: int) -> bool:
+        """Tests if a command that failed with the given status should be resent.
+        Retry is the number of the resend, starting from 1."""
+        return retry <= self.retries and status in self.statuses
+
+    def delay(self, retry: int) -> float:
+        """Returns the delay in secs before the given resend, starting from 1."""
+        delay = min(self.backoff * self.multiplier**(retry - 1), self.max_backoff)
+        return delay * (1 - self.jitter * random.random())
+
+
 class PacketData:
-    """Packet data buffer, with methods to serialize/deserialize the data."""
+    """Packet data buffer, with methods to serialize/deserialize the data.
+    
+    The data is stored in a bytearray, which for decoded packets is the received
+    frame buffer, with no additional copy.
+    """
+    __slots__ = ("__data", "__bytes_read", "__read_error")
 
     def __init__(self):
         """ Constructs a PacketData with given initial data."""
@@ -65,6 +161,15 @@ class PacketData:
         self.__bytes_read: int = 0
         self.__read_error: bool = False
 
+    @classmethod
+    def _from_bytearray(cls, data: bytearray) -> PacketData:
+        """Package private. Returns a PacketData that takes ownership of the given
+        bytearray, without copying the data. The caller should not use it after
+        this call."""
+        result = cls()
+        result.__data = data
+        return result
+
     def hex_str(self, max_bytes=None) -> str:
         """Returns a string with a hex dump fo the bytes. Can be long."""
         if (max_bytes is None) or (self.size() <= max_bytes):
@@ -74,10 +179,10 @@ class PacketData:
 
     def data_bytes(self) -> bytearray:
         """Return a copy of the data bytes."""
-        return self.__data.copy()
+        return bytearray(self.__data)
 
     def _internal_bytes_buffer(self) -> bytearray:
-        """Package private. Returns a reference to the internal bytearray. Do not mutate."""
+        """Package private. Returns a reference to the internal data bytes. Do not mutate."""
         return self.__data
 
     def size(self) -> int:
@@ -86,7 +191,7 @@ class PacketData:
 
     def clear(self) -> None:
         """Clear all data bytes and reset read location."""
-        self.__data.clear()
+        self.__data = bytearray()
         self.__bytes_read = 0
         self.__read_error = False
 
@@ -145,6 +250,36 @@ class PacketData:
         self.__data.extend(bytes)
         return self
 
+    def add_str(self, s: str) -> PacketData:
+        """Appends a string as a length byte followed by its utf-8 bytes, in 
+        the format read_str() expects. Asserts that the length is at most 255."""
+        str_bytes = s.encode("utf-8")
+        assert (len(str_bytes) <= 0xff)
+        self.__data.append(len(str_bytes))
+        self.__data.extend(str_bytes)
+        return self
+
+    def add_struct(self, fmt: str, *vals) -> PacketData:
+        """Appends the values, packed with the given struct format. The format
+        is big endian unless it specifies a byte order."""
+        self.__data.extend(_compiled_struct(fmt).pack(*vals))
+        return self
+
+    def add_array(self, typecode: str, vals: Iterable) -> PacketData:
+        """Appends the values as an array of big endian items. typecode is one
+        of the array module typecodes 'bBhHiIqQfd'. vals can be any iterable,
+        including an array.array and a numpy array."""
+        _array_item_size(typecode)
+        if hasattr(vals, "dtype"):
+            # A numpy array.
+            self.__data.extend(vals.astype(">" + typecode).tobytes())
+            return self
+        items = array.array(typecode, vals)
+        if sys.byteorder == "little":
+            items.byteswap()
+        self.__data.extend(items.tobytes())
+        return self
+
     #  --- Parsing data
 
     def __read_int(self, num_bytes: int, signed: bool) -> int | None:
@@ -197,6 +332,41 @@ class PacketData:
         self.__bytes_read += n
         return result
 
+    def read_struct(self, fmt: str) -> Tuple | None:
+        """Returns a tuple with the next values, unpacked with the given struct
+        format, or None if insufficient number of bytes. The format is big endian 
+        unless it specifies a byte order."""
+        s = _compiled_struct(fmt)
+        if self.__read_error or self.__bytes_read + s.size > len(self.__data):
+            self.__read_error = True
+            return None
+        result = s.unpack_from(self.__data, self.__bytes_read)
+        self.__bytes_read += s.size
+        return result
+
+    def read_array(self, typecode: str, count: int, as_numpy: bool = False):
+        """Returns the next count big endian array items, or None if insufficient 
+        number of bytes. typecode is one of the array module typecodes 'bBhHiIqQfd'.
+        Returns an array.array, or a numpy array if as_numpy is True, in which
+        case numpy must be installed."""
+        assert (count >= 0)
+        n = _array_item_size(typecode) * count
+        if self.__read_error or self.__bytes_read + n > len(self.__data):
+            self.__read_error = True
+            return None
+        raw = self.__data[self.__bytes_read:self.__bytes_read + n]
+        if as_numpy:
+            import numpy
+            # Convert to a native byte order copy that doesn't reference our data.
+            result = numpy.frombuffer(raw, dtype=">" + typecode).astype(typecode)
+        else:
+            result = array.array(typecode)
+            result.frombytes(raw)
+            if sys.byteorder == "little":
+                result.byteswap()
+        self.__bytes_read += n
+        return result
+
     def read_str(self) -> str | None:
         """Returns the next string or null if read error."""
         if self.__read_error or self.__bytes_read + 1 > len(self.__data):
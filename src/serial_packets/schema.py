@@ -0,0 +1,249 @@
+from __future__ import annotations
+
+import array
+
+from typing import Dict, List, Optional, Tuple, Type, TypeVar
+from .packets import PacketData, _array_item_size
+
+# Declarative schemas of packet data.
+#
+# A schema is a subclass of PacketSchema with the fields listed as class
+# attributes, in wire order:
+#
+#   class SensorReport(PacketSchema):
+#       sensor_id = Uint8()
+#       voltage = Uint16()
+#       name = Str()
+#       samples = Array("H", 16)
+#
+#   report = SensorReport(sensor_id=3, voltage=3300, name="s3", samples=[0] * 16)
+#   data = report.encode()
+#   ...
+#   report = SensorReport.decode(data)
+#
+# The schema is compiled once, when the class is defined, and each run of
+# consecutive fixed size fields is encoded and decoded with a single struct
+# pack or unpack call.
+
+T = TypeVar("T", bound="PacketSchema")
+
+
+class SchemaField:
+    """Base class of the schema fields."""
+    # Struct format of fixed size fields, or None for variable size fields.
+    fmt: Optional[str] = None
+
+
+class Uint8(SchemaField):
+    """An unsigned int, encoded as 1 byte."""
+    fmt = "B"
+
+
+class Uint16(SchemaField):
+    """An unsigned int, encoded as 2 bytes big endian."""
+    fmt = "H"
+
+
+class Uint32(SchemaField):
+    """An unsigned int, encoded as 4 bytes big endian."""
+    fmt = "I"
+
+
+class Int8(SchemaField):
+    """A signed int, encoded as 1 byte."""
+    fmt = "b"
+
+
+class Int16(SchemaField):
+    """A signed int, encoded as 2 bytes big endian."""
+    fmt = "h"
+
+
+class Int32(SchemaField):
+    """A signed int, encoded as 4 bytes big endian."""
+    fmt = "i"
+
+
+class Str(SchemaField):
+    """A str, encoded as with PacketData.add_str()."""
+
+
+class Bytes(SchemaField):
+    """A bytes value with a fixed size, or if size is None, all the remaining
+    data bytes, in which case it must be the last field. Decoded as bytes."""
+
+    def __init__(self, size: Optional[int] = None):
+        assert (size is None or size >= 0)
+        self.size = size
+        self.fmt = None if size is None else f"{size}s"
+
+
+class Array(SchemaField):
+    """An array.array of big endian items with a fixed count, or if count is None,
+    all the remaining data, in which case it must be the last field. typecode is
+    one of the array typecodes 'bBhHiIqQfd'."""
+
+    def __init__(self, typecode: str, count: Optional[int] = None):
+        _array_item_size(typecode)
+        assert (count is None or count >= 0)
+        self.typecode = typecode
+        self.count = count
+        self.fmt = None if count is None else f"{count}{typecode}"
+
+
+class _StructStep:
+    """A compiled run of consecutive fixed size fields."""
+
+    def __init__(self, fields: List[Tuple[str, SchemaField]]):
+        self.fmt = ">" + "".join(field.fmt for _, field in fields)
+        self.names = tuple(name for name, _ in fields)
+        # (name, typecode, count) of the fields, where typecode is None
+        # for fields with a single value.
+        self.layout = tuple((name, field.typecode, field.count) if isinstance(field, Array) else
+                            (name, None, 1) for name, field in fields)
+        self.has_arrays = any(isinstance(field, Array) for _, field in fields)
+        # (name, size) of the fixed size bytes fields, which struct would silently
+        # pad or truncate.
+        self.bytes_sizes = tuple(
+            (name, field.size) for name, field in fields if isinstance(field, Bytes))
+
+    def encode(self, obj: PacketSchema, data: PacketData) -> None:
+        for name, size in self.bytes_sizes:
+            assert (len(getattr(obj, name)) == size), name
+        if not self.has_arrays:
+            data.add_struct(self.fmt, *[getattr(obj, name) for name in self.names])
+            return
+        vals = []
+        for name, typecode, _ in self.layout:
+            if typecode is None:
+                vals.append(getattr(obj, name))
+            else:
+                vals.extend(getattr(obj, name))
+        data.add_struct(self.fmt, *vals)
+
+    def decode(self, obj: PacketSchema, data: PacketData) -> bool:
+        vals = data.read_struct(self.fmt)
+        if vals is None:
+            return False
+        if not self.has_arrays:
+            obj.__dict__.update(zip(self.names, vals))
+            return True
+        i = 0
+        for name, typecode, count in self.layout:
+            if typecode is None:
+                setattr(obj, name, vals[i])
+            else:
+                setattr(obj, name, array.array(typecode, vals[i:i + count]))
+            i += count
+        return True
+
+
+class _FieldStep:
+    """A compiled variable size field."""
+
+    def __init__(self, name: str, field: SchemaField):
+        self.name = name
+        self.field = field
+
+    def encode(self, obj: PacketSchema, data: PacketData) -> None:
+        val = getattr(obj, self.name)
+        if isinstance(self.field, Str):
+            data.add_str(val)
+        elif isinstance(self.field, Bytes):
+            data.add_bytes(val)
+        else:
+            data.add_array(self.field.typecode, val)
+
+    def decode(self, obj: PacketSchema, data: PacketData) -> bool:
+        if isinstance(self.field, Str):
+            val = data.read_str()
+        elif isinstance(self.field, Bytes):
+            # Decoded as bytes, the same as fixed size bytes.
+            val = data.read_bytes(data.bytes_left_to_read())
+            if val is not None:
+                val = bytes(val)
+        else:
+            item_size = _array_item_size(self.field.typecode)
+            val = data.read_array(self.field.typecode, data.bytes_left_to_read() // item_size)
+        if val is None:
+            return False
+        setattr(obj, self.name, val)
+        return True
+
+
+class PacketSchema:
+    """Base class of packet data schemas. See the example at the top of this file."""
+
+    # The fields of the schema, in wire order. Set when a subclass is defined.
+    _fields: Tuple[Tuple[str, SchemaField], ...] = ()
+    _steps: Tuple[_StructStep | _FieldStep, ...] = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        fields = list(cls._fields)
+        for name, val in list(cls.__dict__.items()):
+            if isinstance(val, SchemaField):
+                fields.append((name, val))
+                # Allow the instances to have an attribute with this name.
+                delattr(cls, name)
+        cls._fields = tuple(fields)
+        cls._steps = tuple(cls.__compile(fields))
+
+    @staticmethod
+    def __compile(fields: List[Tuple[str, SchemaField]]) -> List[_StructStep | _FieldStep]:
+        """Returns the encoding/decoding steps of the given fields."""
+        steps = []
+        run = []
+        for i, (name, field) in enumerate(fields):
+            if field.fmt is not None:
+                run.append((name, field))
+                continue
+            # Fields that consume all the remaining data must be last.
+            assert (isinstance(field, Str) or i == len(fields) - 1), name
+            if run:
+                steps.append(_StructStep(run))
+                run = []
+            steps.append(_FieldStep(name, field))
+        if run:
+            steps.append(_StructStep(run))
+        return steps
+
+    def __init__(self, *args, **kwargs):
+        """Constructs a schema object with the values of all of its fields, 
+        positional in wire order, or by name."""
+        names = [name for name, _ in self._fields]
+        assert (len(args) <= len(names))
+        vals = dict(zip(names, args))
+        for name, val in kwargs.items():
+            assert (name in names and name not in vals), name
+            vals[name] = val
+        assert (len(vals) == len(names)), f"Missing fields: {set(names) - set(vals)}"
+        for name in names:
+            setattr(self, name, vals[name])
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and self.__dict__ == other.__dict__
+
+    def __repr__(self) -> str:
+        vals = ", ".join(f"{name}={getattr(self, name)!r}" for name, _ in self._fields)
+        return f"{type(self).__name__}({vals})"
+
+    def encode(self, data: Optional[PacketData] = None) -> PacketData:
+        """Appends the fields to data, or to a new PacketData if None. Returns the data."""
+        if data is None:
+            data = PacketData()
+        for step in self._steps:
+            step.encode(self, data)
+        return data
+
+    @classmethod
+    def decode(cls: Type[T], data: PacketData, all_read: bool = True) -> T | None:
+        """Reads the fields from data and returns a new object, or None if a read error
+        occurred or, if all_read is True, if data has unread bytes left."""
+        obj = cls.__new__(cls)
+        for step in cls._steps:
+            if not step.decode(obj, data):
+                return None
+        if all_read and not data.all_read_ok():
+            return None
+        return obj
@@ -0,0 +1,522 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import pickle
+import socket
+import struct
+import traceback
+
+from typing import Callable, Dict, List, Optional, Tuple
+from ._packets import DEFAULT_CMD_TIMEOUT, MIN_CMD_TIMEOUT, MAX_CMD_TIMEOUT
+from .client import SerialPacketsClient
+from .hub import SerialPacketsHub, DEFAULT_HUB_WORKERS_COUNT
+from .packets import PacketData, PacketStatus, PacketsEvent, PacketsEventType, MAX_DATA_LEN, MAX_USER_ENDPOINT
+from .stats import PacketsStats
+from .transports import PacketsTransport
+
+logger = logging.getLogger(__name__)
+
+# The IPC channel between the supervisor and each of its child processes is a
+# stream socket. Records are sent in batches, with a single write per event loop
+# iteration. A batch is a 4 bytes big endian length followed by the records, and
+# each record is a 4 bytes length followed by a record type byte and its fields.
+# The async senders wait while the socket's write buffer is above its high-water
+# mark, so a slow reader slows them down rather than growing the buffer.
+
+# Child to parent records.
+_REC_MESSAGE = 1  # port (H), endpoint (B), data.
+_REC_COMMAND = 2  # port (H), request id (I), endpoint (B), data.
+_REC_EVENT = 3  # port (H), event type (B), utf8 description.
+_REC_READY = 4  # A connect() result byte per port.
+_REC_STATS = 5  # request id (I), pickled list of the ports PacketsStats.
+# Parent to child records.
+_REC_SEND_COMMAND = 6  # port (H), request id (I), endpoint (B), timeout (d), data.
+_REC_SEND_MESSAGE = 7  # port (H), endpoint (B), data.
+_REC_STATS_REQUEST = 8  # request id (I).
+_REC_STOP = 9
+# A command result, in both directions.
+_REC_RESPONSE = 10  # request id (I), status (B), data.
+
+_LEN = struct.Struct(">I")
+_PORT_ENDPOINT = struct.Struct(">BHB")
+_PORT_ID_ENDPOINT = struct.Struct(">BHIB")
+_SEND_COMMAND = struct.Struct(">BHIBd")
+_ID = struct.Struct(">BI")
+_RESPONSE = struct.Struct(">BIB")
+
+# Max wait in secs of a child for the parent to respond to an incoming command.
+_PARENT_RESPONSE_TIMEOUT = MAX_CMD_TIMEOUT
+# Max wait in secs for a child process to exit after a stop request.
+_STOP_TIMEOUT = 5.0
+
+
+class _Channel:
+    """A channel of batched records over a stream socket."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.__reader = reader
+        self.__writer = writer
+        # Records that wait for the next batch write, after room for the batch length.
+        self.__pending = bytearray(_LEN.size)
+
+    def send(self, header: bytes, payload=b"") -> None:
+        """Queues a record for the next batch write."""
+        if len(self.__pending) == _LEN.size:
+            asyncio.get_running_loop().call_soon(self.__flush)
+        self.__pending += _LEN.pack(len(header) + len(payload))
+        self.__pending += header
+        self.__pending += payload
+
+    def __flush(self) -> None:
+        pending = self.__pending
+        self.__pending = bytearray(_LEN.size)
+        n = len(pending) - _LEN.size
+        if self.__writer.is_closing():
+            logger.error("Channel closed, dropping %d bytes", n)
+            return
+        _LEN.pack_into(pending, 0, n)
+        self.__writer.write(pending)
+
+    async def drain(self) -> None:
+        """Waits while the socket's write buffer is above its high-water mark."""
+        try:
+            await self.__writer.drain()
+        except ConnectionError:
+            # The reader finds out that the channel was closed.
+            pass
+
+    async def receive(self) -> Optional[List[memoryview]]:
+        """Returns the records of the next batch, or None if the channel was closed."""
+        try:
+            n = _LEN.unpack(await self.__reader.readexactly(_LEN.size))[0]
+            batch = memoryview(await self.__reader.readexactly(n))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        records = []
+        i = 0
+        while i < n:
+            record_len = _LEN.unpack_from(batch, i)[0]
+            i += _LEN.size
+            records.append(batch[i:i + record_len])
+            i += record_len
+        return records
+
+    def close(self) -> None:
+        self.__writer.close()
+
+
+def _packet_data(payload: memoryview) -> PacketData:
+    return PacketData._from_bytearray(bytearray(payload))
+
+
+class _ShardChild:
+    """The body of a child process. Runs a hub with the clients of the shard's ports."""
+
+    def __init__(self, sock: socket.socket, ports: List[str | PacketsTransport],
+                 child_setup: Optional[Callable[[str, SerialPacketsClient], None]], workers: int,
+                 client_kwargs: Dict):
+        self.__sock = sock
+        self.__ports = ports
+        self.__child_setup = child_setup
+        self.__workers = workers
+        self.__client_kwargs = client_kwargs
+        self.__channel: _Channel = None
+        self.__clients: List[SerialPacketsClient] = []
+        self.__request_id_counter = 0
+        # Commands that were forwarded to the parent, by request id.
+        self.__pending_requests: Dict[int, asyncio.Future] = {}
+
+    async def run(self) -> None:
+        reader, writer = await asyncio.open_connection(sock=self.__sock)
+        self.__channel = _Channel(reader, writer)
+        hub = SerialPacketsHub(workers=self.__workers)
+        for i, port in enumerate(self.__ports):
+            client = hub.add_client(port,
+                                    command_async_callback=self.__command_forwarder(i),
+                                    message_async_callback=self.__message_forwarder(i),
+                                    event_async_callback=self.__event_forwarder(i),
+                                    **self.__client_kwargs)
+            if self.__child_setup:
+                # Same as the port names of the supervisor.
+                self.__child_setup(str(port), client)
+            self.__clients.append(client)
+        results = await hub.connect_all()
+        self.__channel.send(bytes([_REC_READY] + [1 if ok else 0 for ok in results]))
+        while True:
+            records = await self.__channel.receive()
+            if records is None:
+                logger.error("Parent channel closed, exiting")
+                return
+            for record in records:
+                if record[0] == _REC_STOP:
+                    return
+                self.__handle_record(record)
+
+    def __handle_record(self, record: memoryview) -> None:
+        record_type = record[0]
+        if record_type == _REC_SEND_MESSAGE:
+            _, port, endpoint = _PORT_ENDPOINT.unpack_from(record)
+            self.__clients[port].send_message(endpoint,
+                                              _packet_data(record[_PORT_ENDPOINT.size:]))
+        elif record_type == _REC_SEND_COMMAND:
+            _, port, request_id, endpoint, timeout = _SEND_COMMAND.unpack_from(record)
+            future = self.__clients[port].send_command_future(
+                endpoint, _packet_data(record[_SEND_COMMAND.size:]), timeout)
+            future.add_done_callback(lambda f: self.__on_command_done(request_id, f))
+        elif record_type == _REC_RESPONSE:
+            _, request_id, status = _RESPONSE.unpack_from(record)
+            future = self.__pending_requests.pop(request_id, None)
+            if future and not future.done():
+                future.set_result((status, _packet_data(record[_RESPONSE.size:])))
+        elif record_type == _REC_STATS_REQUEST:
+            _, request_id = _ID.unpack_from(record)
+            stats = [client.stats() for client in self.__clients]
+            self.__channel.send(_ID.pack(_REC_STATS, request_id), pickle.dumps(stats))
+        else:
+            logger.error("Unknown record type %d, dropping", record_type)
+
+    def __on_command_done(self, request_id: int, future: asyncio.Future) -> None:
+        if future.cancelled():
+            self.__send_response(request_id, PacketStatus.GENERAL_ERROR.value, PacketData())
+            return
+        self.__send_response(request_id, *future.result())
+
+    def __send_response(self, request_id: int, status: int, data: PacketData) -> None:
+        self.__channel.send(_RESPONSE.pack(_REC_RESPONSE, request_id, status),
+                            data._internal_bytes_buffer())
+
+    def __command_forwarder(self, port: int):
+
+        async def forward_command(endpoint: int, data: PacketData) -> Tuple[int, PacketData]:
+            self.__request_id_counter = (self.__request_id_counter + 1) & 0xffffffff
+            request_id = self.__request_id_counter
+            future = asyncio.get_running_loop().create_future()
+            self.__pending_requests[request_id] = future
+            self.__channel.send(_PORT_ID_ENDPOINT.pack(_REC_COMMAND, port, request_id, endpoint),
+                                data._internal_bytes_buffer())
+            await self.__channel.drain()
+            try:
+                return await asyncio.wait_for(future, _PARENT_RESPONSE_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.error("Parent didn't respond to command request %d", request_id)
+                return (PacketStatus.TIMEOUT.value, PacketData())
+            finally:
+                self.__pending_requests.pop(request_id, None)
+
+        return forward_command
+
+    def __message_forwarder(self, port: int):
+
+        async def forward_message(endpoint: int, data: PacketData) -> None:
+            self.__channel.send(_PORT_ENDPOINT.pack(_REC_MESSAGE, port, endpoint),
+                                data._internal_bytes_buffer())
+            await self.__channel.drain()
+
+        return forward_message
+
+    def __event_forwarder(self, port: int):
+
+        async def forward_event(event: PacketsEvent) -> None:
+            self.__channel.send(_PORT_ENDPOINT.pack(_REC_EVENT, port, event.event_type.value),
+                                event.description.encode())
+            await self.__channel.drain()
+
+        return forward_event
+
+
+def _child_main(sock: socket.socket, ports: List[str | PacketsTransport], child_setup, workers: int,
+                client_kwargs: Dict) -> None:
+    """The entry point of the child processes."""
+    asyncio.run(_ShardChild(sock, ports, child_setup, workers, client_kwargs).run())
+
+
+class _Shard:
+    """The supervisor's state of a child process."""
+
+    def __init__(self, process: multiprocessing.Process, port_names: List[str]):
+        self.process = process
+        self.port_names = port_names
+        self.channel: _Channel = None
+        self.reader_task: asyncio.Task = None
+        self.ready: asyncio.Future = None
+        # True after the channel to the child process was closed, e.g. if it exited.
+        self.closed = False
+        # Futures of the commands and stats requests that were sent to the child,
+        # by request id.
+        self.pending_commands: Dict[int, asyncio.Future] = {}
+        self.pending_stats: Dict[int, asyncio.Future] = {}
+
+
+class ShardedPacketsSupervisor:
+    """Runs the clients of many ports in multiple child processes, each with its
+    own event loop, to spread the load across CPU cores.
+
+    Incoming messages, commands and events of the ports are forwarded to the
+    callbacks of the supervisor, in the parent process, over a batched IPC
+    channel. To avoid the IPC overhead, handlers can instead be registered in the
+    child processes, using child_setup.
+    """
+
+    def __init__(self,
+                 ports: List[str | PacketsTransport],
+                 processes: Optional[int] = None,
+                 command_async_callback: Optional(Callable[[str, int, PacketData],
+                                                           Tuple(int, PacketData)]) = None,
+                 message_async_callback: Optional(Callable[[str, int, PacketData], None]) = None,
+                 event_async_callback: Optional(Callable[[str, PacketsEvent], None]) = None,
+                 child_setup: Optional[Callable[[str, SerialPacketsClient], None]] = None,
+                 workers: int = DEFAULT_HUB_WORKERS_COUNT,
+                 mp_context=None,
+                 **client_kwargs):
+        """
+        Constructs a supervisor. The child processes are started by start().
+
+        Args:
+        * ports: A list of the ports to use, each a port name or a PacketsTransport, as
+          in SerialPacketsClient(). The ports should be picklable and their names,
+          as returned by str(), unique.
+        * processes: An optional int with the number of child processes. The ports are
+          assigned to the processes in a round robin order. Default is the number
+          of CPUs.
+        * command_async_callback: An optional async callback for incoming commands.
+          Same as in SerialPacketsClient but with an additional first argument with
+          the port name.
+        * message_async_callback: An optional async callback for incoming messages.
+          Same as in SerialPacketsClient but with an additional first argument with
+          the port name.
+        * event_async_callback: An optional async callback for the client events.
+          Same as in SerialPacketsClient but with an additional first argument with
+          the port name.
+        * child_setup: An optional function that is called in the child processes
+          with the port name and client of each port, before connecting. Can be used
+          to register per endpoint handlers that run in the child process. Should
+          be picklable, e.g. a module level function.
+        * workers: An optional int with the number of worker tasks in each of the
+          child processes. Default is DEFAULT_HUB_WORKERS_COUNT.
+        * mp_context: An optional multiprocessing context to start the processes
+          with. Default is the 'spawn' context.
+        * client_kwargs: Other SerialPacketsClient() args, e.g. baudrate.
+        """
+        assert (ports)
+        processes = processes or os.cpu_count() or 1
+        assert (processes >= 1)
+        self.__ports = list(ports)
+        self.__port_names = [str(port) for port in self.__ports]
+        assert (len(set(self.__port_names)) == len(self.__port_names))
+        self.__num_processes = min(processes, len(self.__ports))
+        self.__command_async_callback = command_async_callback
+        self.__message_async_callback = message_async_callback
+        self.__event_async_callback = event_async_callback
+        self.__child_setup = child_setup
+        self.__workers = workers
+        self.__mp_context = mp_context or multiprocessing.get_context("spawn")
+        self.__client_kwargs = client_kwargs
+        self.__shards: List[_Shard] = []
+        # Maps port names to (shard, port index in shard).
+        self.__port_locations: Dict[str, Tuple[_Shard, int]] = {}
+        self.__request_id_counter = 0
+        # Per https://stackoverflow.com/questions/71304329
+        self.__background_tasks = set()
+
+    def ports(self) -> List[str]:
+        """Returns the names of the ports."""
+        return list(self.__port_names)
+
+    async def start(self) -> Dict[str, bool]:
+        """Starts the child processes and connects the ports. Returns a dict with the
+        connect() result of each of the ports, keyed by port name."""
+        assert (not self.__shards)
+        for shard_index in range(self.__num_processes):
+            shard_ports = self.__ports[shard_index::self.__num_processes]
+            parent_sock, child_sock = socket.socketpair()
+            process = self.__mp_context.Process(target=_child_main,
+                                                args=(child_sock, shard_ports,
+                                                      self.__child_setup, self.__workers,
+                                                      self.__client_kwargs),
+                                                name=f"serial_packets_shard_{shard_index}",
+                                                daemon=True)
+            process.start()
+            child_sock.close()
+            shard = _Shard(process, [str(port) for port in shard_ports])
+            reader, writer = await asyncio.open_connection(sock=parent_sock)
+            shard.channel = _Channel(reader, writer)
+            shard.ready = asyncio.get_running_loop().create_future()
+            shard.reader_task = asyncio.create_task(self.__reader_task(shard),
+                                                    name=f"shard_reader_{shard_index}")
+            for i, port_name in enumerate(shard.port_names):
+                self.__port_locations[port_name] = (shard, i)
+            self.__shards.append(shard)
+        results = {}
+        for shard in self.__shards:
+            results.update(zip(shard.port_names, await shard.ready))
+        return {name: results[name] for name in self.__port_names}
+
+    async def stop(self) -> None:
+        """Stops the child processes."""
+        for shard in self.__shards:
+            shard.channel.send(bytes([_REC_STOP]))
+        loop = asyncio.get_running_loop()
+        for shard in self.__shards:
+            await loop.run_in_executor(None, shard.process.join, _STOP_TIMEOUT)
+            if shard.process.is_alive():
+                logger.error("Shard process %s didn't stop, terminating", shard.process.name)
+                shard.process.terminate()
+            shard.reader_task.cancel()
+            shard.channel.close()
+            self.__on_shard_closed(shard)
+        self.__shards = []
+        self.__port_locations = {}
+
+    def __on_shard_closed(self, shard: _Shard) -> None:
+        """Fails the pending requests of a shard whose channel was closed. Commands
+        fail with NOT_CONNECTED and stats requests with None."""
+        shard.closed = True
+        pending_commands, shard.pending_commands = shard.pending_commands, {}
+        pending_stats, shard.pending_stats = shard.pending_stats, {}
+        for future in pending_commands.values():
+            if not future.done():
+                future.set_result((PacketStatus.NOT_CONNECTED.value, PacketData()))
+        for future in pending_stats.values():
+            if not future.done():
+                future.set_result(None)
+
+    def __new_request(self, pending: Dict[int, asyncio.Future]) -> Tuple[int, asyncio.Future]:
+        """Allocates a request id and registers its future in the pending requests."""
+        self.__request_id_counter = (self.__request_id_counter + 1) & 0xffffffff
+        request_id = self.__request_id_counter
+        future = asyncio.get_running_loop().create_future()
+        pending[request_id] = future
+        return (request_id, future)
+
+    def send_command_future(self,
+                            port: str,
+                            endpoint: int,
+                            data: PacketData,
+                            timeout=DEFAULT_CMD_TIMEOUT) -> asyncio.Future:
+        """Same as SerialPacketsClient.send_command_future() but with an additional
+        first argument with the name of the port to send the command to."""
+        assert (endpoint >= 0 and endpoint <= MAX_USER_ENDPOINT)
+        assert (data.size() <= MAX_DATA_LEN)
+        assert (timeout >= MIN_CMD_TIMEOUT and timeout <= MAX_CMD_TIMEOUT)
+        shard, port_index = self.__port_locations[port]
+        if shard.closed:
+            logger.error("Shard of port %s exited, ignoring command send", port)
+            future = asyncio.get_running_loop().create_future()
+            future.set_result((PacketStatus.NOT_CONNECTED.value, PacketData()))
+            return future
+        request_id, future = self.__new_request(shard.pending_commands)
+        shard.channel.send(
+            _SEND_COMMAND.pack(_REC_SEND_COMMAND, port_index, request_id, endpoint, timeout),
+            data._internal_bytes_buffer())
+        return future
+
+    async def send_command_blocking(self,
+                                    port: str,
+                                    endpoint: int,
+                                    data: PacketData,
+                                    timeout=DEFAULT_CMD_TIMEOUT) -> Tuple[int, PacketData]:
+        """Same as SerialPacketsClient.send_command_blocking() but with an additional
+        first argument with the name of the port to send the command to."""
+        future = self.send_command_future(port, endpoint, data, timeout)
+        await self.__port_locations[port][0].channel.drain()
+        return await future
+
+    def send_message(self, port: str, endpoint: int, data: PacketData) -> None:
+        """Same as SerialPacketsClient.send_message() but with an additional first
+        argument with the name of the port to send the message to."""
+        assert (endpoint >= 0 and endpoint <= MAX_USER_ENDPOINT)
+        assert (data.size() <= MAX_DATA_LEN)
+        shard, port_index = self.__port_locations[port]
+        if shard.closed:
+            logger.error("Shard of port %s exited, ignoring message send", port)
+            return
+        shard.channel.send(_PORT_ENDPOINT.pack(_REC_SEND_MESSAGE, port_index, endpoint),
+                           data._internal_bytes_buffer())
+
+    async def stats(self) -> Dict[str, PacketsStats]:
+        """Returns a snapshot of the stats of each of the ports, keyed by port name.
+        Ports of child processes that exited are left out."""
+        shards = [shard for shard in self.__shards if not shard.closed]
+        futures = []
+        for shard in shards:
+            request_id, future = self.__new_request(shard.pending_stats)
+            shard.channel.send(_ID.pack(_REC_STATS_REQUEST, request_id))
+            futures.append(future)
+        shards_stats = {}
+        for shard, shard_stats in zip(shards, await asyncio.gather(*futures)):
+            if shard_stats is not None:
+                shards_stats.update(zip(shard.port_names, shard_stats))
+        return {name: shards_stats[name] for name in self.__port_names if name in shards_stats}
+
+    async def __reader_task(self, shard: _Shard) -> None:
+        """Receives and dispatches the records of a child process."""
+        while True:
+            records = await shard.channel.receive()
+            if records is None:
+                logger.error("Shard %s channel closed", shard.process.name)
+                if not shard.ready.done():
+                    shard.ready.set_result([False] * len(shard.port_names))
+                self.__on_shard_closed(shard)
+                return
+            for record in records:
+                try:
+                    await self.__handle_record(shard, record)
+                except Exception as e:
+                    logger.error("Shard %s record exception:", shard.process.name)
+                    traceback.print_exception(e)
+
+    async def __handle_record(self, shard: _Shard, record: memoryview) -> None:
+        record_type = record[0]
+        if record_type == _REC_MESSAGE:
+            _, port, endpoint = _PORT_ENDPOINT.unpack_from(record)
+            if self.__message_async_callback:
+                await self.__message_async_callback(shard.port_names[port], endpoint,
+                                                    _packet_data(record[_PORT_ENDPOINT.size:]))
+        elif record_type == _REC_COMMAND:
+            _, port, request_id, endpoint = _PORT_ID_ENDPOINT.unpack_from(record)
+            # Commands may take a while, so they don't block the channel.
+            task = asyncio.create_task(
+                self.__handle_command(shard, shard.port_names[port], request_id, endpoint,
+                                      _packet_data(record[_PORT_ID_ENDPOINT.size:])))
+            self.__background_tasks.add(task)
+            task.add_done_callback(self.__background_tasks.discard)
+        elif record_type == _REC_RESPONSE:
+            _, request_id, status = _RESPONSE.unpack_from(record)
+            future = shard.pending_commands.pop(request_id, None)
+            if future and not future.done():
+                future.set_result((status, _packet_data(record[_RESPONSE.size:])))
+        elif record_type == _REC_EVENT:
+            _, port, event_type = _PORT_ENDPOINT.unpack_from(record)
+            if self.__event_async_callback:
+                event = PacketsEvent(PacketsEventType(event_type),
+                                     str(record[_PORT_ENDPOINT.size:], "utf-8"))
+                await self.__event_async_callback(shard.port_names[port], event)
+        elif record_type == _REC_STATS:
+            _, request_id = _ID.unpack_from(record)
+            future = shard.pending_stats.pop(request_id, None)
+            if future and not future.done():
+                future.set_result(pickle.loads(record[_ID.size:]))
+        elif record_type == _REC_READY:
+            if not shard.ready.done():
+                shard.ready.set_result([b != 0 for b in record[1:]])
+        else:
+            logger.error("Unknown record type %d, dropping", record_type)
+
+    async def __handle_command(self, shard: _Shard, port_name: str, request_id: int,
+                               endpoint: int, data: PacketData) -> None:
+        if self.__command_async_callback:
+            try:
+                status, response_data = await self.__command_async_callback(
+                    port_name, endpoint, data)
+            except Exception as e:
+                logger.error("Command callback exception:")
+                traceback.print_exception(e)
+                status, response_data = (PacketStatus.GENERAL_ERROR.value, PacketData())
+        else:
+            status, response_data = (PacketStatus.UNHANDLED.value, PacketData())
+        shard.channel.send(_RESPONSE.pack(_REC_RESPONSE, request_id, status),
+                           response_data._internal_bytes_buffer())
+        await shard.channel.drain()
@@ -0,0 +1,475 @@
+"""A Serial Packets sniffer and analyzer.
+
+Decodes a capture file or live ports and prints a summary of the traffic.
+
+Usage:
+  python -m serial_packets.sniff session.spcap              # A CaptureRecorder file.
+  python -m serial_packets.sniff dump.bin                   # Raw received bytes.
+  python -m serial_packets.sniff session.spcap --jsonl packets.jsonl --csv packets.csv
+  python -m serial_packets.sniff --port COM1 --port COM2    # Live tap of both directions.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import concurrent.futures
+import csv
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import sys
+import time
+
+from typing import Callable, Dict, List, Optional, Tuple
+from ._packets import PACKET_END_FLAG, MAX_CMD_TIMEOUT
+from .capture import CaptureReader, CAPTURE_RX
+from .packet_decoder import (PacketDecoder, DecodedCommandPacket, DecodedResponsePacket,
+                             DecodedMessagePacket)
+from .stats import LatencyHistogram
+from .transports import PacketsTransport, SerialPortTransport, TcpClientTransport
+
+# Raw files are decoded in chunks of this size.
+_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Min size in bytes of a raw file that is split between worker processes.
+_PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+
+_END_FLAG = bytes([PACKET_END_FLAG])
+
+# Commands with no response for this time in secs are counted as unanswered.
+_PENDING_COMMAND_TIMEOUT = 2 * MAX_CMD_TIMEOUT
+
+_OTHER_DIRECTION = {"rx": "tx", "tx": "rx"}
+
+# Called with (direction, secs or None, type name, cmd_id, endpoint, status, data, rtt),
+# where fields that don't apply to the packet type are None.
+PacketCallback = Callable[[
+    str, Optional[float], str, Optional[int], Optional[int], Optional[int], bytes,
+    Optional[float]
+], None]
+
+
+class DirectionStats:
+    """Counters of the packets of one direction."""
+
+    def __init__(self):
+        # Keyed by (type name, endpoint), where endpoint is None for responses and logs.
+        # Values are [packets, data bytes].
+        self.packets: Dict[Tuple[str, Optional[int]], List[int]] = {}
+        # Response counts, keyed by status.
+        self.statuses: Dict[int, int] = {}
+        self.wire_bytes = 0
+        self.crc_errors = 0
+        self.framing_errors = 0
+        self.dropped_bytes = 0
+
+    def merge(self, other: DirectionStats) -> None:
+        """Adds the counters of other to this one."""
+        for key, (count, size) in other.packets.items():
+            counters = self.packets.setdefault(key, [0, 0])
+            counters[0] += count
+            counters[1] += size
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.wire_bytes += other.wire_bytes
+        self.crc_errors += other.crc_errors
+        self.framing_errors += other.framing_errors
+        self.dropped_bytes += other.dropped_bytes
+
+    def num_packets(self) -> int:
+        return sum(v[0] for v in self.packets.values())
+
+    def crc_error_rate(self) -> float:
+        """Returns the fraction of the complete packets that failed the CRC check."""
+        total = self.num_packets() + self.crc_errors
+        return self.crc_errors / total if total else 0.0
+
+
+class PacketsAnalyzer:
+    """Decodes the bytes of one or two directions and collects per type and endpoint
+    counters, error counts and command round trip times. Commands and responses
+    of opposite directions are paired by their cmd_id."""
+
+    def __init__(self, on_packet: Optional[PacketCallback] = None):
+        """on_packet is an optional callback that is called with each packet, e.g.
+        for printing or exporting. Leave it None for the fastest analysis."""
+        self.__on_packet = on_packet
+        self.__decoders: Dict[str, PacketDecoder] = {}
+        self.__directions: Dict[str, DirectionStats] = {}
+        # Commands that wait for a response, keyed by (direction, cmd_id). Values
+        # are the command time.
+        self.__pending_commands: Dict[Tuple[str, int], float] = {}
+        self.__expired_commands = 0
+        self.__unmatched_responses = 0
+        self.__rtt = LatencyHistogram()
+
+    def _has_on_packet(self) -> bool:
+        """Package private."""
+        return self.__on_packet is not None
+
+    def directions(self) -> Dict[str, DirectionStats]:
+        """Returns the stats of the directions, keyed by 'rx' and 'tx'."""
+        return self.__directions
+
+    def rtt(self) -> LatencyHistogram:
+        """Returns the round trip times of the paired commands."""
+        return self.__rtt
+
+    def unanswered_commands(self) -> int:
+        """Returns the number of timestamped commands with no response."""
+        return self.__expired_commands + len(self.__pending_commands)
+
+    def unmatched_responses(self) -> int:
+        """Returns the number of timestamped responses with no command."""
+        return self.__unmatched_responses
+
+    def _add_direction(self, direction: str, mid_stream: bool = False) -> PacketDecoder:
+        """Package private. Starts the decoding of a direction. mid_stream is True if
+        the stream starts right after an end flag of an earlier packet, rather than
+        at the start of the communication."""
+        assert (direction in _OTHER_DIRECTION and direction not in self.__decoders)
+        decoder = self.__decoders[direction] = PacketDecoder()
+        if mid_stream:
+            decoder._start_mid_stream()
+        self.__directions[direction] = DirectionStats()
+        return decoder
+
+    def _merge_direction(self, direction: str, stats: DirectionStats) -> None:
+        """Package private. Adds the counters of a separately analyzed part of a
+        stream, with no commands pairing."""
+        if direction not in self.__decoders:
+            self._add_direction(direction)
+        self.__directions[direction].merge(stats)
+
+    def feed(self, direction: str, data: bytes, t: Optional[float] = None) -> None:
+        """Decodes a chunk of bytes of 'rx' or 'tx' direction. t is the time of the chunk
+        in secs, or None if unknown, in which case commands are not paired."""
+        decoder = self.__decoders.get(direction) or self._add_direction(direction)
+        stats = self.__directions[direction]
+        stats.wire_bytes += len(data)
+        # The error counters of the decoder are since the start of the stream.
+        crc_errors = decoder.crc_errors()
+        framing_errors = decoder.framing_errors()
+        dropped_bytes = decoder.dropped_bytes()
+        decoded_packets = decoder.receive_bytes(data)
+        stats.crc_errors += decoder.crc_errors() - crc_errors
+        stats.framing_errors += decoder.framing_errors() - framing_errors
+        stats.dropped_bytes += decoder.dropped_bytes() - dropped_bytes
+        if decoded_packets:
+            self.__process_packets(direction, stats, decoded_packets, t)
+
+    def __process_packets(self, direction: str, stats: DirectionStats, decoded_packets: List,
+                          t: Optional[float]) -> None:
+        packets = stats.packets
+        on_packet = self.__on_packet
+        for decoded_packet in decoded_packets:
+            cmd_id = None
+            endpoint = None
+            status = None
+            if isinstance(decoded_packet, DecodedMessagePacket):
+                type_name = "message"
+                endpoint = decoded_packet.endpoint
+            elif isinstance(decoded_packet, DecodedCommandPacket):
+                type_name = "command"
+                cmd_id = decoded_packet.cmd_id
+                endpoint = decoded_packet.endpoint
+            elif isinstance(decoded_packet, DecodedResponsePacket):
+                type_name = "response"
+                cmd_id = decoded_packet.cmd_id
+                status = decoded_packet.status
+            else:
+                type_name = "log"
+            size = decoded_packet.data.size()
+            key = (type_name, endpoint)
+            counters = packets.get(key)
+            if counters:
+                counters[0] += 1
+                counters[1] += size
+            else:
+                packets[key] = [1, size]
+            rtt = None
+            if status is not None:
+                stats.statuses[status] = stats.statuses.get(status, 0) + 1
+                if t is not None:
+                    rtt = self.__pair_response(direction, cmd_id, t)
+            elif cmd_id is not None and t is not None:
+                self.__add_command(direction, cmd_id, t)
+            if on_packet:
+                on_packet(direction, t, type_name, cmd_id, endpoint, status,
+                          bytes(decoded_packet.data._internal_bytes_buffer()), rtt)
+
+    def __add_command(self, direction: str, cmd_id: int, t: float) -> None:
+        pending = self.__pending_commands
+        pending[(direction, cmd_id)] = t
+        if len(pending) >= 10000:
+            expired = [k for k, v in pending.items() if v < t - _PENDING_COMMAND_TIMEOUT]
+            for k in expired:
+                del pending[k]
+            self.__expired_commands += len(expired)
+
+    def __pair_response(self, direction: str, cmd_id: int, t: float) -> Optional[float]:
+        """Returns the round trip time of a response, or None if its command is unknown."""
+        t0 = self.__pending_commands.pop((_OTHER_DIRECTION[direction], cmd_id), None)
+        if t0 is None:
+            self.__unmatched_responses += 1
+            return None
+        rtt = t - t0
+        self.__rtt.record(rtt)
+        return rtt
+
+    def summary(self) -> str:
+        """Returns a human readable summary of the analysis."""
+        lines = []
+        for direction, stats in sorted(self.__directions.items()):
+            lines.append(f"{direction}: {stats.wire_bytes:,} wire bytes, "
+                         f"{stats.num_packets():,} packets, CRC errors {stats.crc_errors:,} "
+                         f"({stats.crc_error_rate():.3%}), framing errors "
+                         f"{stats.framing_errors:,}, dropped bytes {stats.dropped_bytes:,}")
+            if stats.packets:
+                lines.append(f"  {'Type':<10} {'Endpoint':>8} {'Packets':>14} {'Data bytes':>16}")
+            for (type_name, endpoint), (count, size) in sorted(
+                    stats.packets.items(), key=lambda kv: (kv[0][0], kv[0][1] or 0)):
+                ep = "-" if endpoint is None else str(endpoint)
+                lines.append(f"  {type_name:<10} {ep:>8} {count:>14,} {size:>16,}")
+            if stats.statuses:
+                statuses = ", ".join(f"{s}: {c:,}" for s, c in sorted(stats.statuses.items()))
+                lines.append(f"  Response statuses: {statuses}")
+        rtt = self.__rtt
+        if rtt.count() or self.unanswered_commands() or self.__unmatched_responses:
+            lines.append(f"Commands: {rtt.count():,} paired, {self.unanswered_commands():,} "
+                         f"unanswered, {self.__unmatched_responses:,} unmatched responses")
+        if rtt.count():
+            lines.append(f"  RTT ms: min {rtt.min() * 1e3:.3f}, p50 {rtt.percentile(50) * 1e3:.3f}, "
+                         f"p90 {rtt.percentile(90) * 1e3:.3f}, p99 {rtt.percentile(99) * 1e3:.3f}, "
+                         f"max {rtt.max() * 1e3:.3f}")
+        return "\n".join(lines)
+
+
+def _analyze_raw_range(path: str, start: int, stop: int) -> Optional[DirectionStats]:
+    """Analyzes the bytes [start, stop) of a raw file. Runs in a worker process."""
+    analyzer = PacketsAnalyzer()
+    analyzer._add_direction("rx", mid_stream=start > 0)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        for i in range(start, stop, _CHUNK_SIZE):
+            analyzer.feed("rx", m[i:min(i + _CHUNK_SIZE, stop)])
+    return analyzer.directions()["rx"]
+
+
+def _split_raw_file(path: str, size: int, jobs: int) -> List[Tuple[int, int]]:
+    """Splits a raw file to ranges that start right after an end flag."""
+    bounds = [0]
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        for k in range(1, jobs):
+            i = m.find(_END_FLAG, max(bounds[-1], size * k // jobs))
+            if i < 0:
+                break
+            if i + 1 > bounds[-1]:
+                bounds.append(i + 1)
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if b > a]
+
+
+def analyze_file(path: str, analyzer: PacketsAnalyzer, jobs: int = 1) -> int:
+    """Feeds a capture file to the analyzer. The file can be a CaptureRecorder file or
+    a file with raw received bytes. Returns the size of the file in bytes.
+
+    Large raw files are split to ranges that are analyzed by jobs worker processes,
+    if the analyzer has no on_packet callback. Counters at the range boundaries
+    may differ slightly from a sequential analysis in case of corrupted data."""
+    try:
+        reader = CaptureReader(path)
+    except ValueError:
+        reader = None
+    if reader:
+        with reader:
+            for direction, t, chunk in reader.records():
+                analyzer.feed("rx" if direction == CAPTURE_RX else "tx", chunk, t)
+            return reader.size()
+    size = os.path.getsize(path)
+    if jobs > 1 and size >= _PARALLEL_MIN_SIZE and not analyzer._has_on_packet():
+        ranges = _split_raw_file(path, size, jobs)
+        context = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(len(ranges), mp_context=context) as executor:
+            for stats in executor.map(_analyze_raw_range, *zip(*[(path, a, b) for a, b in ranges])):
+                analyzer._merge_direction("rx", stats)
+        return size
+    if size:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            for i in range(0, size, _CHUNK_SIZE):
+                analyzer.feed("rx", m[i:i + _CHUNK_SIZE])
+    return size
+
+
+def _tap_transport(port: str, baudrate: int) -> PacketsTransport:
+    """Returns the transport of a port name. 'tcp:host:port' connects to a TCP server,
+    e.g. of a serial to network bridge, and other names are serial ports."""
+    if port.startswith("tcp:"):
+        host, tcp_port = port[4:].rsplit(":", 1)
+        return TcpClientTransport(host, int(tcp_port))
+    return SerialPortTransport(port, baudrate)
+
+
+class _TapProtocol(asyncio.Protocol):
+    """Feeds the bytes of a tapped port to the analyzer."""
+
+    def __init__(self, analyzer: PacketsAnalyzer, direction: str, start_time: float,
+                 closed: asyncio.Future):
+        self.__analyzer = analyzer
+        self.__direction = direction
+        self.__start_time = start_time
+        self.__closed = closed
+
+    def data_received(self, data: bytes):
+        self.__analyzer.feed(self.__direction, data, time.monotonic() - self.__start_time)
+
+    def connection_lost(self, exc):
+        if not self.__closed.done():
+            self.__closed.set_result(None)
+
+
+async def tap(ports: List[str],
+              analyzer: PacketsAnalyzer,
+              baudrate: int = 115200,
+              duration: Optional[float] = None) -> None:
+    """Feeds live ports to the analyzer, until the ports are closed or for the given
+    duration in secs. The ports only receive, e.g. from a tap cable of the line. The
+    first port is the 'rx' direction and the optional second port is 'tx'."""
+    assert (1 <= len(ports) <= 2)
+    loop = asyncio.get_running_loop()
+    start_time = time.monotonic()
+    transports = []
+    closed = []
+    try:
+        for port, direction in zip(ports, ("rx", "tx")):
+            future = loop.create_future()
+            transport, _ = await _tap_transport(port, baudrate).connect(
+                lambda direction=direction, future=future: _TapProtocol(
+                    analyzer, direction, start_time, future))
+            transports.append(transport)
+            closed.append(future)
+        await asyncio.wait_for(asyncio.gather(*closed), duration)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        for transport in transports:
+            transport.close()
+
+
+def _print_packet(direction: str, t: Optional[float], type_name: str, cmd_id: Optional[int],
+                  endpoint: Optional[int], status: Optional[int], data: bytes,
+                  rtt: Optional[float]) -> None:
+    fields = [f"{t:12.6f}" if t is not None else "", direction, f"{type_name:<8}"]
+    if cmd_id is not None:
+        fields.append(f"cmd_id={cmd_id}")
+    if endpoint is not None:
+        fields.append(f"endpoint={endpoint}")
+    if status is not None:
+        fields.append(f"status={status}")
+    if rtt is not None:
+        fields.append(f"rtt={rtt * 1e3:.3f}ms")
+    fields.append(f"[{len(data)}] {data.hex(' ')}")
+    print(" ".join(fields))
+
+
+_EXPORT_FIELDS = ["time", "direction", "type", "cmd_id", "endpoint", "status", "size", "data", "rtt"]
+
+
+class _Exporter:
+    """Writes a JSONL and/or CSV row per packet."""
+
+    def __init__(self, jsonl_path: Optional[str], csv_path: Optional[str]):
+        self.__jsonl_file = open(jsonl_path, "w") if jsonl_path else None
+        self.__csv_file = open(csv_path, "w", newline="") if csv_path else None
+        self.__csv_writer = csv.writer(self.__csv_file) if self.__csv_file else None
+        if self.__csv_writer:
+            self.__csv_writer.writerow(_EXPORT_FIELDS)
+
+    def write(self, direction: str, t: Optional[float], type_name: str, cmd_id: Optional[int],
+              endpoint: Optional[int], status: Optional[int], data: bytes,
+              rtt: Optional[float]) -> None:
+        row = [t, direction, type_name, cmd_id, endpoint, status, len(data), data.hex(), rtt]
+        if self.__jsonl_file:
+            self.__jsonl_file.write(json.dumps(dict(zip(_EXPORT_FIELDS, row))))
+            self.__jsonl_file.write("\n")
+        if self.__csv_writer:
+            self.__csv_writer.writerow(["" if v is None else v for v in row])
+
+    def close(self) -> None:
+        for f in (self.__jsonl_file, self.__csv_file):
+            if f:
+                f.close()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m serial_packets.sniff",
+                                     description="Serial Packets sniffer and analyzer.")
+    parser.add_argument("path",
+                        nargs="?",
+                        help="A CaptureRecorder file or a file with raw received bytes.")
+    parser.add_argument("--port",
+                        action="append",
+                        default=[],
+                        help="A port to tap, instead of a file. Repeat for the second "
+                        "direction. 'tcp:host:port' connects to a TCP server.")
+    parser.add_argument("--baudrate", type=int, default=115200, help="Default 115200.")
+    parser.add_argument("--duration", type=float, help="Tap duration in secs. Default forever.")
+    parser.add_argument("-p",
+                        "--packets",
+                        action="store_true",
+                        help="Print the packets. Always on when tapping ports.")
+    parser.add_argument("-j",
+                        "--jobs",
+                        type=int,
+                        default=os.cpu_count() or 1,
+                        help="Worker processes for large raw files. Default is the number of "
+                        "CPUs.")
+    parser.add_argument("--jsonl", help="Export the packets to this JSON lines file.")
+    parser.add_argument("--csv", help="Export the packets to this CSV file.")
+    args = parser.parse_args(argv)
+    if bool(args.path) == bool(args.port) or len(args.port) > 2:
+        parser.error("Specify either a file or one or two --port.")
+
+    exporter = _Exporter(args.jsonl, args.csv) if (args.jsonl or args.csv) else None
+    print_packets = args.packets or args.port
+    callbacks = ([_print_packet] if print_packets else []) + ([exporter.write] if exporter else [])
+    if len(callbacks) > 1:
+        on_packet = lambda *packet: [callback(*packet) for callback in callbacks]
+    else:
+        on_packet = callbacks[0] if callbacks else None
+    analyzer = PacketsAnalyzer(on_packet)
+    # The decoding errors are counted in the summary rather than logged.
+    decoder_logger = logging.getLogger(PacketDecoder.__module__)
+    decoder_log_level = decoder_logger.level
+    decoder_logger.setLevel(logging.CRITICAL)
+
+    start = time.perf_counter()
+    try:
+        if args.path:
+            try:
+                size = analyze_file(args.path, analyzer, args.jobs)
+            except OSError as e:
+                print(f"Can't read {args.path}: {e.strerror or e}", file=sys.stderr)
+                return 1
+        else:
+            try:
+                asyncio.run(tap(args.port, analyzer, args.baudrate, args.duration))
+            except KeyboardInterrupt:
+                pass
+            size = sum(stats.wire_bytes for stats in analyzer.directions().values())
+    finally:
+        decoder_logger.setLevel(decoder_log_level)
+        if exporter:
+            exporter.close()
+    elapsed = time.perf_counter() - start
+
+    print(analyzer.summary())
+    if args.path:
+        print(f"Analyzed {size:,} bytes in {elapsed:.2f}s ({size / max(elapsed, 1e-9) / 1e6:.1f} MB/s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,380 @@
+from __future__ import annotations
+
+import math
+
+from typing import Dict, List, Optional, Tuple
+from ._packets import PacketType
+
+# Histogram buckets. Durations are bucketed in integer microseconds. Values below
+# _SUB_BUCKETS have a bucket each, and each higher power of two range is split
+# into _SUB_BUCKETS / 2 equal buckets, for a max relative error of about 3%.
+_SUB_BUCKET_BITS = 5
+_SUB_BUCKETS = 1 << _SUB_BUCKET_BITS
+_HALF_SUB_BUCKETS = _SUB_BUCKETS // 2
+# Covers durations up to about 9.5 hours. Longer durations are counted in the
+# last bucket.
+_NUM_BUCKETS = _SUB_BUCKETS + 30 * _HALF_SUB_BUCKETS
+
+# Indexed by PacketType value.
+_TYPE_NAMES: List[Optional[str]] = [None] * (max(t.value for t in PacketType) + 1)
+for _t in PacketType:
+    _TYPE_NAMES[_t.value] = _t.name.lower()
+
+_NUM_ENDPOINTS = 256
+
+# The upper bounds, in secs, of the histogram buckets that are exported to
+# Prometheus. The same for all histograms so they can be aggregated.
+_PROMETHEUS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                       0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _bucket_index(usecs: int) -> int:
+    if usecs < _SUB_BUCKETS:
+        return usecs if usecs > 0 else 0
+    shift = usecs.bit_length() - _SUB_BUCKET_BITS
+    index = _SUB_BUCKETS + (shift - 1) * _HALF_SUB_BUCKETS + (usecs >> shift) - _HALF_SUB_BUCKETS
+    return index if index < _NUM_BUCKETS else _NUM_BUCKETS - 1
+
+
+def _bucket_range(index: int) -> Tuple[int, int]:
+    """Returns the [low, high) range of a bucket, in usecs."""
+    if index < _SUB_BUCKETS:
+        return (index, index + 1)
+    k = index - _SUB_BUCKETS
+    shift = k // _HALF_SUB_BUCKETS + 1
+    mantissa = k % _HALF_SUB_BUCKETS + _HALF_SUB_BUCKETS
+    return (mantissa << shift, (mantissa + 1) << shift)
+
+
+class LatencyHistogram:
+    """A histogram of durations, with HDR style log-linear buckets of microsecond
+    resolution. Recording is O(1) and the memory size is fixed."""
+
+    __slots__ = ("__counts", "__count", "__sum", "__min", "__max")
+
+    def __init__(self):
+        self.__counts: List[int] = [0] * _NUM_BUCKETS
+        self.__count = 0
+        self.__sum = 0.0
+        self.__min = math.inf
+        self.__max = 0.0
+
+    def __str__(self) -> str:
+        if not self.__count:
+            return "count=0"
+        return (f"count={self.__count}, min={self.__min * 1e6:.0f}us, "
+                f"p50={self.percentile(50) * 1e6:.0f}us, p99={self.percentile(99) * 1e6:.0f}us, "
+                f"max={self.__max * 1e6:.0f}us")
+
+    def record(self, secs: float) -> None:
+        """Records a duration in secs."""
+        self.__counts[_bucket_index(int(secs * 1e6))] += 1
+        self.__count += 1
+        self.__sum += secs
+        if secs < self.__min:
+            self.__min = secs
+        if secs > self.__max:
+            self.__max = secs
+
+    def copy(self) -> LatencyHistogram:
+        result = LatencyHistogram()
+        result.merge(self)
+        return result
+
+    def merge(self, other: LatencyHistogram) -> None:
+        """Adds to this histogram the durations of another histogram."""
+        counts = self.__counts
+        for i, n in enumerate(other.__counts):
+            if n:
+                counts[i] += n
+        self.__count += other.__count
+        self.__sum += other.__sum
+        self.__min = min(self.__min, other.__min)
+        self.__max = max(self.__max, other.__max)
+
+    def count(self) -> int:
+        """Returns the number of recorded durations."""
+        return self.__count
+
+    def total(self) -> float:
+        """Returns the sum of the recorded durations, in secs."""
+        return self.__sum
+
+    def min(self) -> float:
+        """Returns the min recorded duration in secs, or 0 if empty."""
+        return self.__min if self.__count else 0.0
+
+    def max(self) -> float:
+        """Returns the max recorded duration in secs, or 0 if empty."""
+        return self.__max
+
+    def mean(self) -> float:
+        """Returns the mean recorded duration in secs, or 0 if empty."""
+        return self.__sum / self.__count if self.__count else 0.0
+
+    def percentile(self, p: float) -> float:
+        """Returns the approximated p'th percentile [0, 100] in secs, or 0 if empty."""
+        assert (p >= 0 and p <= 100)
+        if not self.__count:
+            return 0.0
+        if p == 0:
+            return self.__min
+        rank = max(1, math.ceil(p / 100 * self.__count))
+        seen = 0
+        for i, n in enumerate(self.__counts):
+            seen += n
+            if seen >= rank:
+                if i == _NUM_BUCKETS - 1:
+                    # The last bucket is unbounded.
+                    return self.__max
+                low, high = _bucket_range(i)
+                value = (low + high) / 2e6
+                return min(max(value, self.__min), self.__max)
+        return self.__max
+
+    def buckets(self) -> List[Tuple[float, int]]:
+        """Returns a list of (upper_bound_secs, count) of the non empty buckets,
+        in increasing order. The counts are not cumulative."""
+        return [(_bucket_range(i)[1] / 1e6, n) for i, n in enumerate(self.__counts) if n]
+
+    def cumulative_counts(self, upper_bounds: List[float]) -> List[int]:
+        """Returns the number of durations up to each of the given increasing upper
+        bounds in secs. Only buckets that end at or below a bound are counted in
+        it, so the counts are consistently low by the resolution of the buckets."""
+        result = []
+        i = 0
+        cumulative = 0
+        for upper_bound in upper_bounds:
+            usecs = upper_bound * 1e6
+            while i < _NUM_BUCKETS - 1 and _bucket_range(i)[1] <= usecs:
+                cumulative += self.__counts[i]
+                i += 1
+            result.append(cumulative)
+        return result
+
+
+class PacketsStats:
+    """A snapshot of the counters of a SerialPacketsClient, as returned by
+    SerialPacketsClient.stats(). Packet counters are keyed by the lower case packet
+    type name ('command', 'response', 'message', 'log') and byte counters count
+    the packets data bytes. Per endpoint counters include only commands and
+    messages, and only endpoints with a non zero count."""
+
+    def __init__(self):
+        self.rx_packets: Dict[str, int] = {}
+        self.rx_bytes: Dict[str, int] = {}
+        self.tx_packets: Dict[str, int] = {}
+        self.tx_bytes: Dict[str, int] = {}
+        self.rx_endpoint_packets: Dict[int, int] = {}
+        self.rx_endpoint_bytes: Dict[int, int] = {}
+        self.tx_endpoint_packets: Dict[int, int] = {}
+        self.tx_endpoint_bytes: Dict[int, int] = {}
+        # Bytes on the wire, including framing and stuffing.
+        self.rx_wire_bytes = 0
+        self.tx_wire_bytes = 0
+        # Decoder errors.
+        self.crc_errors = 0
+        self.framing_errors = 0
+        self.dropped_bytes = 0
+        # Incoming packets that were dropped due to a full work queue.
+        self.dropped_packets = 0
+        self.command_timeouts = 0
+        # Outgoing commands that were resent per their retry policy.
+        self.command_retries = 0
+        # Responses with no pending command, e.g. after the command timed out.
+        self.late_responses = 0
+        # Max number of items in the work queue.
+        self.queue_high_water = 0
+        # Round trip time of the outgoing commands that got a response.
+        self.command_rtt = LatencyHistogram()
+        # Execution time of the incoming commands and messages handlers.
+        self.callback_time = LatencyHistogram()
+
+    def __str__(self) -> str:
+        return (f"rx={self.rx_packets}, tx={self.tx_packets}, crc_errors={self.crc_errors}, "
+                f"framing_errors={self.framing_errors}, dropped_bytes={self.dropped_bytes}, "
+                f"dropped_packets={self.dropped_packets}, timeouts={self.command_timeouts}, "
+                f"retries={self.command_retries}, "
+                f"late_responses={self.late_responses}, rtt=[{self.command_rtt}]")
+
+
+class _StatsCollector:
+    """The live counters of a client. Counters are lists indexed by packet type
+    value or endpoint, to keep the counting cheap."""
+
+    __slots__ = ("rx_packets", "rx_bytes", "tx_packets", "tx_bytes", "rx_endpoint_packets",
+                 "rx_endpoint_bytes", "tx_endpoint_packets", "tx_endpoint_bytes", "rx_wire_bytes",
+                 "tx_wire_bytes", "dropped_packets", "command_timeouts", "command_retries",
+                 "late_responses", "queue_high_water", "command_rtt", "callback_time")
+
+    def __init__(self):
+        self.rx_packets = [0] * len(_TYPE_NAMES)
+        self.rx_bytes = [0] * len(_TYPE_NAMES)
+        self.tx_packets = [0] * len(_TYPE_NAMES)
+        self.tx_bytes = [0] * len(_TYPE_NAMES)
+        self.rx_endpoint_packets = [0] * _NUM_ENDPOINTS
+        self.rx_endpoint_bytes = [0] * _NUM_ENDPOINTS
+        self.tx_endpoint_packets = [0] * _NUM_ENDPOINTS
+        self.tx_endpoint_bytes = [0] * _NUM_ENDPOINTS
+        self.rx_wire_bytes = 0
+        self.tx_wire_bytes = 0
+        self.dropped_packets = 0
+        self.command_timeouts = 0
+        self.command_retries = 0
+        self.late_responses = 0
+        self.queue_high_water = 0
+        self.command_rtt = LatencyHistogram()
+        self.callback_time = LatencyHistogram()
+
+    def count_rx(self, packet_type: PacketType, endpoint: Optional[int], size: int) -> None:
+        """Counts a received packet. Endpoint is None for responses and logs."""
+        t = packet_type.value
+        self.rx_packets[t] += 1
+        self.rx_bytes[t] += size
+        if endpoint is not None:
+            self.rx_endpoint_packets[endpoint] += 1
+            self.rx_endpoint_bytes[endpoint] += size
+
+    def count_tx(self, packet_type: PacketType, endpoint: Optional[int], size: int) -> None:
+        """Counts a sent packet. Endpoint is None for responses and logs."""
+        t = packet_type.value
+        self.tx_packets[t] += 1
+        self.tx_bytes[t] += size
+        if endpoint is not None:
+            self.tx_endpoint_packets[endpoint] += 1
+            self.tx_endpoint_bytes[endpoint] += size
+
+    def snapshot(self, crc_errors: int, framing_errors: int, dropped_bytes: int) -> PacketsStats:
+        """Returns a snapshot of the counters, with the given decoder counters."""
+        result = PacketsStats()
+        for i, name in enumerate(_TYPE_NAMES):
+            if name:
+                result.rx_packets[name] = self.rx_packets[i]
+                result.rx_bytes[name] = self.rx_bytes[i]
+                result.tx_packets[name] = self.tx_packets[i]
+                result.tx_bytes[name] = self.tx_bytes[i]
+        for endpoint in range(_NUM_ENDPOINTS):
+            if self.rx_endpoint_packets[endpoint]:
+                result.rx_endpoint_packets[endpoint] = self.rx_endpoint_packets[endpoint]
+                result.rx_endpoint_bytes[endpoint] = self.rx_endpoint_bytes[endpoint]
+            if self.tx_endpoint_packets[endpoint]:
+                result.tx_endpoint_packets[endpoint] = self.tx_endpoint_packets[endpoint]
+                result.tx_endpoint_bytes[endpoint] = self.tx_endpoint_bytes[endpoint]
+        result.rx_wire_bytes = self.rx_wire_bytes
+        result.tx_wire_bytes = self.tx_wire_bytes
+        result.crc_errors = crc_errors
+        result.framing_errors = framing_errors
+        result.dropped_bytes = dropped_bytes
+        result.dropped_packets = self.dropped_packets
+        result.command_timeouts = self.command_timeouts
+        result.command_retries = self.command_retries
+        result.late_responses = self.late_responses
+        result.queue_high_water = self.queue_high_water
+        result.command_rtt = self.command_rtt.copy()
+        result.callback_time = self.callback_time.copy()
+        return result
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    items = ",".join(f'{k}="{_escape_label_value(str(v))}"' for k, v in labels.items())
+    return "{" + items + "}"
+
+
+def format_prometheus(stats: PacketsStats,
+                      prefix: str = "serial_packets",
+                      labels: Optional[Dict[str, str]] = None) -> str:
+    """Returns the stats in the Prometheus text exposition format.
+
+    Args:
+    * stats: The stats to format, e.g. as returned by SerialPacketsClient.stats().
+    * prefix: A prefix of the metric names.
+    * labels: Optional labels to add to all the metrics, e.g. {"port": "COM1"}.
+
+    Returns:
+    * A string with the metrics, to be served by an HTTP endpoint.
+    """
+    return _format_prometheus([(labels or {}, stats)], prefix)
+
+
+def format_prometheus_ports(stats_by_port: Dict[str, PacketsStats],
+                            prefix: str = "serial_packets",
+                            label: str = "port") -> str:
+    """Same as format_prometheus() but for the stats of multiple ports, e.g. as
+    returned by SerialPacketsHub.stats(). The metrics of each port are labeled
+    with the port name."""
+    return _format_prometheus([({label: port}, stats) for port, stats in stats_by_port.items()],
+                              prefix)
+
+
+def _format_prometheus(items: List[Tuple[Dict[str, str], PacketsStats]], prefix: str) -> str:
+    """Formats a list of (labels, stats)."""
+    lines = []
+
+    def metric(name: str, kind: str, help: str, get_values):
+        """get_values(stats) returns a list of (labels, value)."""
+        lines.append(f"# HELP {prefix}_{name} {help}")
+        lines.append(f"# TYPE {prefix}_{name} {kind}")
+        for labels, stats in items:
+            for value_labels, value in get_values(stats):
+                lines.append(f"{prefix}_{name}{_format_labels({**labels, **value_labels})} {value}")
+
+    def histogram(name: str, help: str, get_histogram):
+        lines.append(f"# HELP {prefix}_{name} {help}")
+        lines.append(f"# TYPE {prefix}_{name} histogram")
+        for labels, stats in items:
+            hist: LatencyHistogram = get_histogram(stats)
+            for upper_bound, n in zip(_PROMETHEUS_BUCKETS,
+                                      hist.cumulative_counts(_PROMETHEUS_BUCKETS)):
+                bucket_labels = _format_labels({**labels, "le": f"{upper_bound:.6f}"})
+                lines.append(f"{prefix}_{name}_bucket{bucket_labels} {n}")
+            inf_labels = _format_labels({**labels, "le": "+Inf"})
+            lines.append(f"{prefix}_{name}_bucket{inf_labels} {hist.count()}")
+            lines.append(f"{prefix}_{name}_sum{_format_labels(labels)} {hist.total()}")
+            lines.append(f"{prefix}_{name}_count{_format_labels(labels)} {hist.count()}")
+
+    def by_key(label: str, attr: str):
+        return lambda stats: [({label: str(k)}, n) for k, n in getattr(stats, attr).items()]
+
+    def single(attr: str):
+        return lambda stats: [({}, getattr(stats, attr))]
+
+    for d in ["rx", "tx"]:
+        metric(f"{d}_packets_total", "counter", f"Packets {d}, by type.",
+               by_key("type", f"{d}_packets"))
+        metric(f"{d}_data_bytes_total", "counter", f"Packets data bytes {d}, by type.",
+               by_key("type", f"{d}_bytes"))
+        metric(f"{d}_endpoint_packets_total", "counter",
+               f"Command and message packets {d}, by endpoint.",
+               by_key("endpoint", f"{d}_endpoint_packets"))
+        metric(f"{d}_endpoint_data_bytes_total", "counter",
+               f"Command and message data bytes {d}, by endpoint.",
+               by_key("endpoint", f"{d}_endpoint_bytes"))
+        metric(f"{d}_wire_bytes_total", "counter", f"Bytes {d} on the wire.",
+               single(f"{d}_wire_bytes"))
+    metric("crc_errors_total", "counter", "Packets dropped due to CRC errors.",
+           single("crc_errors"))
+    metric("framing_errors_total", "counter", "Packets dropped due to framing errors.",
+           single("framing_errors"))
+    metric("dropped_bytes_total", "counter", "Bytes dropped outside of packets.",
+           single("dropped_bytes"))
+    metric("dropped_packets_total", "counter", "Incoming packets dropped due to a full queue.",
+           single("dropped_packets"))
+    metric("command_timeouts_total", "counter", "Outgoing commands that timed out.",
+           single("command_timeouts"))
+    metric("command_retries_total", "counter", "Outgoing commands that were resent.",
+           single("command_retries"))
+    metric("late_responses_total", "counter", "Responses with no pending command.",
+           single("late_responses"))
+    metric("queue_high_water", "gauge", "Max number of items in the work queue.",
+           single("queue_high_water"))
+    histogram("command_rtt_seconds", "Round trip time of outgoing commands.",
+              lambda stats: stats.command_rtt)
+    histogram("callback_seconds", "Execution time of incoming packets handlers.",
+              lambda stats: stats.callback_time)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,331 @@
+from __future__ import annotations
+
+import abc
+import asyncio
+import collections
+import logging
+import os
+import serial_asyncio
+
+from typing import Callable, Deque, Optional, Tuple
+from asyncio.transports import BaseTransport
+
+logger = logging.getLogger(__name__)
+
+# Transports that a SerialPacketsClient can use to connect to the other node.
+# Each transport creates an asyncio (transport, protocol) connection, similar
+# to asyncio's loop.create_connection(), which the client then uses.
+
+ProtocolFactory = Callable[[], asyncio.Protocol]
+
+
+class PacketsTransport(abc.ABC):
+    """Base class of the transports."""
+
+    @abc.abstractmethod
+    async def connect(self,
+                      protocol_factory: ProtocolFactory) -> Tuple[BaseTransport, asyncio.Protocol]:
+        """Opens a connection. Returns the asyncio transport and the protocol that
+        was created with protocol_factory. Raises an exception if failed."""
+
+    def is_replay(self) -> bool:
+        """Tests if the incoming data is replayed, e.g. from a capture file, rather
+        than a response to what the client sends."""
+        return False
+
+
+class SerialPortTransport(PacketsTransport):
+    """A serial port, using pyserial-asyncio. This is the default transport."""
+
+    # pyserial_asyncio is documented at
+    # https://github.com/pyserial/pyserial-asyncio
+
+    def __init__(self, port: str, baudrate: int = 115200):
+        """Port is a string with the serial port to use. E.g. 'COM1'."""
+        self.__port = port
+        self.__baudrate = baudrate
+
+    def __str__(self) -> str:
+        return f"{self.__port}@{self.__baudrate}"
+
+    async def connect(self, protocol_factory: ProtocolFactory):
+        return await serial_asyncio.create_serial_connection(asyncio.get_running_loop(),
+                                                             protocol_factory,
+                                                             self.__port,
+                                                             baudrate=self.__baudrate)
+
+
+class TcpClientTransport(PacketsTransport):
+    """A TCP connection to a server, e.g. to a ser2net port."""
+
+    def __init__(self, host: str, port: int):
+        self.__host = host
+        self.__port = port
+
+    def __str__(self) -> str:
+        return f"tcp:{self.__host}:{self.__port}"
+
+    async def connect(self, protocol_factory: ProtocolFactory):
+        return await asyncio.get_running_loop().create_connection(protocol_factory, self.__host,
+                                                                  self.__port)
+
+
+class _AcceptProtocol(asyncio.Protocol):
+    """Accepts the first connection of a server, creating its actual protocol and
+    forwarding the callbacks to it. Other connections are rejected."""
+
+    def __init__(self, protocol_factory: ProtocolFactory, accepted: asyncio.Future):
+        self.__protocol_factory = protocol_factory
+        self.__accepted = accepted
+        self.__protocol: Optional[asyncio.Protocol] = None
+
+    def connection_made(self, transport: BaseTransport):
+        if self.__accepted.done():
+            logger.error("Already connected, rejecting a connection")
+            transport.close()
+            return
+        self.__protocol = self.__protocol_factory()
+        self.__accepted.set_result((transport, self.__protocol))
+        self.__protocol.connection_made(transport)
+
+    def data_received(self, data: bytes):
+        if self.__protocol:
+            self.__protocol.data_received(data)
+
+    def eof_received(self):
+        if self.__protocol:
+            return self.__protocol.eof_received()
+
+    def connection_lost(self, exc):
+        if self.__protocol:
+            self.__protocol.connection_lost(exc)
+
+    def pause_writing(self):
+        if self.__protocol:
+            self.__protocol.pause_writing()
+
+    def resume_writing(self):
+        if self.__protocol:
+            self.__protocol.resume_writing()
+
+
+class TcpServerTransport(PacketsTransport):
+    """A TCP server that accepts a single connection. connect() listens on the port
+    and returns once a connection was accepted."""
+
+    def __init__(self, host: Optional[str], port: int):
+        """host can be None to listen on all interfaces."""
+        self.__host = host
+        self.__port = port
+
+    def __str__(self) -> str:
+        return f"tcp_server:{self.__host or '*'}:{self.__port}"
+
+    async def connect(self, protocol_factory: ProtocolFactory):
+        loop = asyncio.get_running_loop()
+        accepted = loop.create_future()
+        server = await loop.create_server(lambda: _AcceptProtocol(protocol_factory, accepted),
+                                          self.__host, self.__port)
+        try:
+            return await accepted
+        finally:
+            # Stop listening. This doesn't close the accepted connection.
+            server.close()
+
+
+class UnixSocketTransport(PacketsTransport):
+    """A UNIX domain socket connection."""
+
+    def __init__(self, path: str):
+        self.__path = path
+
+    def __str__(self) -> str:
+        return f"unix:{self.__path}"
+
+    async def connect(self, protocol_factory: ProtocolFactory):
+        return await asyncio.get_running_loop().create_unix_connection(
+            protocol_factory, self.__path)
+
+
+class _FdWriteProtocol(asyncio.BaseProtocol):
+    """Forwards the write side callbacks of an fd connection to the actual protocol."""
+
+    def __init__(self, protocol: asyncio.Protocol):
+        self.__protocol = protocol
+
+    def pause_writing(self):
+        self.__protocol.pause_writing()
+
+    def resume_writing(self):
+        self.__protocol.resume_writing()
+
+
+class _FdAsyncioTransport(asyncio.Transport):
+    """Combines the read and write pipe transports of an fd connection."""
+
+    def __init__(self, read_transport: asyncio.ReadTransport,
+                 write_transport: asyncio.WriteTransport):
+        super().__init__()
+        self.__read_transport = read_transport
+        self.__write_transport = write_transport
+
+    def write(self, data):
+        self.__write_transport.write(data)
+
+    def pause_reading(self):
+        self.__read_transport.pause_reading()
+
+    def resume_reading(self):
+        self.__read_transport.resume_reading()
+
+    def is_reading(self):
+        return self.__read_transport.is_reading()
+
+    def get_write_buffer_size(self):
+        return self.__write_transport.get_write_buffer_size()
+
+    def is_closing(self):
+        return self.__read_transport.is_closing()
+
+    def close(self):
+        self.__write_transport.close()
+        self.__read_transport.close()
+
+
+class FdTransport(PacketsTransport):
+    """A raw file descriptor, such as a pty or a pipe, that is opened by the 
+    caller. For a pty, the caller should set it to raw mode (e.g. with tty.setraw()).
+    The transport uses duplicates of the fds, and the caller keeps the ownership
+    of the given fds."""
+
+    def __init__(self, read_fd: int, write_fd: Optional[int] = None):
+        """write_fd can be None to use read_fd for writing as well."""
+        self.__read_fd = read_fd
+        self.__write_fd = read_fd if write_fd is None else write_fd
+
+    def __str__(self) -> str:
+        return f"fd:{self.__read_fd}/{self.__write_fd}"
+
+    async def connect(self, protocol_factory: ProtocolFactory):
+        loop = asyncio.get_running_loop()
+        protocol = protocol_factory()
+        read_file = os.fdopen(os.dup(self.__read_fd), "rb", buffering=0)
+        write_file = os.fdopen(os.dup(self.__write_fd), "wb", buffering=0)
+        try:
+            write_transport, _ = await loop.connect_write_pipe(lambda: _FdWriteProtocol(protocol),
+                                                               write_file)
+        except:
+            read_file.close()
+            write_file.close()
+            raise
+        try:
+            read_transport, _ = await loop.connect_read_pipe(lambda: protocol, read_file)
+        except:
+            read_file.close()
+            write_transport.close()
+            raise
+        return (_FdAsyncioTransport(read_transport, write_transport), protocol)
+
+
+class _LoopbackAsyncioTransport(asyncio.Transport):
+    """The asyncio transport of one end of a loopback link."""
+
+    def __init__(self, protocol: asyncio.Protocol):
+        super().__init__()
+        self.__protocol = protocol
+        self.__peer: Optional[_LoopbackAsyncioTransport] = None
+        # Received chunks that were not delivered to the protocol yet.
+        self.__rx_chunks: Deque[bytes] = collections.deque()
+        self.__delivery_scheduled = False
+        self.__reading_paused = False
+        self.__closing = False
+
+    def _set_peer(self, peer: Optional[_LoopbackAsyncioTransport]) -> None:
+        self.__peer = peer
+
+    def _receive(self, data: bytes) -> None:
+        """Called by the peer with written data."""
+        self.__rx_chunks.append(data)
+        self.__schedule_delivery()
+
+    def __schedule_delivery(self) -> None:
+        if self.__rx_chunks and not self.__delivery_scheduled and not self.__reading_paused:
+            self.__delivery_scheduled = True
+            asyncio.get_running_loop().call_soon(self.__deliver)
+
+    def __deliver(self) -> None:
+        self.__delivery_scheduled = False
+        while self.__rx_chunks and not self.__reading_paused and not self.__closing:
+            self.__protocol.data_received(self.__rx_chunks.popleft())
+
+    def write(self, data) -> None:
+        if self.__closing:
+            return
+        if self.__peer:
+            self.__peer._receive(bytes(data))
+
+    def pause_reading(self) -> None:
+        self.__reading_paused = True
+
+    def resume_reading(self) -> None:
+        self.__reading_paused = False
+        self.__schedule_delivery()
+
+    def is_reading(self) -> bool:
+        return not self.__reading_paused
+
+    def get_write_buffer_size(self) -> int:
+        return 0
+
+    def is_closing(self) -> bool:
+        return self.__closing
+
+    def close(self) -> None:
+        """Closes this end. The peer end is closed as well, similar to a socket EOF."""
+        if self.__closing:
+            return
+        self.__closing = True
+        peer = self.__peer
+        self.__peer = None
+        asyncio.get_running_loop().call_soon(self.__protocol.connection_lost, None)
+        if peer:
+            peer._set_peer(None)
+            peer.close()
+
+
+class LoopbackTransport(PacketsTransport):
+    """One end of an in-process loopback link, that connects two clients in the
+    same event loop with no actual I/O. Create the two ends with pair(). Data that
+    is written before the other end is connected is dropped."""
+
+    def __init__(self, name: str):
+        self.__name = name
+        self.__other_end: Optional[LoopbackTransport] = None
+        self.__transport: Optional[_LoopbackAsyncioTransport] = None
+
+    def __str__(self) -> str:
+        return f"loopback:{self.__name}"
+
+    @staticmethod
+    def pair(name: Optional[str] = None) -> Tuple[LoopbackTransport, LoopbackTransport]:
+        """Returns the two ends of a new loopback link. The optional name is used to
+        name the ends as name/1 and name/2."""
+        prefix = f"{name}/" if name else ""
+        end1 = LoopbackTransport(f"{prefix}1")
+        end2 = LoopbackTransport(f"{prefix}2")
+        end1.__other_end = end2
+        end2.__other_end = end1
+        return (end1, end2)
+
+    async def connect(self, protocol_factory: ProtocolFactory):
+        if self.__transport and not self.__transport.is_closing():
+            raise ConnectionError(f"{self} is already connected")
+        protocol = protocol_factory()
+        transport = _LoopbackAsyncioTransport(protocol)
+        self.__transport = transport
+        other_transport = self.__other_end.__transport
+        if other_transport and not other_transport.is_closing():
+            transport._set_peer(other_transport)
+            other_transport._set_peer(transport)
+        asyncio.get_running_loop().call_soon(protocol.connection_made, transport)
+        return (transport, protocol)
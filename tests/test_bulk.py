@@ -0,0 +1,174 @@
+# Unit tests of bulk transfers.
+
+import asyncio
+import random
+import unittest
+import sys
+
+# Assuming VSCode project opened at repo directory
+sys.path.insert(0, "./src")
+
+from serial_packets import bulk
+from serial_packets.client import SerialPacketsClient
+from serial_packets.packets import PacketStatus
+from serial_packets.transports import LoopbackTransport, PacketsTransport
+
+
+class _LossyProtocol:
+    """Wraps a protocol and drops some of its incoming writes."""
+
+    def __init__(self, protocol, drop_rate: float, rnd: random.Random):
+        self.protocol = protocol
+        self.drop_rate = drop_rate
+        self.rnd = rnd
+
+    def data_received(self, data: bytes):
+        if self.rnd.random() >= self.drop_rate:
+            self.protocol.data_received(data)
+
+    def __getattr__(self, name):
+        return getattr(self.protocol, name)
+
+
+class LossyTransport(PacketsTransport):
+    """A loopback end that drops incoming packets at the given rate."""
+
+    def __init__(self, end: LoopbackTransport, drop_rate: float, seed: int):
+        self.__end = end
+        self.__drop_rate = drop_rate
+        self.__rnd = random.Random(seed)
+
+    async def connect(self, protocol_factory):
+        transport, protocol = await self.__end.connect(
+            lambda: _LossyProtocol(protocol_factory(), self.__drop_rate, self.__rnd))
+        return (transport, protocol.protocol)
+
+
+async def blocks(data: bytes, rnd: random.Random):
+    """Yields the data in blocks of random sizes."""
+    i = 0
+    while i < len(data):
+        n = rnd.choice([1, 7, 1000, 1013, 5000])
+        await asyncio.sleep(0)
+        yield data[i:i + n]
+        i += n
+
+
+class TestBulk(unittest.IsolatedAsyncioTestCase):
+
+    async def connect_pair(self, drop_rate: float = 0.0):
+        end1, end2 = LoopbackTransport.pair()
+        if drop_rate:
+            end1 = LossyTransport(end1, drop_rate, 1)
+            end2 = LossyTransport(end2, drop_rate, 2)
+        client = SerialPacketsClient(end1)
+        device = SerialPacketsClient(end2)
+        self.assertTrue(await client.connect())
+        self.assertTrue(await device.connect())
+        await asyncio.sleep(0)
+        return (client, device)
+
+    async def test_send_and_receive(self):
+        client, device = await self.connect_pair()
+        data = random.Random(1).randbytes(100_000)
+        send_task = asyncio.create_task(client.send_bulk(5, data))
+        transfer = await device.receive_bulk(5)
+        self.assertEqual(transfer.endpoint(), 5)
+        received = bytearray()
+        async for chunk in transfer:
+            self.assertLessEqual(len(chunk), bulk.MAX_BULK_CHUNK_LEN)
+            received += chunk
+        self.assertEqual(received, data)
+        self.assertEqual(transfer.status(), PacketStatus.OK.value)
+        self.assertEqual(await send_task, PacketStatus.OK.value)
+        # The chunks are sent as messages to the reserved endpoint.
+        self.assertEqual(client.stats().tx_endpoint_packets, {200: 99})
+        self.assertEqual(device.stats().rx_endpoint_packets, {200: 99})
+
+    async def test_async_iterable_source(self):
+        client, device = await self.connect_pair()
+        rnd = random.Random(2)
+        data = rnd.randbytes(30_000)
+        send_task = asyncio.create_task(client.send_bulk(7, blocks(data, rnd), window=4))
+        transfer = await device.receive_bulk(7)
+        self.assertEqual(await transfer.read_all(), (PacketStatus.OK.value, data))
+        self.assertEqual(await send_task, PacketStatus.OK.value)
+
+    async def test_empty_and_pending(self):
+        client, device = await self.connect_pair()
+        # Small transfers complete before receive_bulk() is called.
+        self.assertEqual(await client.send_bulk(3, b""), PacketStatus.OK.value)
+        self.assertEqual(await client.send_bulk(3, b"abc"), PacketStatus.OK.value)
+        transfer = await device.receive_bulk(3)
+        self.assertTrue(transfer.is_received())
+        self.assertEqual(await transfer.read_all(), (PacketStatus.OK.value, b""))
+        transfer = await device.receive_bulk(3)
+        self.assertEqual(await transfer.read_all(), (PacketStatus.OK.value, b"abc"))
+
+    async def test_lossy_link(self):
+        client, device = await self.connect_pair(drop_rate=0.1)
+        data = random.Random(3).randbytes(200_000)
+        send_task = asyncio.create_task(client.send_bulk(1, data, timeout=10.0))
+        transfer = await device.receive_bulk(1)
+        self.assertEqual(await transfer.read_all(), (PacketStatus.OK.value, data))
+        self.assertEqual(await send_task, PacketStatus.OK.value)
+
+    async def test_slow_receiver(self):
+        """The sender should wait while the receiver's window is full."""
+        client, device = await self.connect_pair()
+        data = random.Random(4).randbytes(100 * bulk.MAX_BULK_CHUNK_LEN)
+        send_task = asyncio.create_task(client.send_bulk(2, data))
+        transfer = await device.receive_bulk(2)
+        await asyncio.sleep(0.05)
+        # Only a window of chunks was sent.
+        self.assertEqual(client.stats().tx_packets["message"], bulk._RECEIVE_WINDOW)
+        received = bytearray()
+        async for chunk in transfer:
+            received += chunk
+            await asyncio.sleep(0.001)
+        self.assertEqual(received, data)
+        self.assertEqual(await send_task, PacketStatus.OK.value)
+
+    async def test_abort_by_receiver(self):
+        client, device = await self.connect_pair()
+        data = bytes(100 * bulk.MAX_BULK_CHUNK_LEN)
+        send_task = asyncio.create_task(client.send_bulk(2, data))
+        transfer = await device.receive_bulk(2)
+        async for chunk in transfer:
+            transfer.abort(PacketStatus.OUT_OF_RANGE.value)
+        self.assertEqual(transfer.status(), PacketStatus.OUT_OF_RANGE.value)
+        self.assertEqual(await send_task, PacketStatus.OUT_OF_RANGE.value)
+
+    async def test_timeout(self):
+        # The other end is not connected, so nothing is acked.
+        end1, _ = LoopbackTransport.pair()
+        client = SerialPacketsClient(end1)
+        self.assertTrue(await client.connect())
+        await asyncio.sleep(0)
+        start = asyncio.get_running_loop().time()
+        self.assertEqual(await client.send_bulk(1, b"x" * 5000, timeout=0.5),
+                         PacketStatus.TIMEOUT.value)
+        self.assertGreaterEqual(asyncio.get_running_loop().time() - start, 0.5)
+
+    async def test_receiver_expiry(self):
+        """Receivers should be dropped when the sender goes quiet, e.g. when its
+        last chunk and its abort are lost."""
+        frames = []
+        channel = bulk._BulkChannel(frames.append)
+        loop = asyncio.get_running_loop()
+        for transfer_id in (1, 2):
+            channel.on_frame(bulk._DATA_HEADER.pack(bulk._DATA, transfer_id, 0, 3, 0, 20) + b"ab",
+                             loop.time())
+        # The first transfer is read, the second waits for receive().
+        transfer = await channel.receive(3)
+        self.assertEqual(await transfer.read_all(), (PacketStatus.TIMEOUT.value, b"ab"))
+        await asyncio.sleep(0.01)
+        aborts = [bulk._ABORT_FRAME.unpack(frame) for frame in frames if frame[0] == bulk._ABORT]
+        self.assertEqual(aborts, [(bulk._ABORT, 1, PacketStatus.TIMEOUT.value),
+                                  (bulk._ABORT, 2, PacketStatus.TIMEOUT.value)])
+        self.assertFalse(channel._BulkChannel__receivers)
+        self.assertFalse(channel._BulkChannel__pending[3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+# Unit tests of the capture recorder and replay.
+
+import asyncio
+import os
+import tempfile
+import unittest
+import sys
+
+# Assuming VSCode project opened at repo directory
+sys.path.insert(0, "./src")
+
+from serial_packets.capture import (CAPTURE_RX, CAPTURE_TX, CaptureReader, CaptureRecorder,
+                                    ReplayTransport, decode_capture)
+from serial_packets.client import SerialPacketsClient
+from serial_packets.packet_decoder import DecodedMessagePacket
+from serial_packets.packet_encoder import PacketEncoder
+from serial_packets.packets import PacketData, PacketStatus
+from serial_packets.transports import LoopbackTransport
+
+
+class TestCapture(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "capture.spcap")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    async def record_session(self):
+        """Records a session with a command and a few messages from the device."""
+
+        async def echo(endpoint: int, data: PacketData):
+            return (PacketStatus.OK.value, data)
+
+        end1, end2 = LoopbackTransport.pair()
+        recorder = CaptureRecorder(self.path)
+        client = SerialPacketsClient(end1, recorder=recorder)
+        device = SerialPacketsClient(end2, command_async_callback=echo)
+        self.assertTrue(await client.connect())
+        self.assertTrue(await device.connect())
+        await asyncio.sleep(0)
+        status, data = await client.send_command_blocking(5, PacketData().add_uint16(0x7e7d))
+        self.assertEqual(status, PacketStatus.OK.value)
+        for i in range(10):
+            device.send_message(7, PacketData().add_uint8(i))
+            await asyncio.sleep(0.001)
+        await asyncio.sleep(0.02)
+        recorder.close()
+        client._SerialPacketsClient__transport.close()
+        device._SerialPacketsClient__transport.close()
+        await asyncio.sleep(0.01)
+        return client.stats()
+
+    async def test_record_and_read(self):
+        stats = await self.record_session()
+        rx = bytearray()
+        tx = bytearray()
+        last_time = 0
+        with CaptureReader(self.path) as reader:
+            for direction, t, chunk in reader.records():
+                self.assertIn(direction, (CAPTURE_RX, CAPTURE_TX))
+                self.assertGreaterEqual(t, last_time)
+                last_time = t
+                (rx if direction == CAPTURE_RX else tx).extend(chunk)
+        self.assertEqual(len(rx), stats.rx_wire_bytes)
+        self.assertEqual(len(tx), stats.tx_wire_bytes)
+        packets = [packet for _, packet in decode_capture(self.path)]
+        self.assertEqual(len(packets), 11)
+        self.assertEqual([p.data.read_uint8() for p in packets[1:]], list(range(10)))
+
+    async def test_truncated_capture(self):
+        encoder = PacketEncoder()
+        with CaptureRecorder(self.path) as recorder:
+            for i in range(3):
+                recorder.record_rx(encoder.encode_message_packet(7, bytearray([i])))
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+        packets = [packet for _, packet in decode_capture(self.path)]
+        self.assertEqual(len(packets), 2)
+        self.assertIsInstance(packets[0], DecodedMessagePacket)
+
+    async def test_not_a_capture(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not a capture file")
+        with self.assertRaises(ValueError):
+            CaptureReader(self.path)
+
+    async def test_replay(self):
+        await self.record_session()
+        for realtime in (False, True):
+            messages = []
+
+            async def on_message(endpoint: int, data: PacketData):
+                messages.append((endpoint, data.read_uint8()))
+
+            transport = ReplayTransport(self.path, realtime=realtime, speed=4.0)
+            client = SerialPacketsClient(transport, message_async_callback=on_message)
+            self.assertTrue(await client.connect())
+            num_bytes, _ = await transport.wait_finished()
+            await asyncio.sleep(0.01)
+            self.assertEqual(messages, [(7, i) for i in range(10)])
+            self.assertEqual(client.stats().rx_wire_bytes, num_bytes)
+            self.assertFalse(client.is_connected())
+            # The recorded response is dropped quietly.
+            self.assertEqual(client.stats().rx_packets["response"], 1)
+            self.assertEqual(client.stats().late_responses, 0)
+
+    async def test_no_overwrite(self):
+        await self.record_session()
+        size = os.path.getsize(self.path)
+        with self.assertRaises(FileExistsError):
+            CaptureRecorder(self.path)
+        self.assertEqual(os.path.getsize(self.path), size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,581 @@
+# Unit tests of SerialPacketsClient
+
+import asyncio
+import functools
+import unittest
+import sys
+from unittest import mock
+
+# Assuming VSCode project opened at repo directory
+sys.path.insert(0, "./src")
+
+from serial_packets.client import SerialPacketsClient, _SerialProtocol
+from serial_packets.packet_decoder import PacketDecoder
+from serial_packets.packet_encoder import PacketEncoder
+from serial_packets.packets import PacketData, PacketStatus, PacketsEventType, QueueOverflowPolicy, RetryPolicy
+from serial_packets.transports import LoopbackTransport
+
+
+class FakeTransport:
+    """A transport that records the written data."""
+
+    def __init__(self):
+        self.writes = []
+        self.reading_paused = False
+
+    def write(self, data):
+        self.writes.append(bytes(data))
+
+    def pause_reading(self):
+        self.reading_paused = True
+
+    def resume_reading(self):
+        self.reading_paused = False
+
+
+def connect_fake(client: SerialPacketsClient) -> _SerialProtocol:
+    """Connects the client to a fake transport. Returns the protocol."""
+    transport = FakeTransport()
+    protocol = _SerialProtocol()
+    protocol.set(client, "fake", client._SerialPacketsClient__packet_decoder)
+    client._SerialPacketsClient__transport = transport
+    client._SerialPacketsClient__protocol = protocol
+    protocol.connection_made(transport)
+    return protocol
+
+
+class TestSerialPacketsClient(unittest.IsolatedAsyncioTestCase):
+
+    async def test_send_messages(self):
+        client = SerialPacketsClient("fake")
+        connect_fake(client)
+        transport = client._SerialPacketsClient__transport
+        messages = [(10, PacketData().add_uint8(0x7e)), (11, PacketData()),
+                    (12, PacketData().add_uint32(12345678))]
+        client.send_messages(messages)
+        e = PacketEncoder()
+        expected = bytearray()
+        for endpoint, data in messages:
+            expected.extend(e.encode_message_packet(endpoint, data.data_bytes()))
+        self.assertEqual(transport.writes, [bytes(expected)])
+
+    async def test_send_commands_futures(self):
+        client = SerialPacketsClient("fake")
+        protocol = connect_fake(client)
+        transport = client._SerialPacketsClient__transport
+        futures = client.send_commands_futures([(20, PacketData().add_uint8(1)),
+                                                (21, PacketData().add_uint8(2))])
+        self.assertEqual(len(transport.writes), 1)
+        self.assertEqual(len(futures), 2)
+        # Respond in reverse order.
+        e = PacketEncoder()
+        protocol.data_received(
+            bytes(e.encode_response_packet(2, 0, bytearray([0x22])) +
+                  e.encode_response_packet(1, 0, bytearray([0x11]))))
+        results = await asyncio.wait_for(asyncio.gather(*futures), timeout=1.0)
+        self.assertEqual([(s, d.data_bytes()) for s, d in results],
+                         [(0, bytearray([0x11])), (0, bytearray([0x22]))])
+
+    async def test_send_commands_futures_not_connected(self):
+        client = SerialPacketsClient("fake")
+        futures = client.send_commands_futures([(20, PacketData())])
+        status, _ = await futures[0]
+        self.assertEqual(status, PacketStatus.NOT_CONNECTED.value)
+
+    async def test_command_timeout(self):
+        client = SerialPacketsClient("fake")
+        connect_fake(client)
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        status, data = await client.send_command_blocking(20, PacketData(), timeout=0.1)
+        self.assertEqual(status, PacketStatus.TIMEOUT.value)
+        self.assertEqual(data.size(), 0)
+        self.assertAlmostEqual(loop.time() - start_time, 0.1, delta=0.05)
+        self.assertEqual(len(client._SerialPacketsClient__tx_cmd_contexts), 0)
+
+    async def test_command_response_cancels_timeout(self):
+        client = SerialPacketsClient("fake")
+        protocol = connect_fake(client)
+        future = client.send_command_future(20, PacketData(), timeout=0.1)
+        protocol.data_received(bytes(PacketEncoder().encode_response_packet(1, 0, bytearray())))
+        status, _ = await future
+        self.assertEqual(status, PacketStatus.OK.value)
+        await asyncio.sleep(0.15)
+        self.assertEqual(len(client._SerialPacketsClient__tx_cmd_contexts), 0)
+
+    async def test_stats(self):
+
+        async def command_async_callback(endpoint: int, data: PacketData):
+            return (PacketStatus.OK.value, PacketData().add_uint8(1))
+
+        client = SerialPacketsClient("fake", command_async_callback=command_async_callback)
+        protocol = connect_fake(client)
+        transport = client._SerialPacketsClient__transport
+        e = PacketEncoder()
+        future = client.send_command_future(20, PacketData().add_uint16(7))
+        client.send_message(21, PacketData())
+        cmd_packet = bytes(e.encode_command_packet(1000, 30, bytearray(5)))
+        rx_data = (bytes(e.encode_response_packet(1, 0, bytearray(3))) +
+                   bytes(e.encode_response_packet(99, 0, bytearray())) + cmd_packet +
+                   bytes(e.encode_message_packet(31, bytearray(2))) + bytes([0x7c, 0x01, 0x7e]))
+        protocol.data_received(rx_data)
+        await future
+        await asyncio.sleep(0.01)
+        stats = client.stats()
+        self.assertEqual(stats.tx_packets, {"command": 1, "response": 1, "message": 1, "log": 0})
+        self.assertEqual(stats.tx_bytes, {"command": 2, "response": 1, "message": 0, "log": 0})
+        self.assertEqual(stats.tx_endpoint_packets, {20: 1, 21: 1})
+        self.assertEqual(stats.rx_packets, {"command": 1, "response": 2, "message": 1, "log": 0})
+        self.assertEqual(stats.rx_endpoint_bytes, {30: 5, 31: 2})
+        self.assertEqual(stats.rx_wire_bytes, len(rx_data))
+        self.assertEqual(stats.tx_wire_bytes, sum(len(w) for w in transport.writes))
+        self.assertEqual(stats.framing_errors, 1)
+        self.assertEqual(stats.late_responses, 1)
+        self.assertEqual(stats.command_rtt.count(), 1)
+        self.assertEqual(stats.callback_time.count(), 2)
+        self.assertGreaterEqual(stats.queue_high_water, 2)
+        await client.send_command_blocking(20, PacketData(), timeout=0.1)
+        self.assertEqual(client.stats().command_timeouts, 1)
+
+    async def test_response_bypasses_busy_workers(self):
+        release = asyncio.Event()
+
+        async def message_async_callback(endpoint: int, data: PacketData):
+            await release.wait()
+
+        client = SerialPacketsClient("fake", message_async_callback=message_async_callback, workers=1)
+        protocol = connect_fake(client)
+        e = PacketEncoder()
+        future = client.send_command_future(20, PacketData())
+        # Occupy the single worker with a message and then send the response.
+        protocol.data_received(bytes(e.encode_message_packet(30, bytearray())))
+        await asyncio.sleep(0.01)
+        protocol.data_received(bytes(e.encode_response_packet(1, 0, bytearray())))
+        status, _ = await asyncio.wait_for(future, timeout=0.5)
+        self.assertEqual(status, PacketStatus.OK.value)
+        release.set()
+
+    async def _run_queue_overflow(self, policy: QueueOverflowPolicy, endpoints):
+        """Sends messages to a client with blocked workers. Returns the endpoints of
+        the messages in the queue, the client, and a function to release the workers."""
+        release = asyncio.Event()
+
+        async def message_async_callback(endpoint: int, data: PacketData):
+            await release.wait()
+
+        client = SerialPacketsClient("fake",
+                                     message_async_callback=message_async_callback,
+                                     workers=1,
+                                     max_queue_size=3,
+                                     queue_overflow_policy=policy)
+        protocol = connect_fake(client)
+        e = PacketEncoder()
+        for endpoint in endpoints:
+            protocol.data_received(bytes(e.encode_message_packet(endpoint, bytearray())))
+        queue = client._SerialPacketsClient__work_queue
+        queued = [
+            item.endpoint for lane in queue._WorkQueue__lanes.values() for item in lane
+            if hasattr(item, "endpoint")
+        ]
+        return queued, client, release
+
+    async def test_queue_overflow_drop_newest(self):
+        queued, _, release = await self._run_queue_overflow(QueueOverflowPolicy.DROP_NEWEST,
+                                                            [1, 2, 3, 4, 5])
+        self.assertEqual(queued, [1, 2, 3])
+        release.set()
+
+    async def test_queue_overflow_drop_oldest(self):
+        queued, _, release = await self._run_queue_overflow(QueueOverflowPolicy.DROP_OLDEST,
+                                                            [1, 2, 3, 4, 5])
+        self.assertEqual(queued, [3, 4, 5])
+        release.set()
+
+    async def test_queue_overflow_coalesce(self):
+        queued, _, release = await self._run_queue_overflow(QueueOverflowPolicy.COALESCE,
+                                                            [1, 2, 3, 2, 4])
+        self.assertEqual(queued, [1, 2, 3])
+        release.set()
+
+    async def test_queue_overflow_pause_reading(self):
+        queued, client, release = await self._run_queue_overflow(
+            QueueOverflowPolicy.PAUSE_READING, [1, 2, 3, 4])
+        transport = client._SerialPacketsClient__transport
+        self.assertEqual(queued, [1, 2, 3, 4])
+        self.assertTrue(transport.reading_paused)
+        release.set()
+        await asyncio.sleep(0.01)
+        self.assertFalse(transport.reading_paused)
+
+    async def test_pause_reading_resumes_on_paused_lane(self):
+        """Reading should resume only when the lane that paused it is drained."""
+        releases = {1: asyncio.Event(), 2: asyncio.Event()}
+
+        async def message_async_callback(endpoint: int, data: PacketData):
+            await releases[endpoint].wait()
+
+        client = SerialPacketsClient("fake",
+                                     message_async_callback=message_async_callback,
+                                     workers=2,
+                                     endpoint_lanes=True,
+                                     max_queue_size=4,
+                                     queue_overflow_policy=QueueOverflowPolicy.PAUSE_READING)
+        protocol = connect_fake(client)
+        transport = client._SerialPacketsClient__transport
+        e = PacketEncoder()
+        for endpoint in [1, 1, 1, 1, 1, 2]:
+            protocol.data_received(bytes(e.encode_message_packet(endpoint, bytearray())))
+        self.assertTrue(transport.reading_paused)
+        # Dequeuing from the short lane of endpoint 2 doesn't resume reading.
+        releases[2].set()
+        await asyncio.sleep(0.01)
+        self.assertTrue(transport.reading_paused)
+        releases[1].set()
+        await asyncio.sleep(0.01)
+        self.assertFalse(transport.reading_paused)
+
+    async def test_dropped_packets_event(self):
+        events = []
+        release = asyncio.Event()
+
+        async def event_async_callback(event):
+            if event.event_type == PacketsEventType.PACKETS_DROPPED:
+                events.append(event.description)
+
+        async def message_async_callback(endpoint: int, data: PacketData):
+            await release.wait()
+
+        client = SerialPacketsClient("fake",
+                                     event_async_callback=event_async_callback,
+                                     message_async_callback=message_async_callback,
+                                     workers=2,
+                                     max_queue_size=1)
+        protocol = connect_fake(client)
+        e = PacketEncoder()
+        with mock.patch("serial_packets.client._DROPPED_PACKETS_REPORT_INTERVAL", 0.01):
+            for endpoint in [1, 2, 3]:
+                protocol.data_received(bytes(e.encode_message_packet(endpoint, bytearray())))
+        await asyncio.sleep(0.05)
+        self.assertEqual(events, ["Dropped 2 incoming packets"])
+        self.assertEqual(client.stats().dropped_packets, 2)
+        release.set()
+
+    async def test_endpoint_handlers(self):
+        calls = []
+
+        def sync_command_handler(endpoint: int, data: PacketData):
+            calls.append(("sync_command", endpoint))
+            return (PacketStatus.OK.value, PacketData().add_uint8(0x11))
+
+        async def async_message_handler(endpoint: int, data: PacketData):
+            calls.append(("async_message", endpoint))
+
+        async def message_async_callback(endpoint: int, data: PacketData):
+            calls.append(("message_callback", endpoint))
+
+        client = SerialPacketsClient("fake", message_async_callback=message_async_callback,
+                                     workers=1)
+        client.register_command_handler(20, sync_command_handler)
+        client.register_message_handler(30, async_message_handler)
+        protocol = connect_fake(client)
+        transport = client._SerialPacketsClient__transport
+        e = PacketEncoder()
+        protocol.data_received(
+            bytes(
+                e.encode_command_packet(7, 20, bytearray()) +
+                e.encode_message_packet(30, bytearray()) +
+                e.encode_message_packet(31, bytearray())))
+        await asyncio.sleep(0.01)
+        self.assertEqual(calls, [("sync_command", 20), ("async_message", 30),
+                                 ("message_callback", 31)])
+        self.assertEqual(transport.writes, [bytes(e.encode_response_packet(7, 0, bytearray([0x11])))])
+        # Unregister
+        client.register_message_handler(30, None)
+        protocol.data_received(bytes(e.encode_message_packet(30, bytearray())))
+        await asyncio.sleep(0.01)
+        self.assertEqual(calls[-1], ("message_callback", 30))
+
+    async def test_endpoint_handlers_dispatch(self):
+        calls = []
+
+        def sync_message_handler(endpoint: int, data: PacketData):
+            calls.append(("sync", endpoint))
+
+        async def async_command_handler(tag: str, endpoint: int, data: PacketData):
+            calls.append((tag, endpoint))
+            return (PacketStatus.OK.value, PacketData())
+
+        class AsyncCallable:
+
+            async def __call__(self, endpoint: int, data: PacketData):
+                calls.append(("callable", endpoint))
+
+        def failing_handler(endpoint: int, data: PacketData):
+            raise ValueError("failed")
+
+        def coroutine_handler(endpoint: int, data: PacketData):
+            return async_command_handler("coroutine", endpoint, data)
+
+        client = SerialPacketsClient("fake", workers=1)
+        client.register_message_handler(1, sync_message_handler)
+        client.register_command_handler(2, functools.partial(async_command_handler, "partial"))
+        client.register_message_handler(3, AsyncCallable())
+        client.register_message_handler(4, failing_handler)
+        client.register_command_handler(5, coroutine_handler)
+        protocol = connect_fake(client)
+        transport = client._SerialPacketsClient__transport
+        e = PacketEncoder()
+        protocol.data_received(
+            bytes(
+                e.encode_command_packet(7, 2, bytearray()) +
+                e.encode_message_packet(3, bytearray()) +
+                e.encode_message_packet(4, bytearray()) +
+                e.encode_message_packet(1, bytearray())))
+        # The sync handler was called inline, ahead of the queued async ones.
+        self.assertEqual(calls, [("sync", 1)])
+        await asyncio.sleep(0.01)
+        self.assertEqual(calls, [("sync", 1), ("partial", 2), ("callable", 3)])
+        self.assertEqual(client.stats().rx_endpoint_packets, {1: 1, 2: 1, 3: 1, 4: 1})
+        # A regular function that returns a coroutine is awaited.
+        protocol.data_received(bytes(e.encode_command_packet(8, 5, bytearray())))
+        await asyncio.sleep(0.01)
+        self.assertEqual(calls[-1], ("coroutine", 5))
+        self.assertEqual(transport.writes, [
+            bytes(e.encode_response_packet(7, 0, bytearray())),
+            bytes(e.encode_response_packet(8, 0, bytearray()))
+        ])
+
+    async def test_endpoint_lanes(self):
+        calls = []
+
+        async def message_async_callback(endpoint: int, data: PacketData):
+            calls.append(("start", endpoint, data.read_uint8()))
+            await asyncio.sleep(0.01 * data.read_uint8())
+            calls.append(("end", endpoint))
+
+        client = SerialPacketsClient("fake",
+                                     message_async_callback=message_async_callback,
+                                     workers=5,
+                                     endpoint_lanes=True)
+        protocol = connect_fake(client)
+        e = PacketEncoder()
+        protocol.data_received(
+            bytes(
+                e.encode_message_packet(30, bytearray([1, 3])) +
+                e.encode_message_packet(30, bytearray([2, 1])) +
+                e.encode_message_packet(31, bytearray([3, 1]))))
+        await asyncio.sleep(0.1)
+        # Endpoint 30 is served in order, concurrently with endpoint 31.
+        self.assertEqual(calls, [("start", 30, 1), ("start", 31, 3), ("end", 31), ("end", 30),
+                                 ("start", 30, 2), ("end", 30)])
+
+    async def test_coalesce_writes(self):
+        client = SerialPacketsClient("fake", coalesce_writes=True)
+        connect_fake(client)
+        transport = client._SerialPacketsClient__transport
+        client.send_message(10, PacketData().add_uint8(1))
+        future = client.send_command_future(11, PacketData().add_uint8(0x7e))
+        encoder = client._SerialPacketsClient__packet_encoder
+        # A failed encoding leaves nothing in the pending writes.
+        with mock.patch.object(encoder, "encode_message_packet_into", side_effect=ValueError()):
+            with self.assertRaises(ValueError):
+                client.send_message(12, PacketData())
+        self.assertEqual(transport.writes, [])
+        await asyncio.sleep(0)
+        e = PacketEncoder()
+        expected = e.encode_message_packet(10, bytearray([1])) + e.encode_command_packet(
+            1, 11, bytearray([0x7e]))
+        self.assertEqual(transport.writes, [bytes(expected)])
+        self.assertEqual(client.stats().tx_wire_bytes, len(expected))
+        future.cancel()
+
+    def sent_commands(self, transport: FakeTransport):
+        """Returns the (cmd_id, endpoint) of the commands that were written."""
+        decoder = PacketDecoder()
+        return [(p.cmd_id, p.endpoint) for w in transport.writes for p in decoder.receive_bytes(w)]
+
+    async def test_commands_window(self):
+        client = SerialPacketsClient("fake", max_commands_in_flight=2, max_endpoint_commands_in_flight=1)
+        protocol = connect_fake(client)
+        transport = client._SerialPacketsClient__transport
+        futures = [client.send_command_future(ep, PacketData().add_uint8(ep)) for ep in (20, 20, 21, 22)]
+        self.assertEqual(self.sent_commands(transport), [(1, 20), (2, 21)])
+        self.assertEqual((client.commands_in_flight(), client.commands_waiting()), (2, 2))
+        e = PacketEncoder()
+        protocol.data_received(bytes(e.encode_response_packet(1, 0, bytearray([1]))))
+        self.assertEqual(self.sent_commands(transport), [(1, 20), (2, 21), (3, 22)])
+        protocol.data_received(bytes(e.encode_response_packet(2, 0, bytearray([2]))))
+        self.assertEqual(self.sent_commands(transport), [(1, 20), (2, 21), (3, 22), (4, 20)])
+        protocol.data_received(
+            bytes(e.encode_response_packet(3, 0, bytearray([3])) +
+                  e.encode_response_packet(4, 0, bytearray([4]))))
+        results = await asyncio.wait_for(asyncio.gather(*futures), timeout=1.0)
+        self.assertEqual([d.data_bytes() for _, d in results],
+                         [bytearray([1]), bytearray([4]), bytearray([2]), bytearray([3])])
+        self.assertEqual((client.commands_in_flight(), client.commands_waiting()), (0, 0))
+
+    async def test_commands_window_timeout_starts_on_send(self):
+        client = SerialPacketsClient("fake", max_commands_in_flight=1)
+        connect_fake(client)
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        future1 = client.send_command_future(20, PacketData(), timeout=0.1)
+        future2 = client.send_command_future(20, PacketData(), timeout=0.1)
+        self.assertEqual((await future1)[0], PacketStatus.TIMEOUT.value)
+        self.assertEqual((await future2)[0], PacketStatus.TIMEOUT.value)
+        self.assertAlmostEqual(loop.time() - start_time, 0.2, delta=0.05)
+
+    async def test_commands_window_batch(self):
+        client = SerialPacketsClient("fake", max_commands_in_flight=2)
+        protocol = connect_fake(client)
+        transport = client._SerialPacketsClient__transport
+        futures = client.send_commands_futures([(20 + i, PacketData().add_uint8(i)) for i in range(3)])
+        self.assertEqual(len(transport.writes), 1)
+        self.assertEqual(self.sent_commands(transport), [(1, 20), (2, 21)])
+        e = PacketEncoder()
+        protocol.data_received(bytes(e.encode_response_packet(2, 0, bytearray([2]))))
+        self.assertEqual(self.sent_commands(transport), [(1, 20), (2, 21), (3, 22)])
+        protocol.data_received(
+            bytes(e.encode_response_packet(1, 0, bytearray([1])) +
+                  e.encode_response_packet(3, 0, bytearray([3]))))
+        results = await asyncio.wait_for(asyncio.gather(*futures), timeout=1.0)
+        self.assertEqual([d.data_bytes() for _, d in results],
+                         [bytearray([1]), bytearray([2]), bytearray([3])])
+
+    async def test_commands_batch_encoding_error(self):
+        """An encoding error in a batch should leave no commands in flight."""
+        client = SerialPacketsClient("fake", max_commands_in_flight=2)
+        connect_fake(client)
+        transport = client._SerialPacketsClient__transport
+        encoder = client._SerialPacketsClient__packet_encoder
+        encode = encoder.encode_command_packet_into
+        calls = [0]
+
+        def failing_encode(*args):
+            # Fails on the second command of the batch.
+            calls[0] += 1
+            if calls[0] == 2:
+                raise ValueError()
+            return encode(*args)
+
+        with mock.patch.object(encoder, "encode_command_packet_into", failing_encode):
+            with self.assertRaises(ValueError):
+                client.send_commands_futures([(20, PacketData()), (21, PacketData())])
+        self.assertEqual(transport.writes, [])
+        self.assertEqual(client.commands_in_flight(), 0)
+        # The window slots were released.
+        futures = client.send_commands_futures([(20, PacketData()), (21, PacketData())])
+        self.assertEqual(len(self.sent_commands(transport)), 2)
+        for future in futures:
+            future.cancel()
+
+    async def test_adaptive_commands_window(self):
+
+        async def slow_echo(endpoint: int, data: PacketData):
+            # The device serves one command at a time, at about 500 commands/sec.
+            await asyncio.sleep(0.002)
+            return (PacketStatus.OK.value, data)
+
+        end1, end2 = LoopbackTransport.pair()
+        client = SerialPacketsClient(end1, adaptive_commands_window=True)
+        device = SerialPacketsClient(end2, command_async_callback=slow_echo, workers=1)
+        self.assertTrue(await client.connect())
+        self.assertTrue(await device.connect())
+        await asyncio.sleep(0)
+        # Without a window, most of these would time out in the device's queue.
+        futures = [client.send_command_future(20, PacketData().add_uint16(i), timeout=0.2)
+                   for i in range(200)]
+        results = await asyncio.gather(*futures)
+        self.assertEqual([s for s, _ in results], [PacketStatus.OK.value] * 200)
+        self.assertEqual([d.read_uint16() for _, d in results], list(range(200)))
+        self.assertLessEqual(client.commands_window(), 10)
+        self.assertEqual(client.stats().command_timeouts, 0)
+        for c in (client, device):
+            c._SerialPacketsClient__transport.close()
+        await asyncio.sleep(0.01)
+
+    async def test_command_retry(self):
+        client = SerialPacketsClient("fake")
+        connect_fake(client)
+        transport = client._SerialPacketsClient__transport
+        policy = RetryPolicy(retries=2, backoff=0.01, jitter=0)
+        status, _ = await client.send_command_blocking(20,
+                                                       PacketData().add_uint8(7),
+                                                       timeout=0.1,
+                                                       retry_policy=policy)
+        self.assertEqual(status, PacketStatus.TIMEOUT.value)
+        self.assertEqual(self.sent_commands(transport), [(1, 20), (2, 20), (3, 20)])
+        stats = client.stats()
+        self.assertEqual((stats.command_timeouts, stats.command_retries), (3, 2))
+        self.assertEqual(client._SerialPacketsClient__retried_cmd_ids, {})
+
+    async def test_command_retry_late_response(self):
+        client = SerialPacketsClient("fake",
+                                     retry_policy=RetryPolicy(retries=3, backoff=0.01, jitter=0))
+        protocol = connect_fake(client)
+        transport = client._SerialPacketsClient__transport
+        future = client.send_command_future(20, PacketData(), timeout=0.1)
+        await asyncio.sleep(0.15)
+        self.assertEqual(self.sent_commands(transport), [(1, 20), (2, 20)])
+        # A late response to the first attempt resolves the command.
+        e = PacketEncoder()
+        protocol.data_received(bytes(e.encode_response_packet(1, 0, bytearray([1]))))
+        status, data = await future
+        self.assertEqual((status, data.data_bytes()), (PacketStatus.OK.value, bytearray([1])))
+        self.assertEqual(client._SerialPacketsClient__retried_cmd_ids, {})
+        # The second attempt is no longer waited for.
+        self.assertEqual(client.commands_in_flight(), 0)
+        protocol.data_received(bytes(e.encode_response_packet(2, 0, bytearray([2]))))
+        await asyncio.sleep(0.15)
+        self.assertEqual(len(transport.writes), 2)
+        stats = client.stats()
+        self.assertEqual((stats.command_retries, stats.command_timeouts), (1, 1))
+        self.assertEqual(stats.late_responses, 1)
+
+    async def test_command_retry_late_response_frees_window(self):
+        client = SerialPacketsClient("fake",
+                                     max_commands_in_flight=1,
+                                     retry_policy=RetryPolicy(retries=3, backoff=0.01, jitter=0))
+        protocol = connect_fake(client)
+        transport = client._SerialPacketsClient__transport
+        future1 = client.send_command_future(20, PacketData(), timeout=0.1)
+        await asyncio.sleep(0.15)
+        future2 = client.send_command_future(21, PacketData(), timeout=0.1)
+        self.assertEqual(self.sent_commands(transport), [(1, 20), (2, 20)])
+        e = PacketEncoder()
+        protocol.data_received(bytes(e.encode_response_packet(1, 0, bytearray())))
+        self.assertEqual((await future1)[0], PacketStatus.OK.value)
+        # The slot of the second attempt goes to the waiting command, with no timeout.
+        self.assertEqual(self.sent_commands(transport), [(1, 20), (2, 20), (3, 21)])
+        self.assertEqual((client.commands_in_flight(), client.commands_waiting()), (1, 0))
+        self.assertEqual(client.stats().command_timeouts, 1)
+        protocol.data_received(bytes(e.encode_response_packet(3, 0, bytearray())))
+        self.assertEqual((await future2)[0], PacketStatus.OK.value)
+        self.assertEqual(client.commands_in_flight(), 0)
+        self.assertEqual(client.stats().command_timeouts, 1)
+
+    async def test_command_retry_statuses(self):
+        client = SerialPacketsClient("fake", max_commands_in_flight=1)
+        protocol = connect_fake(client)
+        transport = client._SerialPacketsClient__transport
+        policy = RetryPolicy(retries=1, backoff=0, statuses=[PacketStatus.GENERAL_ERROR.value])
+        futures = client.send_commands_futures([(20, PacketData()), (21, PacketData())],
+                                               retry_policy=policy)
+        e = PacketEncoder()
+        protocol.data_received(
+            bytes(e.encode_response_packet(1, PacketStatus.GENERAL_ERROR.value, bytearray())))
+        self.assertEqual(self.sent_commands(transport), [(1, 20), (2, 21)])
+        protocol.data_received(
+            bytes(e.encode_response_packet(2, PacketStatus.INVALID_ARGUMENT.value, bytearray())))
+        await asyncio.sleep(0.01)
+        # The resend waited for a slot in the commands window.
+        self.assertEqual(self.sent_commands(transport), [(1, 20), (2, 21), (3, 20)])
+        protocol.data_received(
+            bytes(e.encode_response_packet(3, PacketStatus.GENERAL_ERROR.value, bytearray())))
+        results = await asyncio.wait_for(asyncio.gather(*futures), timeout=1.0)
+        self.assertEqual([s for s, _ in results],
+                         [PacketStatus.GENERAL_ERROR.value, PacketStatus.INVALID_ARGUMENT.value])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,29 +2,44 @@
 
 import unittest
 import sys
-from PyCRC.CRCCCITT import CRCCCITT
 
 # Assuming VSCode project opened at repo directory
-# sys.path.insert(0, "./src")
-# from serial_packets.packets import PacketData
+sys.path.insert(0, "./src")
+
+from serial_packets import _crc
 
 
 class TestCrc16(unittest.TestCase):
     # NOTE: According to https://srecord.sourceforge.net/crc16-ccitt.html#results
     # the correct value should be 0xE5CC and not 0x29B1.
     def test_data1(self):
-        crc_gen = CRCCCITT("FFFF")
         data = bytearray([0x31, 0x32, 0x33, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39])
-        crc = crc_gen.calculate(bytes(data))
+        crc = _crc.crc16(data)
         # print(f"CRC:  {data} -> {crc:04x}\n", flush=True)
         self.assertEqual(crc, 0x29b1)
 
     def test_data2(self):
-        crc_gen = CRCCCITT("FFFF")
         data = bytearray([0x01, 0x00, 0x00, 0x00, 0x07, 0x14, 0xc8, 0x00, 0x00, 0x04, 0xd2])
-        crc = crc_gen.calculate(bytes(data))
+        crc = _crc.crc16(data)
         self.assertEqual(crc, 0x1f49)
 
+    def test_table_implementation(self):
+        data = bytearray([0x01, 0x00, 0x00, 0x00, 0x07, 0x14, 0xc8, 0x00, 0x00, 0x04, 0xd2])
+        self.assertEqual(_crc._update_table(data), 0x1f49)
+        self.assertEqual(_crc._update_table(bytes(range(256))), _crc.crc16(bytes(range(256))))
+
+    def test_incremental_update(self):
+        data = bytearray([0x01, 0x00, 0x00, 0x00, 0x07, 0x14, 0xc8, 0x00, 0x00, 0x04, 0xd2])
+        mv = memoryview(data)
+        crc = _crc.update(mv[:4])
+        crc = _crc.update(mv[4:], crc)
+        self.assertEqual(crc, 0x1f49)
+
+    def test_crc_of_packet_with_crc(self):
+        data = bytearray([0x31, 0x32, 0x33, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39, 0x29, 0xb1])
+        self.assertEqual(_crc.crc16(data), 0)
+        self.assertEqual(_crc._update_table(data), 0)
+
 
 if __name__ == '__main__':
     unittest.main()
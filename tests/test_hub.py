@@ -0,0 +1,105 @@
+# Unit tests of SerialPacketsHub
+
+import asyncio
+import unittest
+import sys
+
+# Assuming VSCode project opened at repo directory
+sys.path.insert(0, "./src")
+
+from serial_packets.client import SerialPacketsClient
+from serial_packets.hub import SerialPacketsHub
+from serial_packets.packets import PacketData, PacketStatus
+from serial_packets.stats import format_prometheus_ports
+from serial_packets.transports import LoopbackTransport
+
+
+class TestSerialPacketsHub(unittest.IsolatedAsyncioTestCase):
+
+    async def test_many_ports(self):
+
+        async def command_async_callback(endpoint: int, data: PacketData):
+            return (PacketStatus.OK.value, PacketData().add_uint8(endpoint))
+
+        tasks_before = len(asyncio.all_tasks())
+        hub = SerialPacketsHub(workers=4)
+        devices = []
+        for i in range(50):
+            end1, end2 = LoopbackTransport.pair(f"link{i}")
+            hub.add_client(end1, command_async_callback=command_async_callback)
+            devices.append(SerialPacketsClient(end2, workers=1))
+        # Only the hub workers were created for the hub's clients.
+        self.assertEqual(len(asyncio.all_tasks()) - tasks_before, 4 + 50)
+        self.assertEqual(await hub.connect_all(), [True] * 50)
+        for device in devices:
+            self.assertTrue(await device.connect())
+        await asyncio.sleep(0)
+        results = await asyncio.gather(
+            *[device.send_command_blocking(i % 200, PacketData()) for i, device in enumerate(devices)])
+        for i, (status, data) in enumerate(results):
+            self.assertEqual(status, PacketStatus.OK.value)
+            self.assertEqual(data.read_uint8(), i % 200)
+        stats = hub.stats()
+        self.assertEqual(len(stats), 50)
+        self.assertEqual([s.rx_packets["command"] for s in stats.values()], [1] * 50)
+        text = format_prometheus_ports(stats)
+        self.assertIn('serial_packets_rx_packets_total{port="loopback:link7/1",type="command"} 1', text)
+
+    async def test_round_robin(self):
+        served = []
+
+        async def message_async_callback(endpoint: int, data: PacketData):
+            served.append(endpoint)
+            await asyncio.sleep(0)
+
+        hub = SerialPacketsHub(workers=1)
+        senders = []
+        for _ in range(2):
+            end1, end2 = LoopbackTransport.pair()
+            hub.add_client(end1, message_async_callback=message_async_callback)
+            sender = SerialPacketsClient(end2)
+            senders.append(sender)
+        await hub.connect_all()
+        for sender in senders:
+            await sender.connect()
+        await asyncio.sleep(0)
+        senders[0].send_messages([(1, PacketData())] * 6)
+        senders[1].send_messages([(2, PacketData())] * 2)
+        for _ in range(100):
+            if len(served) == 8:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(served, [1, 2, 1, 2, 1, 1, 1, 1])
+
+    async def test_max_client_workers(self):
+        release = asyncio.Event()
+        served = []
+
+        async def message_async_callback(endpoint: int, data: PacketData):
+            if endpoint == 1:
+                await release.wait()
+            served.append(endpoint)
+
+        hub = SerialPacketsHub(workers=3, max_client_workers=2)
+        senders = []
+        for _ in range(2):
+            end1, end2 = LoopbackTransport.pair()
+            hub.add_client(end1, message_async_callback=message_async_callback)
+            senders.append(SerialPacketsClient(end2))
+        await hub.connect_all()
+        for sender in senders:
+            await sender.connect()
+        await asyncio.sleep(0)
+        # The slow port can occupy only two of the three workers.
+        senders[0].send_messages([(1, PacketData())] * 5)
+        await asyncio.sleep(0.01)
+        senders[1].send_messages([(2, PacketData())] * 3)
+        await asyncio.sleep(0.05)
+        self.assertEqual(served, [2, 2, 2])
+        release.set()
+        await asyncio.sleep(0.05)
+        self.assertEqual(served, [2, 2, 2, 1, 1, 1, 1, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 # Unit tests of PacketData
 
+import array
 import unittest
 import sys
 
@@ -169,13 +170,80 @@ class TestPacketData(unittest.TestCase):
         self.assertFalse(d.read_error())
         self.assertFalse(d.all_read())
         self.assertFalse(d.all_read_ok())
-        
 
+    def test_add_str(self):
+        d = PacketData()
+        d.add_str("abc")
+        self.assertEqual(d.data_bytes(), bytearray([0x03, 0x61, 0x62, 0x63]))
+        self.assertEqual(d.read_str(), "abc")
+        self.assertTrue(d.all_read_ok())
 
-        
-        
-        
-    
+    def test_add_struct(self):
+        d = PacketData()
+        d.add_struct("BhI", 0x12, -2, 0x12345678)
+        self.assertEqual(d.data_bytes(),
+                         bytearray([0x12, 0xff, 0xfe, 0x12, 0x34, 0x56, 0x78]))
+        d.add_struct("<H", 0x1234)
+        self.assertEqual(d.data_bytes()[-2:], bytearray([0x34, 0x12]))
+
+    def test_read_struct(self):
+        d = PacketData()
+        d.add_bytes(bytearray([0x12, 0xff, 0xfe, 0x12, 0x34, 0x56, 0x78]))
+        self.assertEqual(d.read_struct("BhI"), (0x12, -2, 0x12345678))
+        self.assertTrue(d.all_read_ok())
+
+    def test_read_struct_new_error(self):
+        d = PacketData()
+        d.add_bytes(bytearray([0x12, 0x34, 0x56]))
+        self.assertIsNone(d.read_struct("I"))
+        self.assertEqual(d.bytes_read(), 0)
+        self.assertTrue(d.read_error())
+
+    def test_add_array(self):
+        d = PacketData()
+        d.add_array("H", [0x1234, 0x5678])
+        d.add_array("h", array.array("h", [-1]))
+        self.assertEqual(d.data_bytes(), bytearray([0x12, 0x34, 0x56, 0x78, 0xff, 0xff]))
+
+    def test_read_array(self):
+        d = PacketData()
+        d.add_bytes(bytearray([0x12, 0x34, 0x56, 0x78, 0xff, 0xff]))
+        v = d.read_array("H", 2)
+        self.assertEqual(v, array.array("H", [0x1234, 0x5678]))
+        self.assertEqual(d.read_array("h", 1), array.array("h", [-1]))
+        self.assertTrue(d.all_read_ok())
+
+    def test_read_array_new_error(self):
+        d = PacketData()
+        d.add_bytes(bytearray([0x12, 0x34, 0x56]))
+        self.assertIsNone(d.read_array("H", 2))
+        self.assertEqual(d.bytes_read(), 0)
+        self.assertTrue(d.read_error())
+
+    def test_read_numpy_array(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        d = PacketData()
+        d.add_array("H", numpy.array([0x1234, 0x5678], dtype="H"))
+        self.assertEqual(d.data_bytes(), bytearray([0x12, 0x34, 0x56, 0x78]))
+        v = d.read_array("H", 2, as_numpy=True)
+        self.assertEqual(v.tolist(), [0x1234, 0x5678])
+
+    def test_from_bytearray(self):
+        """Test data that takes ownership of a bytearray."""
+        frame = bytearray([0x11, 0x22, 0x33, 0x44])
+        d = PacketData._from_bytearray(frame)
+        self.assertIs(d._internal_bytes_buffer(), frame)
+        self.assertEqual(d.hex_str(), "11 22 33 44")
+        self.assertEqual(d.read_uint16(), 0x1122)
+        v = d.read_bytes(2)
+        self.assertIsInstance(v, bytearray)
+        self.assertEqual(v, bytearray([0x33, 0x44]))
+        self.assertTrue(d.all_read_ok())
+        d.add_uint8(0x55)
+        self.assertEqual(d.data_bytes(), bytearray([0x11, 0x22, 0x33, 0x44, 0x55]))
 
 
 if __name__ == '__main__':
@@ -1,12 +1,17 @@
 # Unit tests of PacketDecoder
 
+import asyncio
 import unittest
+import random
 import sys
+import tracemalloc
+from unittest import mock
 
 # Assuming VSCode project opened at repo directory
 sys.path.insert(0, "./src")
 
 from serial_packets.packet_decoder import PacketDecoder, DecodedCommandPacket, DecodedResponsePacket, DecodedMessagePacket, DecodedLogPacket
+from serial_packets.packet_encoder import PacketEncoder
 
 
 class TestPacketEncoder(unittest.TestCase):
@@ -113,6 +118,8 @@ class TestPacketEncoder(unittest.TestCase):
                 0x22, 0x7d, 0x5d, 0x99, 0x7a, 0xaa, 0x7e
             ]))
         self.assertEqual(len(self.packets), 0)
+        self.assertEqual(d.crc_errors(), 1)
+        self.assertEqual(d.framing_errors(), 0)
         self.assertEqual(len(d._PacketDecoder__packet_bfr), 0)
         self.assertFalse(d._PacketDecoder__in_packet)
         self.assertFalse(d._PacketDecoder__pending_escape)
@@ -130,6 +137,156 @@ class TestPacketEncoder(unittest.TestCase):
         self.assertTrue(d._PacketDecoder__in_packet)
         self.assertFalse(d._PacketDecoder__pending_escape)
 
+    def test_receive_bytes_command_packet(self):
+        """Tests decoding of a command packet in a single chunk."""
+        d = PacketDecoder()
+        packets = d.receive_bytes(
+            bytes([
+                0x7c, 0x01, 0xff, 0x12, 0x34, 0x56, 0x20, 0xff, 0x00, 0x7d, 0x5c, 0x11, 0x7d, 0x5e,
+                0x22, 0x7d, 0x5d, 0x99, 0x7a, 0xa7, 0x7e
+            ]))
+        self.assertEqual(len(packets), 1)
+        packet: DecodedCommandPacket = packets[0]
+        self.assertIsInstance(packet, DecodedCommandPacket)
+        self.assertEqual(packet.cmd_id, 0xff123456)
+        self.assertEqual(packet.endpoint, 0x20)
+        self.assertEqual(packet.data.data_bytes(),
+                         bytearray([0xff, 0x00, 0x7c, 0x11, 0x7e, 0x22, 0x7d, 0x99]))
+        self.assertEqual(len(d._PacketDecoder__packet_bfr), 0)
+        self.assertFalse(d._PacketDecoder__in_packet)
+        self.assertFalse(d._PacketDecoder__pending_escape)
+
+    def test_receive_bytes_partial_packet_error(self):
+        """Same as test_partial_packet_error() but using receive_bytes()."""
+        d = PacketDecoder()
+        self.assertEqual(d.receive_bytes(bytes([0x7c, 0x01, 0x7d])), [])
+        self.assertEqual(len(d._PacketDecoder__packet_bfr), 1)
+        self.assertTrue(d._PacketDecoder__in_packet)
+        self.assertTrue(d._PacketDecoder__pending_escape)
+        self.assertEqual(d.receive_bytes(bytes([0x7c, 0x03, 0x04, 0x05])), [])
+        self.assertEqual(len(d._PacketDecoder__packet_bfr), 3)
+        self.assertTrue(d._PacketDecoder__in_packet)
+        self.assertFalse(d._PacketDecoder__pending_escape)
+        self.assertEqual(d.framing_errors(), 1)
+
+    def test_dropped_bytes(self):
+        """Tests the counting of bytes outside of packets."""
+        d = PacketDecoder()
+        # Bytes before the first start flag are not counted.
+        d.receive_bytes(bytes([0x11, 0x22]))
+        d.receive_bytes(bytes([0x7c, 0x7e, 0x33, 0x44, 0x55]))
+        d.receive_byte(0x66)
+        self.assertEqual(d.dropped_bytes(), 4)
+        # The empty packet is too short.
+        self.assertEqual(d.framing_errors(), 1)
+
+    def test_error_log_rate_limit(self):
+        """Tests that decoder errors are logged as a periodic summary."""
+        d = PacketDecoder()
+        now = [100.0]
+        with mock.patch("serial_packets.packet_decoder.time.monotonic", lambda: now[0]):
+            with self.assertLogs("serial_packets.packet_decoder", level="ERROR") as logs:
+                d.receive_bytes(bytes([0x7c, 0x7e]))
+                for _ in range(1000):
+                    d.receive_bytes(bytes([0x11, 0x22]))
+                    d.receive_byte(0x33)
+                    d.receive_bytes(bytes([0x7c, 0x7c, 0x7e]))
+                now[0] += 1.5
+                # A valid packet flushes the summary.
+                packets = d.receive_bytes(bytes(PacketEncoder().encode_log_packet(bytearray(1))))
+        self.assertEqual(len(packets), 1)
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn("Packet too short (0)", logs.output[0])
+        self.assertIn("Decoder errors in last 1.5s: dropped 3000 bytes, 2000 framing errors, "
+                      "0 CRC errors", logs.output[1])
+        self.assertEqual(d.dropped_bytes(), 3000)
+        self.assertEqual(d.framing_errors(), 2001)
+
+    def test_error_log_flush_when_quiet(self):
+        """Tests that the errors summary is logged when no more data is received."""
+
+        async def run(d: PacketDecoder):
+            d.receive_bytes(bytes([0x7c, 0x7e]))
+            d.receive_bytes(bytes([0x11, 0x22]))
+            await asyncio.sleep(0.1)
+
+        d = PacketDecoder()
+        with mock.patch("serial_packets.packet_decoder._ERROR_LOG_INTERVAL", 0.05):
+            with self.assertLogs("serial_packets.packet_decoder", level="ERROR") as logs:
+                asyncio.run(run(d))
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn("dropped 2 bytes, 0 framing errors, 0 CRC errors", logs.output[1])
+
+    def test_receive_bytes_matches_receive_byte(self):
+        """Tests that chunked decoding matches byte by byte decoding on random streams."""
+        rnd = random.Random(1234)
+        e = PacketEncoder()
+        specials = [0x7c, 0x7d, 0x7e]
+        for _ in range(100):
+            # Construct a stream of valid packets, corrupted packets and noise.
+            stream = bytearray()
+            for _ in range(rnd.randint(1, 8)):
+                choice = rnd.randint(0, 5)
+                size = rnd.choice([0, 1, 5, 100, 1024, 1025, 1030])
+                data = bytearray(rnd.choice(specials + [rnd.randint(0, 255)]) for _ in range(size))
+                if choice == 0:
+                    stream.extend(bytes(rnd.choice(specials + [0x00, 0x5c]) for _ in range(5)))
+                elif choice == 1:
+                    packet = e.encode_log_packet(data[:1024])
+                    pos = rnd.randint(0, len(packet) - 1)
+                    packet[pos] = rnd.choice(specials + [0x5c, 0x11])
+                    stream.extend(packet)
+                elif choice == 2:
+                    stream.extend(e.encode_command_packet(rnd.randint(0, 0xffffffff), 7, data[:1024]))
+                else:
+                    packet = e.encode_message_packet(9, data[:1024])
+                    if size > 1024:
+                        # Create an oversized packet.
+                        packet[-1:-1] = bytes([0x11] * (size - 1024))
+                    stream.extend(packet)
+            d1 = PacketDecoder()
+            expected = []
+            for b in stream:
+                packet = d1.receive_byte(b)
+                if packet:
+                    expected.append(packet)
+            d2 = PacketDecoder()
+            actual = []
+            i = 0
+            while i < len(stream):
+                n = rnd.choice([1, 2, 3, 17, 500, 5000])
+                actual.extend(d2.receive_bytes(bytes(stream[i:i + n])))
+                i += n
+            self.assertEqual([str(p) for p in actual], [str(p) for p in expected])
+            self.assertEqual([p.data.data_bytes() for p in actual],
+                             [p.data.data_bytes() for p in expected])
+            self.assertEqual(d2._PacketDecoder__packet_bfr, d1._PacketDecoder__packet_bfr)
+            self.assertEqual(d2._PacketDecoder__in_packet, d1._PacketDecoder__in_packet)
+            self.assertEqual(d2._PacketDecoder__pending_escape,
+                             d1._PacketDecoder__pending_escape)
+            self.assertEqual(d2.crc_errors(), d1.crc_errors())
+            self.assertEqual(d2.framing_errors(), d1.framing_errors())
+            self.assertEqual(d2.dropped_bytes(), d1.dropped_bytes())
+
+    def test_decode_copy_count(self):
+        """Tests that decoding doesn't copy the data and read_bytes() copies it once."""
+        data = bytes(i % 0x7c for i in range(1024))
+        stream = PacketEncoder().encode_message_packet(9, data)
+        d = PacketDecoder()
+        tracemalloc.start()
+        try:
+            tracemalloc.reset_peak()
+            packets = d.receive_bytes(stream)
+            result = packets[0].data.read_bytes(1024)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(result, data)
+        # The frame buffer plus a single copy. A copy on decode would add another 1024.
+        self.assertLess(peak, 2.5 * 1024)
+        # The decoder handed its buffer to the packet and started a new one.
+        self.assertEqual(len(d._PacketDecoder__packet_bfr), 0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -14,12 +14,32 @@ class TestPacketEncoder(unittest.TestCase):
     def test_byte_stuffing(self):
         e = PacketEncoder()
         input = bytearray([0xff, 0x00, 0x7c, 0x11, 0x7e, 0x22, 0x7d, 0x99])
-        output = e._PacketEncoder__byte_stuffing(input)
+        output = e.encode_message_packet(0x20, input)
         # print(f"Actual: 0x{packet.hex(sep='#').replace('#', ', 0x')}")
-        self.assertCountEqual(
+        self.assertEqual(
             output,
-            bytearray(
-                [0x7c, 0xff, 0x00, 0x7d, 0x5c, 0x11, 0x7d, 0x5e, 0x22, 0x7d, 0x5d, 0x99, 0x7e]))
+            bytearray([
+                0x7c, 0x03, 0x20, 0xff, 0x00, 0x7d, 0x5c, 0x11, 0x7d, 0x5e, 0x22, 0x7d, 0x5d, 0x99,
+                0xe7, 0x2d, 0x7e
+            ]))
+
+    def test_byte_stuffing_no_escapes(self):
+        e = PacketEncoder()
+        input = bytearray([0xff, 0x00, 0x11, 0x22, 0x99])
+        output = e.encode_message_packet(0x20, input)
+        self.assertEqual(output,
+                         bytearray([0x7c, 0x03, 0x20, 0xff, 0x00, 0x11, 0x22, 0x99, 0x40, 0xac, 0x7e]))
+
+    def test_byte_stuffing_all_escapes(self):
+        e = PacketEncoder()
+        input = bytearray([0x7d, 0x7c, 0x7d, 0x7e, 0x7e, 0x7c])
+        output = e.encode_message_packet(0x20, input)
+        self.assertEqual(
+            output,
+            bytearray([
+                0x7c, 0x03, 0x20, 0x7d, 0x5d, 0x7d, 0x5c, 0x7d, 0x5d, 0x7d, 0x5e, 0x7d, 0x5e, 0x7d,
+                0x5c, 0x26, 0x78, 0x7e
+            ]))
 
     def test_construct_command_packet(self):
         e = PacketEncoder()
@@ -110,6 +130,36 @@ class TestPacketEncoder(unittest.TestCase):
                 0xba, 0x7e
             ]))
 
+    def test_encode_command_packet_into(self):
+        e = PacketEncoder()
+        data = bytearray([0xff, 0x00, 0x7c, 0x11, 0x7e, 0x22, 0x7d, 0x99])
+        out = bytearray(100)
+        n = e.encode_command_packet_into(memoryview(out)[3:], 0xff123456, 0x20, data)
+        self.assertEqual(n, 21)
+        self.assertEqual(
+            out[3:3 + n],
+            bytearray([
+                0x7c, 0x01, 0xff, 0x12, 0x34, 0x56, 0x20, 0xff, 0x00, 0x7d, 0x5c, 0x11, 0x7d, 0x5e,
+                0x22, 0x7d, 0x5d, 0x99, 0x7a, 0xa7, 0x7e
+            ]))
+        self.assertEqual(len(out), 100)
+
+    def test_encode_message_packet_into_no_escapes(self):
+        e = PacketEncoder()
+        out = bytearray(10)
+        n = e.encode_message_packet_into(out, 0x20, bytearray([0x11, 0x22]))
+        self.assertEqual(n, 8)
+        self.assertEqual(out[:n], e.encode_message_packet(0x20, bytearray([0x11, 0x22])))
+        self.assertEqual(len(out), 10)
+
+    def test_encode_packet_into_small_buffer(self):
+        e = PacketEncoder()
+        data = bytearray([0xff, 0x00, 0x7c, 0x11, 0x7e, 0x22, 0x7d, 0x99])
+        with self.assertRaises(ValueError):
+            e.encode_log_packet_into(bytearray(15), data)
+        with self.assertRaises(ValueError):
+            e.encode_log_packet_into(bytearray(5), bytearray([0x11, 0x22]))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,111 @@
+# Unit tests of PacketSchema
+
+import array
+import unittest
+import sys
+
+# Assuming VSCode project opened at repo directory
+sys.path.insert(0, "./src")
+
+from serial_packets.packets import PacketData, _compiled_struct
+from serial_packets.schema import PacketSchema, Uint8, Uint16, Uint32, Int8, Int16, Int32, Str, Bytes, Array
+
+
+class FixedSchema(PacketSchema):
+    u8 = Uint8()
+    u16 = Uint16()
+    u32 = Uint32()
+    i8 = Int8()
+    i16 = Int16()
+    i32 = Int32()
+
+
+class MixedSchema(PacketSchema):
+    id = Uint8()
+    samples = Array("H", 3)
+    tag = Bytes(2)
+    name = Str()
+    flags = Uint16()
+    rest = Array("h")
+
+
+class TestPacketSchema(unittest.TestCase):
+
+    def test_compile(self):
+        self.assertEqual(len(FixedSchema._steps), 1)
+        self.assertEqual(FixedSchema._steps[0].fmt, ">BHIbhi")
+        self.assertEqual([name for name, _ in MixedSchema._fields],
+                         ["id", "samples", "tag", "name", "flags", "rest"])
+        self.assertEqual(len(MixedSchema._steps), 4)
+
+    def test_encode_fixed(self):
+        data = FixedSchema(0x12, 0x3456, 0x789abcde, -1, -2, i32=-3).encode()
+        expected = (PacketData().add_uint8(0x12).add_uint16(0x3456).add_uint32(0x789abcde)
+                    .add_bytes(bytearray([0xff, 0xff, 0xfe, 0xff, 0xff, 0xff, 0xfd])))
+        self.assertEqual(data.data_bytes(), expected.data_bytes())
+
+    def test_decode_fixed(self):
+        data = PacketData().add_bytes(
+            bytearray([0x12, 0x34, 0x56, 0x78, 0x9a, 0xbc, 0xde, 0xff, 0xff, 0xfe, 0xff, 0xff, 0xff, 0xfd]))
+        obj = FixedSchema.decode(data)
+        self.assertEqual(obj, FixedSchema(0x12, 0x3456, 0x789abcde, -1, -2, -3))
+        self.assertEqual(obj.u16, 0x3456)
+
+    def test_round_trip_mixed(self):
+        obj = MixedSchema(id=7, samples=[1, 2, 3], tag=b"ab", name="xyz", flags=0x1234, rest=[-1, 5])
+        data = obj.encode()
+        self.assertEqual(
+            data.data_bytes(),
+            bytearray([
+                0x07, 0x00, 0x01, 0x00, 0x02, 0x00, 0x03, 0x61, 0x62, 0x03, 0x78, 0x79, 0x7a, 0x12,
+                0x34, 0xff, 0xff, 0x00, 0x05
+            ]))
+        decoded = MixedSchema.decode(data)
+        self.assertEqual(decoded.samples, array.array("H", [1, 2, 3]))
+        self.assertEqual(decoded.tag, b"ab")
+        self.assertEqual(decoded.name, "xyz")
+        self.assertEqual(decoded.rest, array.array("h", [-1, 5]))
+
+    def test_bytes_type(self):
+
+        class BytesSchema(PacketSchema):
+            head = Bytes(2)
+            tail = Bytes()
+
+        obj = BytesSchema.decode(PacketData().add_bytes(bytearray([1, 2, 3, 4, 5])))
+        self.assertEqual((obj.head, obj.tail), (b"\x01\x02", b"\x03\x04\x05"))
+        self.assertIs(type(obj.head), bytes)
+        self.assertIs(type(obj.tail), bytes)
+        obj = BytesSchema.decode(PacketData().add_bytes(bytearray([1, 2])))
+        self.assertEqual(obj.tail, b"")
+        self.assertIs(type(obj.tail), bytes)
+        # Fixed size bytes of a wrong size are not padded or truncated.
+        with self.assertRaises(AssertionError):
+            BytesSchema(b"\x01", b"").encode()
+        with self.assertRaises(AssertionError):
+            BytesSchema(b"\x01\x02\x03", b"").encode()
+        self.assertEqual(BytesSchema(b"\x01\x02", b"\x03").encode().data_bytes(),
+                         bytearray([1, 2, 3]))
+
+    def test_variable_bytes_struct_cache(self):
+        """Decoding variable size bytes of many sizes should not grow the struct cache."""
+
+        class TailSchema(PacketSchema):
+            tail = Bytes()
+
+        misses = _compiled_struct.cache_info().misses
+        for n in range(300):
+            self.assertEqual(TailSchema.decode(PacketData().add_bytes(bytes(n))).tail, bytes(n))
+        self.assertEqual(_compiled_struct.cache_info().misses, misses)
+
+    def test_decode_errors(self):
+        self.assertIsNone(FixedSchema.decode(PacketData().add_uint8(1)))
+        data = FixedSchema(1, 2, 3, 4, 5, 6).encode().add_uint8(0)
+        self.assertIsNone(FixedSchema.decode(data))
+        data.reset_read_location()
+        self.assertIsNotNone(FixedSchema.decode(data, all_read=False))
+        self.assertEqual(data.bytes_left_to_read(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
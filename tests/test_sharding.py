@@ -0,0 +1,179 @@
+# Unit tests of ShardedPacketsSupervisor
+
+import asyncio
+import socket
+import unittest
+import sys
+
+# Assuming VSCode project opened at repo directory
+sys.path.insert(0, "./src")
+
+from serial_packets.client import SerialPacketsClient
+from serial_packets.packets import PacketData, PacketStatus, PacketsEventType
+from serial_packets.sharding import ShardedPacketsSupervisor, _Channel
+from serial_packets.transports import TcpClientTransport, TcpServerTransport
+
+
+def free_tcp_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def child_setup(port: str, client: SerialPacketsClient) -> None:
+    """Registers a handler that runs in the child process."""
+
+    def child_command_handler(endpoint: int, data: PacketData):
+        return (PacketStatus.OK.value, PacketData().add_str(f"child {port}"))
+
+    client.register_command_handler(50, child_command_handler)
+
+
+class TestShardedPacketsSupervisor(unittest.IsolatedAsyncioTestCase):
+
+    async def test_channel_backpressure(self):
+        sock1, sock2 = socket.socketpair()
+        reader1, writer1 = await asyncio.open_connection(sock=sock1)
+        reader2, writer2 = await asyncio.open_connection(sock=sock2)
+        writes = []
+        write = writer1.write
+        writer1.write = lambda data: (writes.append(len(data)), write(data))
+        sender = _Channel(reader1, writer1)
+        receiver = _Channel(reader2, writer2)
+        # A batch is a single write.
+        sender.send(b"a", b"xyz")
+        sender.send(b"b")
+        await sender.drain()
+        await asyncio.sleep(0)
+        self.assertEqual(writes, [4 + 8 + 5])
+        self.assertEqual([bytes(r) for r in await receiver.receive()], [b"axyz", b"b"])
+
+        # The sender waits while the receiver doesn't read.
+        async def send_batches():
+            for _ in range(1000):
+                sender.send(b"c", bytes(1000))
+                await sender.drain()
+                await asyncio.sleep(0)
+
+        task = asyncio.create_task(send_batches())
+        await asyncio.sleep(0.1)
+        self.assertFalse(task.done())
+        self.assertLess(sum(writes), 1000 * 1000)
+        received = 0
+        while received < 1000:
+            received += len(await receiver.receive())
+        await task
+        sender.close()
+        receiver.close()
+
+    async def test_supervisor(self):
+        # The devices, in this process.
+        device_messages = []
+
+        async def device_command(endpoint: int, data: PacketData):
+            return (PacketStatus.OK.value, PacketData().add_uint8(endpoint + 1))
+
+        async def device_message(endpoint: int, data: PacketData):
+            device_messages.append((endpoint, data.data_bytes()))
+
+        tcp_ports = [free_tcp_port() for _ in range(3)]
+        devices = [
+            SerialPacketsClient(TcpServerTransport("127.0.0.1", p),
+                                command_async_callback=device_command,
+                                message_async_callback=device_message) for p in tcp_ports
+        ]
+        device_connects = [asyncio.create_task(device.connect()) for device in devices]
+        await asyncio.sleep(0.05)
+
+        # The supervisor's callbacks.
+        messages = []
+        events = []
+
+        async def command_async_callback(port: str, endpoint: int, data: PacketData):
+            return (PacketStatus.OK.value, PacketData().add_str(f"parent {port}"))
+
+        async def message_async_callback(port: str, endpoint: int, data: PacketData):
+            messages.append((port, endpoint, data.data_bytes()))
+
+        async def event_async_callback(port: str, event):
+            events.append((port, event.event_type))
+
+        ports = [TcpClientTransport("127.0.0.1", p) for p in tcp_ports]
+        port_names = [str(p) for p in ports]
+        supervisor = ShardedPacketsSupervisor(ports,
+                                              processes=2,
+                                              command_async_callback=command_async_callback,
+                                              message_async_callback=message_async_callback,
+                                              event_async_callback=event_async_callback,
+                                              child_setup=child_setup,
+                                              workers=2)
+        try:
+            self.assertEqual(await asyncio.wait_for(supervisor.start(), timeout=30),
+                             {name: True for name in port_names})
+            self.assertEqual(await asyncio.gather(*device_connects), [True] * 3)
+
+            # Device to parent.
+            devices[1].send_message(7, PacketData().add_uint8(0x7e))
+            status, data = await devices[2].send_command_blocking(10, PacketData())
+            self.assertEqual((status, data.read_str()), (0, f"parent {port_names[2]}"))
+            # Device to a handler in the child process.
+            status, data = await devices[0].send_command_blocking(50, PacketData())
+            self.assertEqual((status, data.read_str()), (0, f"child {port_names[0]}"))
+            self.assertEqual(messages, [(port_names[1], 7, bytearray([0x7e]))])
+
+            # Parent to device.
+            status, data = await supervisor.send_command_blocking(port_names[1], 20, PacketData())
+            self.assertEqual((status, data.read_uint8()), (0, 21))
+            supervisor.send_message(port_names[2], 30, PacketData().add_uint16(0x1234))
+            for _ in range(100):
+                if device_messages:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual(device_messages, [(30, bytearray([0x12, 0x34]))])
+
+            stats = await supervisor.stats()
+            self.assertEqual(list(stats.keys()), port_names)
+            self.assertEqual(stats[port_names[0]].rx_endpoint_packets, {50: 1})
+            self.assertEqual(stats[port_names[1]].tx_packets["command"], 1)
+            self.assertEqual(sorted(events),
+                             sorted((name, PacketsEventType.CONNECTED) for name in port_names))
+        finally:
+            await supervisor.stop()
+
+    async def test_shard_exit(self):
+
+        async def slow_device_command(endpoint: int, data: PacketData):
+            await asyncio.sleep(5)
+            return (PacketStatus.OK.value, PacketData())
+
+        tcp_ports = [free_tcp_port() for _ in range(2)]
+        devices = [
+            SerialPacketsClient(TcpServerTransport("127.0.0.1", p),
+                                command_async_callback=slow_device_command) for p in tcp_ports
+        ]
+        device_connects = [asyncio.create_task(device.connect()) for device in devices]
+        await asyncio.sleep(0.05)
+        ports = [TcpClientTransport("127.0.0.1", p) for p in tcp_ports]
+        port_names = [str(p) for p in ports]
+        supervisor = ShardedPacketsSupervisor(ports, processes=2)
+        try:
+            await asyncio.wait_for(supervisor.start(), timeout=30)
+            await asyncio.gather(*device_connects)
+            future = supervisor.send_command_future(port_names[0], 20, PacketData(), timeout=10)
+            await asyncio.sleep(0.1)
+            # The shard of the first port crashes.
+            supervisor._ShardedPacketsSupervisor__shards[0].process.kill()
+            status, _ = await asyncio.wait_for(future, timeout=5)
+            self.assertEqual(status, PacketStatus.NOT_CONNECTED.value)
+            future = supervisor.send_command_future(port_names[0], 20, PacketData())
+            self.assertTrue(future.done())
+            self.assertEqual((await future)[0], PacketStatus.NOT_CONNECTED.value)
+            self.assertEqual(list((await supervisor.stats()).keys()), [port_names[1]])
+        finally:
+            await supervisor.stop()
+            for device in devices:
+                device._SerialPacketsClient__transport.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+# Unit tests of the sniffer.
+
+import asyncio
+import contextlib
+import csv
+import io
+import json
+import os
+import random
+import tempfile
+import unittest
+import sys
+from unittest import mock
+
+# Assuming VSCode project opened at repo directory
+sys.path.insert(0, "./src")
+
+from serial_packets.capture import CaptureRecorder
+from serial_packets.packet_decoder import PacketDecoder
+from serial_packets.packet_encoder import PacketEncoder
+from serial_packets import sniff
+from serial_packets.sniff import PacketsAnalyzer, analyze_file, main, tap
+
+
+def random_stream(rnd: random.Random, num_packets: int) -> bytes:
+    """Returns a stream of random packets, with noise and corruptions."""
+    encoder = PacketEncoder()
+    stream = bytearray()
+    for _ in range(num_packets):
+        data = bytearray(rnd.choice([0x7c, 0x7d, 0x7e, rnd.randrange(256)])
+                         for _ in range(rnd.randrange(20)))
+        kind = rnd.randrange(4)
+        if kind == 0:
+            packet = encoder.encode_command_packet(rnd.randrange(1 << 32), rnd.randrange(256),
+                                                   data)
+        elif kind == 1:
+            packet = encoder.encode_response_packet(rnd.randrange(1 << 32), rnd.randrange(256),
+                                                    data)
+        elif kind == 2:
+            packet = encoder.encode_message_packet(rnd.randrange(256), data)
+        else:
+            packet = encoder.encode_log_packet(data)
+        packet = bytearray(packet)
+        if rnd.random() < 0.2:
+            packet[rnd.randrange(len(packet))] = rnd.choice([0x7c, 0x7d, 0x7e, rnd.randrange(256)])
+        if rnd.random() < 0.1:
+            packet = packet[:rnd.randrange(len(packet))]
+        stream += packet
+        if rnd.random() < 0.1:
+            stream += bytes(rnd.randrange(256) for _ in range(rnd.randrange(5)))
+    return bytes(stream)
+
+
+class TestSniff(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "capture")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_same_as_decoder(self):
+        """The analyzer should find the same packets and errors as the decoder."""
+        rnd = random.Random(123)
+        for _ in range(20):
+            stream = random_stream(rnd, 200)
+            decoder = PacketDecoder()
+            expected = {}
+            for packet in decoder.receive_bytes(stream):
+                name = type(packet).__name__[len("Decoded"):-len("Packet")].lower()
+                endpoint = getattr(packet, "endpoint", None)
+                counters = expected.setdefault((name, endpoint), [0, 0])
+                counters[0] += 1
+                counters[1] += packet.data.size()
+            analyzer = PacketsAnalyzer()
+            # Feed in random chunks.
+            i = 0
+            while i < len(stream):
+                n = rnd.randrange(1, 100)
+                analyzer.feed("rx", stream[i:i + n])
+                i += n
+            stats = analyzer.directions()["rx"]
+            self.assertEqual(stats.packets, expected)
+            self.assertEqual(stats.crc_errors, decoder.crc_errors())
+            self.assertEqual(stats.framing_errors, decoder.framing_errors())
+            self.assertEqual(stats.dropped_bytes, decoder.dropped_bytes())
+            self.assertEqual(stats.wire_bytes, len(stream))
+
+    def test_same_as_decoder_noise(self):
+        """Same as test_same_as_decoder, with random bytes and truncated packets."""
+        rnd = random.Random(456)
+        encoder = PacketEncoder()
+        for _ in range(200):
+            stream = bytearray()
+            for _ in range(rnd.randrange(1, 10)):
+                if rnd.random() < 0.5:
+                    stream += bytes(rnd.choice([0x7c, 0x7d, 0x7e, rnd.randrange(256)])
+                                    for _ in range(rnd.randrange(3000)))
+                else:
+                    packet = encoder.encode_message_packet(1, bytearray(rnd.randrange(1025)))
+                    stream += packet[:rnd.randrange(len(packet) + 1)]
+            decoder = PacketDecoder()
+            num_packets = len(decoder.receive_bytes(stream))
+            analyzer = PacketsAnalyzer()
+            analyzer.feed("rx", bytes(stream))
+            stats = analyzer.directions()["rx"]
+            self.assertEqual(stats.num_packets(), num_packets)
+            self.assertEqual((stats.crc_errors, stats.framing_errors, stats.dropped_bytes),
+                             (decoder.crc_errors(), decoder.framing_errors(),
+                              decoder.dropped_bytes()))
+
+    def test_raw_file(self):
+        stream = random_stream(random.Random(7), 1000)
+        with open(self.path, "wb") as f:
+            f.write(stream)
+        analyzer = PacketsAnalyzer()
+        self.assertEqual(analyze_file(self.path, analyzer), len(stream))
+        decoder = PacketDecoder()
+        self.assertEqual(analyzer.directions()["rx"].num_packets(),
+                         len(decoder.receive_bytes(stream)))
+        self.assertEqual(analyzer.rtt().count(), 0)
+
+    def test_raw_file_jobs(self):
+        stream = random_stream(random.Random(8), 3000)
+        with open(self.path, "wb") as f:
+            f.write(stream)
+        sequential = PacketsAnalyzer()
+        analyze_file(self.path, sequential)
+        parallel = PacketsAnalyzer()
+        with mock.patch.object(sniff, "_PARALLEL_MIN_SIZE", 0):
+            self.assertEqual(analyze_file(self.path, parallel, jobs=3), len(stream))
+        stats1 = sequential.directions()["rx"]
+        stats2 = parallel.directions()["rx"]
+        self.assertEqual(stats2.packets, stats1.packets)
+        self.assertEqual(stats2.crc_errors, stats1.crc_errors)
+        self.assertEqual(stats2.wire_bytes, len(stream))
+
+    def write_capture(self):
+        """Writes a capture with 3 commands, 2 of them answered, and a message."""
+        encoder = PacketEncoder()
+
+        async def record():
+            with CaptureRecorder(self.path) as recorder:
+                for cmd_id in (10, 11, 12):
+                    recorder.record_tx(encoder.encode_command_packet(cmd_id, 5, bytearray([1])))
+                await asyncio.sleep(0.01)
+                recorder.record_rx(
+                    encoder.encode_response_packet(11, 0, bytearray([2, 3])) +
+                    encoder.encode_response_packet(10, 0, bytearray()))
+                recorder.record_rx(encoder.encode_message_packet(9, bytearray([0x7e])))
+
+        asyncio.run(record())
+
+    def test_capture_file(self):
+        self.write_capture()
+        analyzer = PacketsAnalyzer()
+        analyze_file(self.path, analyzer)
+        directions = analyzer.directions()
+        self.assertEqual(directions["tx"].packets, {("command", 5): [3, 3]})
+        self.assertEqual(directions["rx"].packets, {
+            ("response", None): [2, 2],
+            ("message", 9): [1, 1]
+        })
+        self.assertEqual(directions["rx"].statuses, {0: 2})
+        self.assertEqual(analyzer.rtt().count(), 2)
+        self.assertGreaterEqual(analyzer.rtt().min(), 0.009)
+        self.assertEqual(analyzer.unanswered_commands(), 1)
+        self.assertEqual(analyzer.unmatched_responses(), 0)
+
+    def test_export(self):
+        self.write_capture()
+        jsonl_path = self.path + ".jsonl"
+        csv_path = self.path + ".csv"
+        try:
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                self.assertEqual(main([self.path, "--jsonl", jsonl_path, "--csv", csv_path]), 0)
+            self.assertIn("2 paired, 1 unanswered", out.getvalue())
+            with open(jsonl_path) as f:
+                rows = [json.loads(line) for line in f]
+            with open(csv_path, newline="") as f:
+                csv_rows = list(csv.DictReader(f))
+        finally:
+            os.remove(jsonl_path)
+            os.remove(csv_path)
+        self.assertEqual(len(rows), 6)
+        self.assertEqual([row["type"] for row in rows],
+                         ["command"] * 3 + ["response", "response", "message"])
+        self.assertEqual(rows[3]["cmd_id"], 11)
+        self.assertEqual(rows[3]["data"], "0203")
+        self.assertIsNotNone(rows[3]["rtt"])
+        self.assertIsNone(rows[0]["rtt"])
+        self.assertEqual(len(csv_rows), 6)
+        self.assertEqual(csv_rows[5]["endpoint"], "9")
+        self.assertEqual(csv_rows[5]["data"], "7e")
+
+    def test_missing_file(self):
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            self.assertEqual(main([self.path + ".missing"]), 1)
+        self.assertIn("Can't read", err.getvalue())
+        self.assertIn("No such file", err.getvalue())
+
+    def test_tap(self):
+
+        async def run():
+            encoder = PacketEncoder()
+
+            async def on_connection(reader, writer):
+                writer.write(encoder.encode_message_packet(3, bytearray([1, 2])) * 5)
+                await writer.drain()
+                writer.close()
+
+            server = await asyncio.start_server(on_connection, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            analyzer = PacketsAnalyzer()
+            async with server:
+                await tap([f"tcp:127.0.0.1:{port}"], analyzer, duration=2.0)
+            return analyzer
+
+        analyzer = asyncio.run(run())
+        self.assertEqual(analyzer.directions()["rx"].packets, {("message", 3): [5, 10]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# Unit tests of the stats module.
+
+import unittest
+import sys
+
+# Assuming VSCode project opened at repo directory
+sys.path.insert(0, "./src")
+
+from serial_packets.stats import LatencyHistogram, PacketsStats, format_prometheus
+
+
+class TestStats(unittest.TestCase):
+
+    def test_empty_histogram(self):
+        h = LatencyHistogram()
+        self.assertEqual(h.count(), 0)
+        self.assertEqual(h.percentile(50), 0.0)
+        self.assertEqual(h.min(), 0.0)
+        self.assertEqual(h.buckets(), [])
+
+    def test_histogram_percentiles(self):
+        h = LatencyHistogram()
+        # 1us to 100ms.
+        for i in range(1, 100001):
+            h.record(i * 1e-6)
+        self.assertEqual(h.count(), 100000)
+        self.assertAlmostEqual(h.min(), 1e-6)
+        self.assertAlmostEqual(h.max(), 0.1)
+        self.assertAlmostEqual(h.mean(), 0.05, delta=1e-5)
+        for p in [1, 10, 50, 90, 99, 99.9]:
+            expected = p / 100 * 0.1
+            self.assertAlmostEqual(h.percentile(p), expected, delta=expected * 0.04)
+        self.assertAlmostEqual(h.percentile(100), 0.1)
+        self.assertEqual(sum(n for _, n in h.buckets()), 100000)
+        for expected, n in zip([1000, 10000, 100000, 100000],
+                               h.cumulative_counts([0.001, 0.01, 0.1, 10.0])):
+            self.assertAlmostEqual(n, expected, delta=expected * 0.04)
+            # Never more than the durations up to the bound.
+            self.assertLessEqual(n, expected)
+
+    def test_histogram_extreme_values(self):
+        h = LatencyHistogram()
+        h.record(0.0)
+        h.record(1e6)
+        self.assertEqual(h.percentile(0), 0.0)
+        self.assertEqual(h.percentile(100), 1e6)
+
+    def test_histogram_merge(self):
+        h1 = LatencyHistogram()
+        h2 = LatencyHistogram()
+        h1.record(0.001)
+        h2.record(0.003)
+        h2.record(0.005)
+        h1.merge(h2)
+        self.assertEqual(h1.count(), 3)
+        self.assertAlmostEqual(h1.total(), 0.009)
+        self.assertAlmostEqual(h1.percentile(50), 0.003, delta=0.0001)
+        self.assertEqual(h2.count(), 2)
+
+    def test_format_prometheus(self):
+        stats = PacketsStats()
+        stats.rx_packets = {"command": 3, "message": 0}
+        stats.rx_endpoint_packets = {20: 3}
+        stats.crc_errors = 2
+        stats.command_rtt.record(0.001)
+        stats.command_rtt.record(0.002)
+        text = format_prometheus(stats, labels={"port": 'COM"1'})
+        lines = text.splitlines()
+        self.assertIn("# TYPE serial_packets_rx_packets_total counter", lines)
+        self.assertIn('serial_packets_rx_packets_total{port="COM\\"1",type="command"} 3', lines)
+        self.assertIn('serial_packets_rx_endpoint_packets_total{port="COM\\"1",endpoint="20"} 3',
+                      lines)
+        self.assertIn('serial_packets_crc_errors_total{port="COM\\"1"} 2', lines)
+        self.assertIn('serial_packets_command_rtt_seconds_bucket{port="COM\\"1",le="+Inf"} 2',
+                      lines)
+        self.assertIn('serial_packets_command_rtt_seconds_count{port="COM\\"1"} 2', lines)
+        # A fixed ladder of cumulative buckets, also when empty.
+        buckets = [l for l in lines if l.startswith("serial_packets_command_rtt_seconds_bucket")]
+        self.assertEqual(len(buckets), 17)
+        self.assertIn('serial_packets_command_rtt_seconds_bucket{port="COM\\"1",le="0.000500"} 0',
+                      lines)
+        # The 1ms duration is in a bucket that ends above 1ms.
+        self.assertIn('serial_packets_command_rtt_seconds_bucket{port="COM\\"1",le="0.001000"} 0',
+                      lines)
+        self.assertIn('serial_packets_command_rtt_seconds_bucket{port="COM\\"1",le="0.002500"} 2',
+                      lines)
+        self.assertIn('serial_packets_command_rtt_seconds_bucket{port="COM\\"1",le="10.000000"} 2',
+                      lines)
+        callback_buckets = [
+            l for l in lines if l.startswith("serial_packets_callback_seconds_bucket")
+        ]
+        self.assertEqual([l.split()[-1] for l in callback_buckets], ["0"] * 17)
+        self.assertTrue(text.endswith("\n"))
+
+
+if __name__ == '__main__':
+    unittest.main()
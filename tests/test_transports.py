@@ -0,0 +1,113 @@
+# Unit tests of the transports.
+
+import asyncio
+import os
+import socket
+import tty
+import unittest
+import sys
+
+# Assuming VSCode project opened at repo directory
+sys.path.insert(0, "./src")
+
+from serial_packets.client import SerialPacketsClient
+from serial_packets.packets import PacketData, PacketStatus
+from serial_packets.transports import (FdTransport, LoopbackTransport, PacketsTransport,
+                                       TcpClientTransport, TcpServerTransport)
+
+
+def free_tcp_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def close(client: SerialPacketsClient) -> None:
+    client._SerialPacketsClient__transport.close()
+
+
+class Node:
+    """A client that echoes commands and records messages."""
+
+    def __init__(self, transport):
+        self.messages = []
+        self.client = SerialPacketsClient(transport,
+                                          command_async_callback=self.__on_command,
+                                          message_async_callback=self.__on_message)
+
+    async def __on_command(self, endpoint: int, data: PacketData):
+        return (PacketStatus.OK.value, PacketData().add_uint8(endpoint).add_bytes(data.data_bytes()))
+
+    async def __on_message(self, endpoint: int, data: PacketData):
+        self.messages.append((endpoint, data.data_bytes()))
+
+
+class TestTransports(unittest.IsolatedAsyncioTestCase):
+
+    async def check_round_trip(self, node1: Node, node2: Node):
+        status, data = await node1.client.send_command_blocking(7,
+                                                                PacketData().add_bytes(b"\x7e\x7c"),
+                                                                timeout=2.0)
+        self.assertEqual(status, PacketStatus.OK.value)
+        self.assertEqual(data.data_bytes(), bytearray(b"\x07\x7e\x7c"))
+        node2.client.send_message(9, PacketData().add_uint16(0x7d7d))
+        for _ in range(100):
+            if node1.messages:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(node1.messages, [(9, bytearray(b"\x7d\x7d"))])
+
+    async def test_abstract_base(self):
+
+        class NoConnectTransport(PacketsTransport):
+            pass
+
+        with self.assertRaises(TypeError):
+            NoConnectTransport()
+
+    async def test_loopback(self):
+        end1, end2 = LoopbackTransport.pair()
+        node1 = Node(end1)
+        node2 = Node(end2)
+        self.assertTrue(await node1.client.connect())
+        self.assertTrue(await node2.client.connect())
+        await asyncio.sleep(0)
+        self.assertTrue(node1.client.is_connected())
+        await self.check_round_trip(node1, node2)
+        close(node1.client)
+        await asyncio.sleep(0.01)
+        self.assertFalse(node2.client.is_connected())
+
+    async def test_tcp(self):
+        port = free_tcp_port()
+        server = Node(TcpServerTransport("127.0.0.1", port))
+        client = Node(TcpClientTransport("127.0.0.1", port))
+        server_connect = asyncio.create_task(server.client.connect())
+        await asyncio.sleep(0.05)
+        self.assertTrue(await client.client.connect())
+        self.assertTrue(await server_connect)
+        await self.check_round_trip(client, server)
+        await self.check_round_trip(server, client)
+        close(client.client)
+        close(server.client)
+
+    @unittest.skipUnless(hasattr(os, "openpty"), "No pty support")
+    async def test_pty(self):
+        master_fd, slave_fd = os.openpty()
+        tty.setraw(master_fd)
+        tty.setraw(slave_fd)
+        try:
+            node1 = Node(FdTransport(master_fd))
+            node2 = Node(FdTransport(slave_fd))
+            self.assertTrue(await node1.client.connect())
+            self.assertTrue(await node2.client.connect())
+            await self.check_round_trip(node1, node2)
+            close(node1.client)
+            close(node2.client)
+        finally:
+            os.close(master_fd)
+            os.close(slave_fd)
+
+
+if __name__ == '__main__':
+    unittest.main()